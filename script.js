@@ -1,310 +1,197 @@
-// Initialize an array to store unique values from the third column
-const uniqueValues3c = [];
-const uniqueValues1c = [];
-const uniqueValues3and1 = [];
-// Create a table element
+// CSV rows are processed in a Web Worker when possible, so the page does not freeze on large files,
+// and the table is added to the page in one go
 const tableContainer = document.getElementById("tableContainer");
-const table = document.createElement("table");
-const tbody = document.createElement("tbody"); // Create the tbody element
+
+// "Budjettipuu" values of the table rows, kept up to date for syncTable()
+let budjettipuuValues = new Set();
 
 // Add an event listener to the file input element
 const fileInput = document.getElementById("UTF8csvFileInput");
 fileInput.addEventListener("change", (e) => {
     const selectedFile = e.target.files[0];
     if (selectedFile) {
-        handleCSVFile(selectedFile);
+        // Good practice is UTF-8
+        handleCSVFile(selectedFile, "utf-8");
     }
 });
 
-// Function to read a CSV file in "Nordic (ISO 8859-10)" encoding and convert it to UTF-8
-function handleCSVFile(file) {
-    const reader = new FileReader();
-
-    reader.onload = function (e) {
-        const contents = e.target.result;
-
-        // Convert the CSV data to UTF-8 encoding
-        // A:
-        // budjetti.vm.fi https://budjetti.vm.fi/indox/opendata/ = iso-8859-10
-        //const iso8859_10Decoder = new TextDecoder("iso-8859-10");
-        //const utf8Text = iso8859_10Decoder.decode(contents);
-        // B:
-        //Good practice is UTF-8
-        const encryptionDecoder = new TextDecoder("utf-8"); 
-        const utf8Text = encryptionDecoder.decode(contents);
-
-        // Remove double quotes from the CSV text
-        const cleanedText = utf8Text.replace(/"/g, "");
-        const lines = cleanedText.split("\n");
-        console.log("Saatiin rivejä:", lines.length);
-
-        const table = document.createElement("table");
-        const tbody = document.createElement("tbody"); // Create a tbody element
-
-        // Initialize a flag to identify the header row
-        let isFirstRow = true;
-
-        // Loop through CSV lines
-        isFirstRow = processCSVLines(lines, tbody, isFirstRow); // Call the processCSVLines function
-
-        // Clear previous table and append the new one
-        tableContainer.innerHTML = "";
-        table.innerHTML = "";
-        tableContainer.appendChild(table);
-        table.appendChild(tbody);
-    };
-
-    reader.readAsArrayBuffer(file);
-}
-
 // Add an event listener to the file input element
 const fileInput2 = document.getElementById("ISO885910csvFileInput");
 fileInput2.addEventListener("change", (e) => {
     const selectedFile = e.target.files[0];
     if (selectedFile) {
-        handleISOCSVFile(selectedFile);
+        // budjetti.vm.fi https://budjetti.vm.fi/indox/opendata/ = iso-8859-10
+        handleCSVFile(selectedFile, "iso-8859-10");
     }
 });
 
-// Function to read a CSV file in "Nordic (ISO 8859-10)" encoding and convert it to UTF-8
-function handleISOCSVFile(file) {
+// Function to read a CSV file in given encoding and show it as a table
+function handleCSVFile(file, encoding) {
     const reader = new FileReader();
 
     reader.onload = function (e) {
-        const contents = e.target.result;
-
-        // Convert the CSV data to UTF-8 encoding
-        // A:
-        // budjetti.vm.fi https://budjetti.vm.fi/indox/opendata/ = iso-8859-10
-        const iso8859_10Decoder = new TextDecoder("iso-8859-10");
-        const utf8Text = iso8859_10Decoder.decode(contents);
-        // B:
-        //Good practice is UTF-8
-        //const encryptionDecoder = new TextDecoder("utf-8"); 
-        //const utf8Text = encryptionDecoder.decode(contents);
-
-        // Remove double quotes from the CSV text
-        const cleanedText = utf8Text.replace(/"/g, "");
-        const lines = cleanedText.split("\n");
-        console.log("Saatiin rivejä:", lines.length);
-
-        const table = document.createElement("table");
-        const tbody = document.createElement("tbody"); // Create a tbody element
-
-        // Initialize a flag to identify the header row
-        let isFirstRow = true;
-
-        // Loop through CSV lines
-        isFirstRow = processCSVLines(lines, tbody, isFirstRow); // Call the processCSVLines function
-
-        // Clear previous table and append the new one
-        tableContainer.innerHTML = "";
-        table.innerHTML = "";
-        tableContainer.appendChild(table);
-        table.appendChild(tbody);
+        buildRows(e.target.result, encoding, renderRows);
     };
 
     reader.readAsArrayBuffer(file);
 }
 
-function processCSVLines(lines, tbody, isFirstRow) {
-    lines.forEach((line, index) => {
-        const row = document.createElement("tr");
-        const cells = line.split(";"); // Use semicolon as the separator
+// Decodes and processes CSV contents in a Web Worker, or in the page if a worker can not be used,
+// for example when the page is opened from a file and the browser does not allow workers there
+function buildRows(contents, encoding, callback) {
+    const processInPage = () => callback(processCSVLines(decodeCSV(contents, encoding)));
+
+    let worker = null;
+    let workerUrl = null;
+    try {
+        // Worker runs the same functions, so the page works without a separate worker file
+        const source = `${decodeCSV.toString()}\n${processCSVLines.toString()}\n` +
+            "onmessage = (e) => { postMessage(processCSVLines(decodeCSV(e.data.contents, e.data.encoding))); };";
+        workerUrl = URL.createObjectURL(new Blob([source], { type: "text/javascript" }));
+        worker = new Worker(workerUrl);
+    } catch (err) {
+        console.log("Web Worker ei käytettävissä, käsitellään sivulla:", err);
+        if (workerUrl) {
+            URL.revokeObjectURL(workerUrl);
+        }
+        processInPage();
+        return;
+    }
 
-        cells.forEach((cell, cellIndex) => {
-            const cellElement = isFirstRow ? document.createElement("th") : document.createElement("td");
-            cellElement.textContent = cell.trim();
+    worker.onmessage = (e) => {
+        worker.terminate();
+        URL.revokeObjectURL(workerUrl);
+        callback(e.data);
+    };
+    worker.onerror = (e) => {
+        e.preventDefault();
+        worker.terminate();
+        URL.revokeObjectURL(workerUrl);
+        console.log("Web Worker epäonnistui, käsitellään sivulla:", e.message);
+        processInPage();
+    };
+    // Contents are copied, not transferred, so they are still available if the worker fails
+    worker.postMessage({ contents, encoding });
+}
 
-            // If it's the header row, set the cell as a table header (th)
-            if (isFirstRow) {
-                cellElement.scope = "col";
-            }
+// Function to convert the CSV data to UTF-8 text lines
+function decodeCSV(contents, encoding) {
+    const decoder = new TextDecoder(encoding);
+    const text = decoder.decode(contents);
 
-            row.appendChild(cellElement);
-        });
+    // Remove double quotes from the CSV text
+    const cleanedText = text.replace(/"/g, "");
+    const lines = cleanedText.split("\n");
+    console.log("Saatiin rivejä:", lines.length);
+    return lines;
+}
 
-        // Add the "Budjettipuu" column to the header and data rows
-        if (isFirstRow) {
-            // For the header row, add headers
-            const budjettipuuHeader = document.createElement("th");
-            budjettipuuHeader.textContent = "Budjettipuu";
-            row.insertBefore(budjettipuuHeader, row.firstChild);
-            const momenttitasoHeader = document.createElement("th");
-            momenttitasoHeader.textContent = "Momenttitaso";
-            row.insertBefore(momenttitasoHeader, row.firstChild);
-        } else {
-            // For data rows, calculate and add the "Budjettipuu" value
-            const firstColumn = cells[0] ? cells[0].trim() : "";
-            const thirdColumn = cells[2] ? cells[2].trim() : "";
-            const fifthColumn = cells[4] ? cells[4].trim() : "";
-            const budjettipuuCell = document.createElement("td");
-            budjettipuuCell.textContent = `${firstColumn}.${thirdColumn}.${fifthColumn}.`;
-            row.insertBefore(budjettipuuCell, row.firstChild);
-
-            const momenttitasoCell = document.createElement("td");
-            momenttitasoCell.textContent = `3`;
-            row.insertBefore(momenttitasoCell, row.firstChild);
-
-            // Store unique values from the first column
-            if (cells[0]) {
-                const uniqueValue1 = cells[0].trim();
-                if (!uniqueValues1c.includes(uniqueValue1)) {
-                    uniqueValues1c.push(uniqueValue1);
-                }
-                // Store unique values from the third column
-                if (cells[2]) {
-                    const uniqueValue3and1 = `${cells[0].trim()}.${cells[2].trim()}`;
-                    if (!uniqueValues3c.includes(uniqueValue3and1)) {
-                        uniqueValues3c.push(uniqueValue3and1);
-                    }
-                }
+// Processes CSV lines in one pass. Returns table rows as arrays of cell texts: the data rows with
+// "Momenttitaso" and "Budjettipuu" cells in front, then a summed row for each unique paaluokka and menoluku,
+// and then for each unique paaluokka. Header row is left out.
+// Runs in the worker too, so it must not use anything outside of itself.
+function processCSVLines(lines) {
+    const rows = [];
+    // Momenttitaso 2 and 1 rows, by their paaluokka.menoluku and paaluokka, in order of first appearance
+    const momenttitaso2 = new Map();
+    const momenttitaso1 = new Map();
+
+    // Adds cells 8 to 20 to the sums
+    const addToSums = (sums, cells) => {
+        for (let cellIndex = 7; cellIndex <= 19; cellIndex++) {
+            if (cells[cellIndex]) {
+                sums[cellIndex - 7] += parseFloat(cells[cellIndex]);
             }
-            // Store unique values from the combined first and third columns
-            if (cells[0] && cells[2]) {
-                const uniqueValue3and1 = `${cells[0].trim()}.${cells[2].trim()}`;
-                if (!uniqueValues3and1.includes(uniqueValue3and1)) {
-                    uniqueValues3and1.push(uniqueValue3and1);
-                }
+        }
+    };
+
+    // Row based on the first row of its group, with sums and emptied cells
+    const createSumRow = (group, momenttitaso, budjettipuu, emptyCells) => {
+        const values = group.firstRow.map((value, cellIndex) => {
+            if (cellIndex >= 7 && cellIndex <= 19) {
+                return String(group.sums[cellIndex - 7]);
             }
+            return emptyCells.has(cellIndex) ? "" : value;
+        });
+        return [momenttitaso, budjettipuu, ...values];
+    };
 
-            tbody.appendChild(row);
+    lines.forEach((line, index) => {
+        // Header row is not shown
+        if (index === 0) {
+            return;
         }
+        const cells = line.split(";"); // Use semicolon as the separator
+        const trimmed = cells.map((cell) => cell.trim());
+
+        const firstColumn = cells[0] ? trimmed[0] : "";
+        const thirdColumn = cells[2] ? trimmed[2] : "";
+        const fifthColumn = cells[4] ? trimmed[4] : "";
+        rows.push(["3", `${firstColumn}.${thirdColumn}.${fifthColumn}.`, ...trimmed]);
 
-        // After processing the first row, set the flag to false
-        if (isFirstRow) {
-            isFirstRow = false;
+        if (!cells[0]) {
+            return;
         }
+        let group1 = momenttitaso1.get(trimmed[0]);
+        if (!group1) {
+            group1 = { firstRow: trimmed, sums: Array(13).fill(0) };
+            momenttitaso1.set(trimmed[0], group1);
+        }
+        if (!cells[2]) {
+            return;
+        }
+        const key2 = `${trimmed[0]}.${trimmed[2]}`;
+        let group2 = momenttitaso2.get(key2);
+        if (!group2) {
+            group2 = { firstRow: trimmed, sums: Array(13).fill(0) };
+            momenttitaso2.set(key2, group2);
+        }
+        addToSums(group1.sums, cells);
+        addToSums(group2.sums, cells);
     });
 
     console.log("Tehdään momenttitaso 2 ja summaus puuttuneille");
-    console.log(uniqueValues3and1);
-    // Create new rows based on unique values in the combined first and third columns
-    uniqueValues3and1.forEach((uniqueValue) => {
-        const newRow = createMomenttitaso2(lines, uniqueValue);
-        tbody.appendChild(newRow);
+    momenttitaso2.forEach((group) => {
+        // Ensure the fifth, and sixth cells are empty
+        rows.push(createSumRow(group, "2", `${group.firstRow[0]}.${group.firstRow[2]}.`, new Set([4, 5])));
     });
     console.log("Tehdään momenttitaso 1 ja summaus puuttuneille");
-    console.log(uniqueValues1c);
-    // Create new rows based on unique values in the first column
-    uniqueValues1c.forEach((uniqueValue) => {
-        const newRow = createMomenttitaso1(lines, uniqueValue);
-        tbody.appendChild(newRow);
+    momenttitaso1.forEach((group) => {
+        // Ensure the third, fourth, fifth, and sixth cells are empty
+        rows.push(createSumRow(group, "1", `${group.firstRow[0]}.`, new Set([2, 3, 4, 5])));
     });
 
-    return isFirstRow;
+    return rows;
 }
 
-// Function to create a new row based on a unique value in the third column
-function createMomenttitaso2(lines, uniqueValue) {
-    const newRow = document.createElement("tr");
-
-    // Initialize an array to store values for the new row
-    const newRowValues = [];
-
-    // Find rows with matching values in the third column
-    lines.forEach((line) => {
-        const cells = line.split(";");
-        if (cells[2] && `${cells[0].trim()}.${cells[2].trim()}` === uniqueValue) {
-            newRowValues.push(cells.map((cell) => cell.trim()));
-        }
+// Function to show rows as the table, replacing previous table
+function renderRows(rows) {
+    const table = document.createElement("table");
+    const tbody = document.createElement("tbody"); // Create a tbody element
+
+    // Rows are collected in a fragment and added with a single insertion
+    const fragment = document.createDocumentFragment();
+    budjettipuuValues = new Set();
+    rows.forEach((values) => {
+        fragment.appendChild(createRow(values));
+        budjettipuuValues.add(values[1]);
     });
+    tbody.appendChild(fragment);
+    table.appendChild(tbody);
 
-    // Calculate the sums of each cell with matching first and third cell values
-    const sums = calculateSumsOfMatchingCells(lines, newRowValues[0][0], newRowValues[0][2]);
-
-    // Fill in values for the new row based on the row beneath it
-    if (newRowValues.length > 0) {
-        newRowValues[0].forEach((value, cellIndex) => {
-            const cellElement = document.createElement("td");
-            if (cellIndex >= 7 && cellIndex <= 19) {
-                // Set the sum of the corresponding cell with matching first and third cell values
-                cellElement.textContent = sums[cellIndex - 7]; // Adjust the index
-            } else if (cellIndex === 4 || cellIndex === 5) {
-                // Ensure the fifth, and sixth cells are empty
-                cellElement.textContent = "";
-            } else {
-                cellElement.textContent = value;
-            }
-            newRow.appendChild(cellElement);
-        });
-    }
-
-    // Add the "Budjettipuu" column to the new row
-    const budjettipuuCell = document.createElement("td");
-    budjettipuuCell.textContent = `${newRowValues[0][0]}.${newRowValues[0][2]}.`;
-    newRow.insertBefore(budjettipuuCell, newRow.firstChild);
-
-    const momenttitasoCell = document.createElement("td");
-    momenttitasoCell.textContent = `2`;
-    newRow.insertBefore(momenttitasoCell, newRow.firstChild);
-
-    return newRow;
+    // Clear previous table and append the new one
+    tableContainer.innerHTML = "";
+    tableContainer.appendChild(table);
 }
 
-// Function to create a new row based on a unique value in the third column
-function createMomenttitaso1(lines, uniqueValue) {
-    const newRow = document.createElement("tr");
-
-    // Initialize an array to store values for the new row
-    const newRowValues = [];
-
-    // Find rows with matching values in the third column
-    lines.forEach((line) => {
-        const cells = line.split(";");
-        if (cells[0] && cells[0].trim() === uniqueValue) {
-            newRowValues.push(cells.map((cell) => cell.trim()));
-        }
+function createRow(values) {
+    const row = document.createElement("tr");
+    values.forEach((value) => {
+        const cellElement = document.createElement("td");
+        cellElement.textContent = value;
+        row.appendChild(cellElement);
     });
-
-    // Calculate the sums of each cell with matching first and third cell values
-    const sums = calculateSumsOfMatchingCells(lines, newRowValues[0][0], null);
-
-    // Fill in values for the new row based on the row beneath it
-    if (newRowValues.length > 0) {
-        newRowValues[0].forEach((value, cellIndex) => {
-            const cellElement = document.createElement("td");
-            if (cellIndex >= 7 && cellIndex <= 19) {
-                // Set the sum of the corresponding cell with matching first and third cell values
-                cellElement.textContent = sums[cellIndex - 7]; // Adjust the index
-            } else if (cellIndex === 2 || cellIndex === 3 || cellIndex === 4 || cellIndex === 5) {
-                // Ensure the third, fourth, fifth, and sixth cells are empty
-                cellElement.textContent = "";
-            } else {
-                cellElement.textContent = value;
-            }
-            newRow.appendChild(cellElement);
-        });
-    }
-
-    // Add the "Budjettipuu" column to the new row
-    const budjettipuuCell = document.createElement("td");
-    budjettipuuCell.textContent = `${newRowValues[0][0]}.`;
-    newRow.insertBefore(budjettipuuCell, newRow.firstChild);
-
-    const momenttitasoCell = document.createElement("td");
-    momenttitasoCell.textContent = `1`;
-    newRow.insertBefore(momenttitasoCell, newRow.firstChild);
-
-    return newRow;
-}
-
-// Function to calculate the sums of specified cells (8th to 20th) with matching first and third cell values
-function calculateSumsOfMatchingCells(lines, firstCellValue, thirdCellValue) {
-    const sums = Array(13).fill(0); // Initialize an array for cells 8 to 20
-
-    lines.forEach((line) => {
-        const cells = line.split(";");
-        if (cells[0] && cells[0].trim() === firstCellValue && cells[2] && (cells[2].trim() === thirdCellValue || thirdCellValue === null)) {
-            for (let cellIndex = 7; cellIndex <= 19; cellIndex++) {
-                if (cells[cellIndex]) {
-                    sums[cellIndex - 7] += parseFloat(cells[cellIndex]);
-                }
-            }
-        }
-    });
-
-    return sums;
+    return row;
 }
 
 // Add an HTML input field for the new values
@@ -325,10 +212,7 @@ function syncTable() {
     console.log("Uuden budjetin momentit:", uniqueBudjettipuuValues);
 
     // Find values that are in newValues but not in the current "Budjettipuu" column
-    const missingValues = newValues.filter((newValue) => {
-        // Check if it doesn't exist in the current "Budjettipuu" values
-        return !uniqueBudjettipuuValues.includes(newValue);
-    });
+    const missingValues = newValues.filter((newValue) => !uniqueBudjettipuuValues.has(newValue));
 
     console.log("Vanhan budjetin momentit joita ei ollut uudessa:", missingValues);
 
@@ -336,38 +220,23 @@ function syncTable() {
     // Check if there's an existing table
     const existingTable = document.querySelector("#tableContainer table");
     const tbody = existingTable ? existingTable.querySelector("tbody") : null;
+    if (!tbody) {
+        console.error("Table or tbody not found.");
+        return;
+    }
 
     // Create empty table rows for missing values and add them inside the tbody
+    const fragment = document.createDocumentFragment();
     missingValues.forEach((missingValue) => {
-        const newRow = createEmptyRow(missingValue);
-        if (tbody) {
-            tbody.appendChild(newRow);
-        } else {
-            console.error("Table or tbody not found.");
-        }
+        fragment.appendChild(createEmptyRow(missingValue));
     });
+    tbody.appendChild(fragment);
+    missingValues.forEach((missingValue) => uniqueBudjettipuuValues.add(missingValue));
 }
 
+// "Budjettipuu" values of all table rows, including empty rows added by syncTable()
 function getUniqueBudjettipuuValues() {
-    const uniqueBudjettipuuValues = [];
-
-    // Select the table element
-    const table = document.querySelector("table");
-
-    // Iterate through the rows of the table
-    const rows = table.querySelectorAll("tr");
-    for (let i = 1; i < rows.length; i++) { // Start from 1 to skip the header row
-        const row = rows[i];
-        const budjettipuuCell = row.querySelector("td:nth-child(2)"); // Assuming the "Budjettipuu" cell is the first one
-        if (budjettipuuCell) {
-            const budjettipuuValue = budjettipuuCell.textContent.trim();
-            if (!uniqueBudjettipuuValues.includes(budjettipuuValue)) {
-                uniqueBudjettipuuValues.push(budjettipuuValue);
-            }
-        }
-    }
-
-    return uniqueBudjettipuuValues;
+    return budjettipuuValues;
 }
 
 // Function to create an empty row based on missingValues input
@@ -387,4 +256,4 @@ function createEmptyRow(missingValues) {
     newRow.insertBefore(momenttitasoCell, newRow.firstChild);
 
     return newRow;
-}
\ No newline at end of file
+}
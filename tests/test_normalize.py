@@ -0,0 +1,120 @@
+"""
+Checks normalize command against script.js, which it is a port of.
+
+fixtures/normalize-expected.csv is script.js output for the fixture CSVs, with the header row normalize writes.
+If node is installed, script.js is also run on the fixtures and compared directly.
+"""
+import importlib.util
+import json
+import math
+import os
+import shutil
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, 'tests', 'fixtures')
+ENCODINGS = ['utf-8', 'iso-8859-10']
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('vaihtoehtobudjetti_wordpress',
+                                                  os.path.join(ROOT, 'vaihtoehtobudjetti-wordpress.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+vb = load_script()
+
+
+def fixture(encoding):
+    return os.path.join(FIXTURES, 'normalize-%s.csv' % encoding)
+
+
+def read_expected():
+    with open(os.path.join(FIXTURES, 'normalize-expected.csv'), 'r', encoding='utf-8', newline='') as file:
+        return file.read()
+
+
+def run_node(source, *args):
+    return subprocess.run(['node', '-e', source, '--'] + list(args), check=True, capture_output=True,
+                          encoding='utf-8').stdout
+
+
+needs_node = pytest.mark.skipif(shutil.which('node') is None, reason='node is not installed')
+
+# Runs decodeCSV() and processCSVLines() of script.js without a browser
+SCRIPT_JS_ROWS = """
+const fs = require('fs');
+const vm = require('vm');
+const context = { document: { getElementById: () => ({ addEventListener() {} }) }, console: { log() {} }, TextDecoder };
+vm.createContext(context);
+vm.runInContext(fs.readFileSync(process.argv[1], 'utf8'), context);
+const rows = context.processCSVLines(context.decodeCSV(fs.readFileSync(process.argv[2]), process.argv[3]));
+process.stdout.write(rows.map((row) => row.join(';')).join('\\n') + '\\n');
+"""
+
+
+@pytest.mark.parametrize('fixture_encoding, encoding', [(fixture_encoding, encoding) for fixture_encoding in ENCODINGS
+                                                        for encoding in ('auto', fixture_encoding)])
+def test_normalize_fixture(tmp_path, fixture_encoding, encoding):
+    output = tmp_path / 'normalized.csv'
+    vb.normalize_budget_csv(fixture(fixture_encoding), str(output), encoding)
+    assert output.read_text(encoding='utf-8') == read_expected()
+
+
+@needs_node
+@pytest.mark.parametrize('encoding', ENCODINGS)
+def test_normalize_matches_script_js(encoding):
+    rows = run_node(SCRIPT_JS_ROWS, os.path.join(ROOT, 'script.js'), fixture(encoding), encoding)
+    # script.js does not show the header row
+    assert rows == read_expected().split('\n', 1)[1]
+
+
+def test_blank_lines_and_crlf():
+    # Unlike script.js, blank lines are skipped and CRLF does not make the last cell NaN
+    lines = ['a;b;c\r\n', '21;X;01;Y;01;Z;;1\r\n', '\r\n', '21;X;01;Y;02;Z;;2\r\n']
+    rows = [';'.join(row) for row in vb.iter_normalized_rows(lines)]
+    assert rows == [
+        'Momenttitaso;Budjettipuu;a;b;c',
+        '3;21.01.01.;21;X;01;Y;01;Z;;1',
+        '3;21.01.02.;21;X;01;Y;02;Z;;2',
+        '2;21.01.;21;X;01;Y;;;;3',
+        '1;21.;21;X;;;;;;3',
+    ]
+
+
+NUMBERS = [1e21, 1e20, 123456789012345680000, 1.5e-7, 0.000001, 0.0000001, 123.456, -0.0, 0.1 + 0.2, 5e-324,
+           1.7976931348623157e308, -1234.5, 2.0 ** 53, 1e-6 * 3, 100.0, math.nan, math.inf, -math.inf]
+NUMBER_TEXTS = ['1e+21', '100000000000000000000', '123456789012345680000', '1.5e-7', '0.000001', '1e-7', '123.456',
+                '0', '0.30000000000000004', '5e-324', '1.7976931348623157e+308', '-1234.5', '9007199254740992',
+                '0.000003', '100', 'NaN', 'Infinity', '-Infinity']
+
+
+@pytest.mark.parametrize('value, text', list(zip(NUMBERS, NUMBER_TEXTS)))
+def test_format_js_number(value, text):
+    assert vb.format_js_number(value) == text
+
+
+FLOAT_TEXTS = ['12abc', 'abc', ' 1e3x', '.5', '-Infinity', '1e', '', '+.5e-2z', '0x10', '  -7.25 ', 'Infinityx', '1.2.3']
+FLOATS = [12.0, math.nan, 1000.0, 0.5, -math.inf, 1.0, math.nan, 0.005, 0.0, -7.25, math.inf, 1.2]
+
+
+@pytest.mark.parametrize('text, value', list(zip(FLOAT_TEXTS, FLOATS)))
+def test_parse_js_float(text, value):
+    parsed = vb.parse_js_float(text)
+    assert parsed == value or (math.isnan(value) and math.isnan(parsed))
+
+
+@needs_node
+def test_numbers_match_javascript():
+    output = run_node("""
+        const [numbers, texts] = JSON.parse(process.argv[1]);
+        console.log(JSON.stringify([numbers.map((x) => String(x === null ? NaN : x)), texts.map((s) => String(parseFloat(s)))]));
+    """, json.dumps([[x if math.isfinite(x) else None for x in NUMBERS], FLOAT_TEXTS]))
+    numbers, floats = json.loads(output)
+    finite = [text for value, text in zip(NUMBERS, NUMBER_TEXTS) if math.isfinite(value)]
+    assert [text for value, text in zip(NUMBERS, numbers) if math.isfinite(value)] == finite
+    assert floats == [vb.format_js_number(vb.parse_js_float(text)) for text in FLOAT_TEXTS]
@@ -0,0 +1,98 @@
+"""
+Checks sharded publishing against a fake Wordpress REST api
+"""
+import importlib.util
+import os
+import types
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_script():
+    spec = importlib.util.spec_from_file_location('vaihtoehtobudjetti_wordpress',
+                                                  os.path.join(ROOT, 'vaihtoehtobudjetti-wordpress.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+vb = load_script()
+
+
+class FakeWordpress:
+    """
+    Pages in memory, get_pages() lists only published pages unless status is given like Wordpress does
+    """
+    url = 'https://example.invalid/wp-json/wp/v2'
+
+    def __init__(self, parent_status):
+        self.pages = {1: {'id': 1, 'slug': 'budjetti', 'status': parent_status, 'parent': 0, 'content': {'raw': ''}}}
+        self.created = []
+        # Content Wordpress stores for old and sent content
+        self.save = lambda old, new: new
+
+    def page(self, page_id):
+        page = self.pages[page_id]
+        return dict(page, link='https://example.invalid/%s/' % page['slug'], modified='2023-01-01T00:00:00')
+
+    def get_page(self, page_id, context=None):
+        return self.page(page_id)
+
+    def get_pages(self, params=None, per_page=100):
+        statuses = (params or {}).get('status', 'publish').split(',')
+        return [self.page(page_id) for page_id, page in self.pages.items()
+                if page['parent'] == params.get('parent') and page['status'] in statuses]
+
+    def create_page(self, title, content, slug=None, parent=None, status='draft'):
+        page_id = max(self.pages) + 1
+        self.pages[page_id] = {'id': page_id, 'slug': slug, 'status': status, 'parent': parent,
+                               'content': {'raw': content}}
+        self.created.append(slug)
+        return self.page(page_id)
+
+    def update_page(self, page_id, content):
+        self.pages[page_id]['content'] = {'raw': self.save(self.pages[page_id]['content']['raw'], content)}
+        return self.page(page_id)
+
+
+@pytest.fixture
+def publishing(tmp_path, monkeypatch):
+    monkeypatch.setattr(vb, 'PUBLISH_MANIFEST', str(tmp_path / 'manifest.json'), raising=False)
+    monkeypatch.setattr(vb, 'PUBLISH_WORKERS', 2, raising=False)
+    monkeypatch.setattr(vb, 'generate_html', lambda data, summary, links=None, lazy_tables=False: 'index %r' % links)
+
+
+def shards():
+    rows = [types.SimpleNamespace(osoite=osoite, paaluokka_selite='Selite') for osoite in ('21.', '22.')]
+    return {vb.paaluokka_slug(row): (row, '<p>%s</p>' % row.osoite) for row in rows}
+
+
+@pytest.mark.parametrize('parent_status', ['publish', 'draft', 'pending', 'private'])
+def test_second_run_creates_no_pages(publishing, parent_status):
+    client = FakeWordpress(parent_status)
+    assert vb.publish_sharded(client, 1, {}, None, shards()) == 'updated'
+    assert sorted(client.created) == ['paaluokka-21', 'paaluokka-22']
+    assert vb.publish_sharded(client, 1, {}, None, shards()) == 'unchanged'
+    assert sorted(client.created) == ['paaluokka-21', 'paaluokka-22']
+    assert {page['status'] for page in client.pages.values()} == {parent_status}
+
+
+def test_update_that_did_not_go_through_fails(publishing):
+    client = FakeWordpress('publish')
+    client.pages[1]['content'] = {'raw': '<p>old</p>'}
+    client.save = lambda old, new: old
+    assert vb.publish_page(1, '<p>new</p>', client=client) is None
+    client.save = lambda old, new: ''
+    assert vb.publish_page(1, '<p>new</p>', client=client) is None
+    assert vb.load_publish_manifest()[client.url + '/pages/1']['hash'] == vb.content_hash('<p>old</p>')
+
+
+def test_content_filtered_when_saving_is_recorded(publishing):
+    client = FakeWordpress('publish')
+    client.save = lambda old, new: new.replace('<script>x</script>', '')
+    content = '<p>new</p><script>x</script>'
+    assert vb.publish_page(1, content, client=client) == 'updated'
+    assert vb.load_publish_manifest()[client.url + '/pages/1']['hash'] == vb.content_hash(content)
+    assert vb.publish_page(1, content, client=client) == 'unchanged'
@@ -1,11 +1,31 @@
 from __future__ import print_function
 from collections import defaultdict
+from collections.abc import Mapping
 
 import datetime
 
 import sys
 import os.path
 import configparser
+import argparse
+import array
+import codecs
+import contextlib
+import csv
+import gzip
+import hashlib
+import json
+import mmap
+import pickle
+import random
+import re
+import string
+import struct
+import threading
+import time
+import types
+import zlib
+import functools
 from unicodedata import decimal
 
 #
@@ -16,109 +36,272 @@ from unicodedata import decimal
 
 # Main config file, paths to secrets and google and worpress configuration
 CONFIG_INI = 'vaihtoehtobudjetti-wordpress.ini'
-print("Current working directory %s" % os.getcwd())
-if not os.path.exists(CONFIG_INI):
-    print("Mandatory config file missing, expected to find %s" % CONFIG_INI)
-    sys.exit(1)
-config = configparser.ConfigParser()
-config.read(CONFIG_INI)
-
-try:
-    WORDPRESS_AUTHENTICATION_FILE = config.get('secrets', 'WORDPRESS_AUTHENTICATION')
-    GOOGLE_AUTHENTICATION_FILE = config.get('secrets', 'GOOGLE_AUTHENTICATION')
-    GOOGLE_TOKEN_FILE = config.get('secrets', 'GOOGLE_TOKEN')
-except configparser.NoOptionError as e:
-    print("Mandatory config key missing, please review %s. %r" % (CONFIG_INI, e))
-    sys.exit(1)
-
-# Wordpress authentication config
-wpconfig = configparser.ConfigParser()
-wpconfig.read(WORDPRESS_AUTHENTICATION_FILE)
-try:
-    WP_USERNAME = wpconfig.get('wordpress', 'USERNAME')
-    WP_APP_PASSWORD = wpconfig.get('wordpress', 'APP_PASSWORD')
-except configparser.NoOptionError as e:
-    print("Mandatory config key missing, please review %s. %r" % (WORDPRESS_AUTHENTICATION_FILE, e))
-    sys.exit(1)
-
-# Google sheets
-# How to run, see: https://developers.google.com/sheets/api/quickstart/python
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
 # If modifying these scopes, delete the file GOOGLE_TOKEN_FILE
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly']
-
-# The ID and range of a sample spreadsheet.
-try:
-    SPREADSHEET_ID = config.get('google', 'SPREADSHEET_ID')
-    SHEET_NAME = config.get('google', 'SHEET_NAME')
-    SHEET_EXTRAS = config.get('google', 'SHEET_EXTRAS')
-    COL_IDX_TULO = config.getint('google', 'COL_IDX_TULO')
-    COL_IDX_SYVYYS = config.getint('google', 'COL_IDX_SYVYYS')
-    COL_IDX_PAALUOKKA = config.getint('google', 'COL_IDX_PAALUOKKA')
-    COL_IDX_PAALUOKKA_SELITE = config.getint('google', 'COL_IDX_PAALUOKKA_SELITE')
-    COL_IDX_MENOLUOKKA = config.getint('google', 'COL_IDX_MENOLUOKKA')
-    COL_IDX_MENOLUOKKA_SELITE = config.getint('google', 'COL_IDX_MENOLUOKKA_SELITE')
-    COL_IDX_MOMENTTI = config.getint('google', 'COL_IDX_MOMENTTI')
-    COL_IDX_MOMENTTI_SELITE = config.getint('google', 'COL_IDX_MOMENTTI_SELITE')    
-    COL_IDX_HALLITUS = config.getint('google', 'COL_IDX_HALLITUS')
-    COL_IDX_LIB = config.getint('google', 'COL_IDX_LIB')
-    COL_IDX_PERUSTELU = config.getint('google', 'COL_IDX_PERUSTELU')
-    COL_IDX_OSOITE = config.getint('google', 'COL_IDX_OSOITE')
-    COL_IDX_LINKKI = config.getint('google', 'COL_IDX_LINKKI')
-    COL_IDX_ERO = config.getint('google', 'COL_IDX_ERO')
-    COL_IDX_ERO_PERCENT = config.getint('google', 'COL_IDX_ERO_PERCENT')
-except configparser.NoOptionError as e:
-    print("Mandatory config key missing, please review %s. %r" % (CONFIG_INI, e))
-    sys.exit(1)
-
-# Wordpress
-import requests
-# Configuration
-# Note: To generate app_password, see wp-admin, users, edit user
-try:
-    WORDPRESS_URL = config.get('wordpress', 'WORDPRESS_URL')
-    PAGE_ID = config.getint('wordpress', 'PAGE_ID') 
-except configparser.NoOptionError:
-    print("Mandatory config key missing, please review %s" % CONFIG_INI)
-    sys.exit(1)
-
-# Headers for the API request
-HEADERS = {
-    'Authorization': f'{requests.auth._basic_auth_str(WP_USERNAME, WP_APP_PASSWORD)}',
-    'Content-Type': 'application/json'
-}
+# Drive metadata is used to read spreadsheet version for snapshot cache
+SCOPES = ['https://www.googleapis.com/auth/spreadsheets.readonly',
+          'https://www.googleapis.com/auth/drive.metadata.readonly']
+
+# Increase when DataObject or parsing changes, old snapshots are then ignored
+SNAPSHOT_FORMAT = 6
+
+# Importing has no side effects. Configuration is read by load_config() when a command is run,
+# secrets by load_wordpress_secrets() and get_google_credentials() when they are needed.
+# Google client, requests and yattag are imported where used, see Doc().
+config = None
+wpconfig = None
+# Config file read by load_config(), for messages
+config_path = CONFIG_INI
+
+def load_config(path=CONFIG_INI) -> None:
+    """
+    Reads config file to module level settings below
+    """
+    global config, config_path
+    global WORDPRESS_AUTHENTICATION_FILE, GOOGLE_AUTHENTICATION_FILE, GOOGLE_TOKEN_FILE
+    global SPREADSHEET_ID, SHEET_NAME, SHEET_EXTRAS
+    global COL_IDX_TULO, COL_IDX_SYVYYS, COL_IDX_PAALUOKKA, COL_IDX_PAALUOKKA_SELITE, COL_IDX_MENOLUOKKA
+    global COL_IDX_MENOLUOKKA_SELITE, COL_IDX_MOMENTTI, COL_IDX_MOMENTTI_SELITE, COL_IDX_HALLITUS, COL_IDX_LIB
+    global COL_IDX_PERUSTELU, COL_IDX_OSOITE, COL_IDX_LINKKI, COL_IDX_ERO, COL_IDX_ERO_PERCENT
+    global DATA_SOURCE, CSV_FILE, CSV_EXTRAS, CSV_ENCODING
+    global SYNTHETIC_TREE, SYNTHETIC_TAE, SYNTHETIC_ROWS, SYNTHETIC_SEED, CHECK_TOTALS, FILL_MISSING_PARENTS
+    global CACHE_ENABLED, CACHE_DIRECTORY, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS, CACHE_TREE
+    global WORDPRESS_URL, PAGE_ID, PUBLISH_MANIFEST, WORDPRESS_TIMEOUT, WORDPRESS_RETRIES, WORDPRESS_COMPRESS
+    global WORDPRESS_STREAM, WORDPRESS_TARGETS, PUBLISH_WORKERS, SHARDED
+    global TABLES, RENDERER, RENDER_WORKERS, COMPARE_TO
+    global HISTORY_DATABASE, TOTEUTUMA_YEAR
+    global BENCH_FIXTURE, BENCH_SCALES, BENCH_REPEAT
+
+    print("Current working directory %s" % os.getcwd())
+    if not os.path.exists(path):
+        print("Mandatory config file missing, expected to find %s" % path)
+        sys.exit(1)
+    config = configparser.ConfigParser()
+    config.read(path)
+    config_path = path
+
+    # Checked when used, not all commands need secrets
+    WORDPRESS_AUTHENTICATION_FILE = config.get('secrets', 'WORDPRESS_AUTHENTICATION', fallback=None)
+    GOOGLE_AUTHENTICATION_FILE = config.get('secrets', 'GOOGLE_AUTHENTICATION', fallback=None)
+    GOOGLE_TOKEN_FILE = config.get('secrets', 'GOOGLE_TOKEN', fallback=None)
+
+    # The ID and range of a sample spreadsheet.
+    try:
+        SPREADSHEET_ID = config.get('google', 'SPREADSHEET_ID')
+        SHEET_NAME = config.get('google', 'SHEET_NAME')
+        SHEET_EXTRAS = config.get('google', 'SHEET_EXTRAS')
+        COL_IDX_TULO = config.getint('google', 'COL_IDX_TULO')
+        COL_IDX_SYVYYS = config.getint('google', 'COL_IDX_SYVYYS')
+        COL_IDX_PAALUOKKA = config.getint('google', 'COL_IDX_PAALUOKKA')
+        COL_IDX_PAALUOKKA_SELITE = config.getint('google', 'COL_IDX_PAALUOKKA_SELITE')
+        COL_IDX_MENOLUOKKA = config.getint('google', 'COL_IDX_MENOLUOKKA')
+        COL_IDX_MENOLUOKKA_SELITE = config.getint('google', 'COL_IDX_MENOLUOKKA_SELITE')
+        COL_IDX_MOMENTTI = config.getint('google', 'COL_IDX_MOMENTTI')
+        COL_IDX_MOMENTTI_SELITE = config.getint('google', 'COL_IDX_MOMENTTI_SELITE')    
+        COL_IDX_HALLITUS = config.getint('google', 'COL_IDX_HALLITUS')
+        COL_IDX_LIB = config.getint('google', 'COL_IDX_LIB')
+        COL_IDX_PERUSTELU = config.getint('google', 'COL_IDX_PERUSTELU')
+        COL_IDX_OSOITE = config.getint('google', 'COL_IDX_OSOITE')
+        COL_IDX_LINKKI = config.getint('google', 'COL_IDX_LINKKI')
+        COL_IDX_ERO = config.getint('google', 'COL_IDX_ERO')
+        COL_IDX_ERO_PERCENT = config.getint('google', 'COL_IDX_ERO_PERCENT')
+    except (configparser.NoOptionError, configparser.NoSectionError) as e:
+        print("Mandatory config key missing, please review %s. %r" % (path, e))
+        sys.exit(1)
+
+    # Data source
+    # sheets: SHEET_NAME and SHEET_EXTRAS over Sheets API
+    # csv: local CSV exports of the same tabs, see CsvFileDataSource
+    DATA_SOURCE = config.get('data', 'SOURCE', fallback='sheets')
+    CSV_FILE = config.get('data', 'CSV_FILE', fallback=None)
+    CSV_EXTRAS = config.get('data', 'CSV_EXTRAS', fallback=None)
+    CSV_ENCODING = config.get('data', 'CSV_ENCODING', fallback='auto')
+    # synthetic: generated budget of SYNTHETIC_ROWS rows, structure from budget tree and TAE files, see SyntheticDataSource
+    SYNTHETIC_TREE = config.get('data', 'SYNTHETIC_TREE', fallback='data/Budjettipuu 2024.txt')
+    SYNTHETIC_TAE = config.get('data', 'SYNTHETIC_TAE', fallback='data/yhdistelmä budjetti TAE 2024.csv')
+    SYNTHETIC_ROWS = config.getint('data', 'SYNTHETIC_ROWS', fallback=0)
+    SYNTHETIC_SEED = config.getint('data', 'SYNTHETIC_SEED', fallback=0)
+    # Compare totals of rows with sums of their subrows, see rollup_totals()
+    CHECK_TOTALS = config.getboolean('data', 'CHECK_TOTALS', fallback=False)
+    # Add missing parent rows with totals of their subrows, instead of leaving subrows out
+    FILL_MISSING_PARENTS = config.getboolean('data', 'FILL_MISSING_PARENTS', fallback=False)
+
+    # Snapshot cache of parsed data, keyed by source and its revision
+    CACHE_ENABLED = config.getboolean('cache', 'ENABLED', fallback=True)
+    CACHE_DIRECTORY = config.get('cache', 'DIRECTORY', fallback='.cache')
+    CACHE_MAX_ENTRIES = config.getint('cache', 'MAX_ENTRIES', fallback=20)
+    CACHE_MAX_AGE_DAYS = config.getint('cache', 'MAX_AGE_DAYS', fallback=30)
+    # Also cache sorted tree in binary file mapped on load, see TreeCache
+    CACHE_TREE = config.getboolean('cache', 'TREE', fallback=True)
+
+    # Wordpress
+    # Note: To generate app_password, see wp-admin, users, edit user
+    # Checked when publishing, see get_publish_targets()
+    WORDPRESS_URL = config.get('wordpress', 'WORDPRESS_URL', fallback=None)
+    PAGE_ID = config.getint('wordpress', 'PAGE_ID', fallback=None)
+    # Hashes of last published content per page, used to skip updates with unchanged content
+    PUBLISH_MANIFEST = config.get('wordpress', 'PUBLISH_MANIFEST', fallback='.publish-manifest.json')
+    # REST API client settings, see WordPressClient
+    WORDPRESS_TIMEOUT = config.getfloat('wordpress', 'TIMEOUT', fallback=60)
+    WORDPRESS_RETRIES = config.getint('wordpress', 'RETRIES', fallback=4)
+    WORDPRESS_COMPRESS = config.getboolean('wordpress', 'COMPRESS_REQUESTS', fallback=False)
+    WORDPRESS_STREAM = config.getboolean('wordpress', 'STREAM_REQUESTS', fallback=True)
+    # Pages to publish to, one per line as "PAGE_ID" or "URL PAGE_ID". Defaults to PAGE_ID at WORDPRESS_URL
+    WORDPRESS_TARGETS = config.get('wordpress', 'TARGETS', fallback='')
+    PUBLISH_WORKERS = config.getint('wordpress', 'PUBLISH_WORKERS', fallback=4)
+    # Publish each paaluokka to its own child page, main page gets summaries and links to them
+    SHARDED = config.getboolean('wordpress', 'SHARDED', fallback=False)
+
+    # Level 2 tables as html, or as json data rendered in browser when section is opened
+    TABLES = config.get('html', 'TABLES', fallback='html')
+    # Level 2 tables with yattag, or with precompiled templates, see render_level_2()
+    RENDERER = config.get('html', 'RENDERER', fallback='yattag')
+    # Processes rendering paaluokka sections, 1 renders in this process, 0 uses all cores
+    RENDER_WORKERS = config.getint('html', 'RENDER_WORKERS', fallback=1)
+    # Budget to highlight changes against, e.g. last year's budget tree, see read_budget_nodes()
+    COMPARE_TO = config.get('html', 'COMPARE_TO', fallback='')
+
+    # Budgets of different years, filled with ingest command, see BudgetHistory
+    HISTORY_DATABASE = config.get('history', 'DATABASE', fallback='budjettihistoria.sqlite')
+    # Add toteutuma of this year from history database to level 2 tables, none if empty
+    TOTEUTUMA_YEAR = config.getint('history', 'TOTEUTUMA_YEAR', fallback=None)
+
+    # Benchmarks, see run_benchmarks()
+    BENCH_FIXTURE = config.get('benchmark', 'FIXTURE', fallback='benchmark/fixture.json')
+    BENCH_SCALES = config.get('benchmark', 'SCALES', fallback='1,10,100,1000')
+    BENCH_REPEAT = config.getint('benchmark', 'REPEAT', fallback=3)
+
+def load_wordpress_secrets():
+    """
+    Reads Wordpress authentication config from WORDPRESS_AUTHENTICATION_FILE on first use
+    """
+    global wpconfig
+    if wpconfig is None:
+        if not WORDPRESS_AUTHENTICATION_FILE:
+            print("Mandatory config key missing, please review %s. [secrets] WORDPRESS_AUTHENTICATION" % config_path)
+            sys.exit(1)
+        wpconfig = configparser.ConfigParser()
+        wpconfig.read(WORDPRESS_AUTHENTICATION_FILE)
+    return wpconfig
 
 # html generation
-from yattag import Doc
-from decimal import ConversionSyntax, Decimal, InvalidOperation
+from decimal import ConversionSyntax, Decimal, InvalidOperation, ROUND_HALF_UP
 from dataclasses import dataclass
-import locale # For currency formatting
-locale.setlocale(locale.LC_ALL, 'fi_FI.UTF-8')
 
-@dataclass
+def Doc(*args, **kwargs):
+    """
+    yattag Doc, yattag is imported on first use
+    """
+    from yattag import Doc
+    return Doc(*args, **kwargs)
+
+# Shared by rows without subrows, use add_subrow() to add
+_NO_SUBROWS = types.MappingProxyType({})
+
 class DataObject:
-    tulo: bool          # Tulo vai meno
-    syvyys: int         # 1, 2 vai 3 tason rivi
-    paaluokka: str      # Ensimmäinen nro
-    paaluokka_selite: str # Ensimmäinen selite
-    menoluokka: str       # Toinen nro
-    menoluokka_selite: str # Toinen selite
-    momentti: str      # Kolmas nro
-    momentti_selite: str # Kolman selite
-    osoite: str         # Ensimmainen nro.Toinen nro.Kolmas nro
-    libLisays: bool     # Jos rivi on Liberaalipuolueen lisäys
-    hallitus: Decimal   # Hallituksen esitys
-    lib: Decimal # Liberaalipuolueen esitys
-    ero: Decimal # Erotus, "Leikattavaa löytyy" -luku
-    eroPercent: float # Erotus, desimaaleja
-    perustelu: str      # Leikkauksen perustelu
-    linkki: str         # Budjettikirjan linkki
-    subrows: dict        # Sorttausta varten, alemman tason rivit
+    """
+    Budget row. Compact: fixed slots instead of instance dict, amounts as int cents, percent as int basis points,
+    repeating strings interned and subrows dict only for rows which have subrows.
+
+    Amounts are also available as Decimal euros with the original names, hallitus, lib and ero,
+    and percent as fraction eroPercent.
+    """
+    __slots__ = (
+        'tulo',             # Tulo vai meno
+        'syvyys',           # 1, 2 vai 3 tason rivi
+        'paaluokka',        # Ensimmäinen nro
+        'paaluokka_selite', # Ensimmäinen selite
+        'menoluokka',       # Toinen nro
+        'menoluokka_selite', # Toinen selite
+        'momentti',         # Kolmas nro
+        'momentti_selite',  # Kolman selite
+        'osoite',           # Ensimmainen nro.Toinen nro.Kolmas nro
+        'libLisays',        # Jos rivi on Liberaalipuolueen lisäys
+        'hallitus_cents',   # Hallituksen esitys
+        'lib_cents',        # Liberaalipuolueen esitys
+        'ero_cents',        # Erotus, "Leikattavaa löytyy" -luku
+        'ero_percent_bp',   # Erotus, peruspisteinä (0,01 %)
+        'perustelu',        # Leikkauksen perustelu
+        'linkki',           # Budjettikirjan linkki
+        'muutos',           # (laji, kuvaus) jos rivi on muuttunut verrattavasta budjetista, ks. mark_budget_changes()
+        'toteutuma_cents',  # Vertailuvuoden toteutuma historiatietokannasta, ks. add_toteutuma()
+        '_subrows',         # Sorttausta varten, alemman tason rivit
+    )
+
+    def __init__(self, tulo, syvyys, paaluokka, paaluokka_selite, menoluokka, menoluokka_selite, momentti,
+                 momentti_selite, osoite, libLisays, hallitus_cents, lib_cents, ero_cents, ero_percent_bp, perustelu, linkki,
+                 subrows=None):
+        self.tulo = tulo
+        self.syvyys = syvyys
+        self.paaluokka = sys.intern(paaluokka)
+        self.paaluokka_selite = sys.intern(paaluokka_selite)
+        self.menoluokka = sys.intern(menoluokka)
+        self.menoluokka_selite = sys.intern(menoluokka_selite)
+        self.momentti = sys.intern(momentti)
+        self.momentti_selite = sys.intern(momentti_selite)
+        self.osoite = sys.intern(osoite)
+        self.libLisays = libLisays
+        self.hallitus_cents = hallitus_cents
+        self.lib_cents = lib_cents
+        self.ero_cents = ero_cents
+        self.ero_percent_bp = ero_percent_bp
+        self.perustelu = perustelu
+        self.linkki = sys.intern(linkki)
+        self.muutos = None
+        self.toteutuma_cents = None
+        self._subrows = subrows or None
+
+    @property
+    def hallitus(self) -> Decimal:
+        return Decimal(self.hallitus_cents) / 100
+
+    @property
+    def lib(self) -> Decimal:
+        return Decimal(self.lib_cents) / 100
+
+    @property
+    def ero(self) -> Decimal:
+        return Decimal(self.ero_cents) / 100
+
+    @property
+    def eroPercent(self) -> float:
+        return self.ero_percent_bp / 10000
+
+    @property
+    def subrows(self):
+        return self._subrows if self._subrows is not None else _NO_SUBROWS
+
+    def add_subrow(self, key, row) -> None:
+        if self._subrows is None:
+            self._subrows = {}
+        self._subrows[key] = row
+
+    def sort_subrows(self, key) -> None:
+        """
+        Reorders subrows by key(subrow key)
+        """
+        if self._subrows is not None:
+            self._subrows = dict(sorted(self._subrows.items(), key=lambda item: key(item[0])))
+
+    def __repr__(self) -> str:
+        return 'DataObject(%s)' % ', '.join('%s=%r' % (name, getattr(self, name)) for name in self.__slots__
+                                            if name != '_subrows') + ', subrows=%r)' % (dict(self.subrows),)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DataObject):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__ if name != '_subrows') \
+            and dict(self.subrows) == dict(other.subrows)
+
+    __hash__ = None
+
+def to_cents(amount) -> int:
+    """
+    Euro amount, Decimal or number, to int cents
+    """
+    if isinstance(amount, int):
+        return amount * 100
+    return int((Decimal(amount) * 100).to_integral_value(ROUND_HALF_UP))
 
 @dataclass
 class SummaryDataObject:
@@ -131,59 +314,627 @@ class SummaryDataObject:
     leikkausten_osuus: Decimal
 
 
-def main():
-    data = None
+# Profiler of current run, set by --profile, see profile_stage()
+_profiler = None
+
+class Profiler:
+    """
+    Collects wall and cpu time, tracemalloc peak and counters per stage.
+
+    Stages nest and are identified by their path, e.g. ('render', 'generate_html', 'generate_summary').
+    Stages entered in worker threads are placed under the current stage of the main thread.
+    Repeated stages with the same path are summed. Memory peaks are tracked for main thread only.
+    If cprofile is set, each top level stage is also profiled with cProfile.
+    """
+    def __init__(self, memory=True, cprofile=False):
+        import tracemalloc
+        self.memory = memory
+        self.cprofile = cprofile
+        self.stages = {}
+        self.profiles = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.main_stack = []
+        self.local.stack = self.main_stack
+        self.started = time.perf_counter()
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stack(self) -> list:
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def current_path(self) -> tuple:
+        stack = self.stack()
+        if stack:
+            return stack[-1]['path']
+        # Worker thread outside own stages, use main thread stage
+        main_stack = self.main_stack
+        return main_stack[-1]['path'] if main_stack else ()
+
+    def stats(self, path) -> dict:
+        if path not in self.stages:
+            self.stages[path] = {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'self': 0.0, 'peak_memory': 0, 'counters': defaultdict(int)}
+        return self.stages[path]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        import cProfile, pstats, tracemalloc
+        stack = self.stack()
+        main = stack is self.main_stack
+        path = self.current_path() + (name,)
+        frame = {'path': path, 'children': 0.0, 'peak': 0}
+        profile = None
+        if main and self.memory:
+            if stack:
+                # Keep parent peak so far, child measures its own
+                stack[-1]['peak'] = max(stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        if main and not stack and self.cprofile:
+            profile = cProfile.Profile()
+            profile.enable()
+        stack.append(frame)
+        start = time.perf_counter()
+        start_cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.thread_time() - start_cpu
+            stack.pop()
+            if profile is not None:
+                profile.disable()
+                with self.lock:
+                    if name in self.profiles:
+                        self.profiles[name].add(profile)
+                    else:
+                        self.profiles[name] = pstats.Stats(profile)
+            if main and self.memory:
+                frame['peak'] = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], frame['peak'])
+            with self.lock:
+                parent = stack[-1] if stack else self.main_stack[-1] if self.main_stack and not main else None
+                if parent is not None:
+                    parent['children'] += wall
+                stats = self.stats(path)
+                stats['calls'] += 1
+                stats['wall'] += wall
+                stats['cpu'] += cpu
+                # Stages run in parallel threads may overlap their parent more than once
+                stats['self'] += max(0.0, wall - frame['children'])
+                stats['peak_memory'] = max(stats['peak_memory'], frame['peak'])
+
+    def count(self, name, amount=1) -> None:
+        path = self.current_path()
+        with self.lock:
+            self.stats(path)['counters'][name] += amount
+
+    def report(self, path) -> None:
+        """
+        Writes JSON report to path, stage self times as folded stacks for flamegraph tools to path with .folded
+        suffix, and cProfile stats of top level stages to path with .<stage>.pstats suffix.
+        """
+        base = os.path.splitext(path)[0]
+        with self.lock:
+            stages = [{
+                'path': '/'.join(stage_path),
+                'calls': stats['calls'],
+                'wall_seconds': stats['wall'],
+                'cpu_seconds': stats['cpu'],
+                'self_seconds': stats['self'],
+                'peak_memory_bytes': stats['peak_memory'] if self.memory else None,
+                'counters': dict(stats['counters']),
+            } for stage_path, stats in self.stages.items()]
+            profiles = dict(self.profiles)
+        report = {
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'argv': sys.argv,
+            'wall_seconds': time.perf_counter() - self.started,
+            'stages': stages,
+            'pstats': {},
+        }
+        for name, stats in profiles.items():
+            pstats_file = '%s.%s.pstats' % (base, name)
+            stats.dump_stats(pstats_file)
+            report['pstats'][name] = pstats_file
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+        # Folded stacks, "a;b;c microseconds" per line, e.g. for flamegraph.pl and speedscope
+        with open(base + '.folded', 'w', encoding='utf-8') as file:
+            for stage in stages:
+                if stage['path'] and stage['self_seconds'] > 0:
+                    file.write('%s %d\n' % (stage['path'].replace('/', ';'), round(stage['self_seconds'] * 1000000)))
+        print("Wrote profile report to %s" % path)
+        for stage in stages:
+            if stage['path']:
+                print("  %-50s %8.3fs %s" % (stage['path'], stage['wall_seconds'],
+                                              ' '.join('%s=%d' % counter for counter in stage['counters'].items())))
+
+    def close(self) -> None:
+        import tracemalloc
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+def profile_stage(name):
+    """
+    Context manager timing a stage when profiling, does nothing otherwise
+    """
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.stage(name)
+
+def profile_count(name, amount=1) -> None:
+    """
+    Adds to counter of current stage when profiling
+    """
+    if _profiler is not None:
+        _profiler.count(name, amount)
+
+def profiled(function):
+    """
+    Decorator timing each call of function as a stage named by the function when profiling
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if _profiler is None:
+            return function(*args, **kwargs)
+        with _profiler.stage(function.__name__):
+            return function(*args, **kwargs)
+    return wrapper
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Publishes Varjobudjetti from Google Sheets to Wordpress')
+    parser.add_argument('--config', metavar='FILE', default=CONFIG_INI,
+                        help='Config file, default %(default)s')
+    parser.add_argument('--source', choices=['sheets', 'csv', 'synthetic'], default=None,
+                        help='Data source, defaults to [data] SOURCE in %s' % CONFIG_INI)
+    parser.add_argument('--csv', metavar='FILE', default=None,
+                        help='CSV file with data rows, implies --source csv')
+    parser.add_argument('--csv-extras', metavar='FILE', default=None,
+                        help='CSV file with extras key-value rows')
+    parser.add_argument('--synthetic-rows', metavar='N', type=int, default=None,
+                        help='Size of generated budget, implies --source synthetic')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed of generated budget, see [data] SYNTHETIC_SEED')
+    parser.add_argument('--fill-missing-parents', action='store_true', default=None,
+                        help='Add rows missing from sheet with totals of their subrows, see [data] FILL_MISSING_PARENTS')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Fetch data from source even if snapshot cache has current revision')
+    parser.add_argument('--force', action='store_true',
+                        help='Update Wordpress page even if content is unchanged')
+    parser.add_argument('--sharded', action='store_true', default=None,
+                        help='Publish each paaluokka to its own child page, see [wordpress] SHARDED')
+    parser.add_argument('--tables', choices=['html', 'json'], default=None,
+                        help='Level 2 tables as html, or as json rendered in browser, see [html] TABLES')
+    parser.add_argument('--renderer', choices=['yattag', 'template'], default=None,
+                        help='Render level 2 tables with yattag or precompiled templates, see [html] RENDERER')
+    parser.add_argument('--render-workers', metavar='N', type=int, default=None,
+                        help='Render paaluokka sections in N processes, 0 for all cores, see [html] RENDER_WORKERS')
+    parser.add_argument('--compare-to', metavar='FILE', default=None,
+                        help='Highlight rows changed since budget in FILE, see [html] COMPARE_TO')
+    parser.add_argument('--toteutuma-year', metavar='YEAR', type=int, default=None,
+                        help='Add toteutuma of YEAR from history database to level 2 tables, see [history] TOTEUTUMA_YEAR')
+    parser.add_argument('--profile', metavar='FILE', default=None,
+                        help='Write stage timings, memory peaks and counters to JSON file, and flamegraph stacks to .folded file')
+    parser.add_argument('--cprofile', action='store_true',
+                        help='With --profile, write cProfile stats of each top level stage to .pstats files')
+
+    # Publishing is the default command, options above apply to it
+    subparsers = parser.add_subparsers(dest='command', metavar='COMMAND')
+    subparsers.add_parser('publish', help='Fetch data, generate html and publish it (default)')
+    bench = subparsers.add_parser('bench', help='Benchmark parse, sort, render and publish stages offline')
+    bench.add_argument('--fixture', default=None,
+                       help='Recorded sheet data to benchmark with, see [benchmark] FIXTURE')
+    bench.add_argument('--record', action='store_true',
+                       help='Record fixture from data source given by --source/--csv options instead of benchmarking')
+    bench.add_argument('--synthetic', action='store_true',
+                       help='Benchmark with generated budgets instead of scaled fixture, sizes are scales of budget tree size')
+    bench.add_argument('--scales', default=None,
+                       help='Comma separated multipliers of fixture size, see [benchmark] SCALES')
+    bench.add_argument('--repeat', type=int, default=None,
+                       help='Runs per scale, stage timings are reported as min and median, see [benchmark] REPEAT')
+    bench.add_argument('--output', metavar='FILE', default=None,
+                       help='Results JSON file, defaults to benchmark/results-<commit>.json')
+    bench.add_argument('--compare', metavar='FILE', default=None,
+                       help='Earlier results JSON file, exits with error if a stage got slower than --threshold')
+    bench.add_argument('--threshold', type=float, default=0.2,
+                       help='Allowed slowdown of stage median when comparing, 0.2 is 20%%')
+    synthesize = subparsers.add_parser('synthesize', help='Write generated budget as CSV files for csv data source')
+    synthesize.add_argument('--rows', type=int, default=None,
+                            help='Approximate number of data rows, defaults to size of budget tree')
+    synthesize.add_argument('--output', metavar='FILE', default='synthetic.csv',
+                            help='Data rows CSV file, default %(default)s')
+    synthesize.add_argument('--extras-output', metavar='FILE', default='synthetic-extras.csv',
+                            help='Extras CSV file, default %(default)s')
+    normalize = subparsers.add_parser('normalize',
+                                      help='Add Momenttitaso and Budjettipuu columns and level 1 and 2 sum rows to budjetti.vm.fi CSV, like script.js')
+    normalize.add_argument('input', metavar='FILE', help='budjetti.vm.fi opendata CSV file')
+    normalize.add_argument('--output', metavar='FILE', default='normalized.csv',
+                           help='Normalized CSV file, default %(default)s')
+    normalize.add_argument('--encoding', choices=['auto', 'utf-8', 'iso-8859-10'], default='auto',
+                           help='Input file encoding, default %(default)s')
+    diff = subparsers.add_parser('diff', help='List added, removed, renumbered and changed rows between two budgets')
+    diff.add_argument('old', metavar='OLD',
+                      help='Budget tree .txt, budjetti.vm.fi TAE CSV, CSV in sheet layout or year in history database')
+    diff.add_argument('new', metavar='NEW', nargs='?', default=None,
+                      help='Budget file like OLD, defaults to data from configured data source')
+    ingest = subparsers.add_parser('ingest', help='Load budgets to history database, see [history] DATABASE')
+    ingest.add_argument('files', metavar='FILE', nargs='*',
+                        help='Budget tree .txt, budjetti.vm.fi TAE CSV or CSV in sheet layout, defaults to data from configured data source')
+    ingest.add_argument('--year', type=int, default=None,
+                        help='Budget year, defaults to year in file name or budget tree title')
+    ingest.add_argument('--database', metavar='FILE', default=None,
+                        help='History database, see [history] DATABASE')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global _profiler, RENDERER, RENDER_WORKERS, TOTEUTUMA_YEAR
+    args = parse_args(argv)
+    load_config(args.config)
+    if args.renderer:
+        RENDERER = args.renderer
+    if args.render_workers is not None:
+        RENDER_WORKERS = args.render_workers
+    if args.toteutuma_year is not None:
+        TOTEUTUMA_YEAR = args.toteutuma_year
+    if args.profile:
+        _profiler = Profiler(cprofile=args.cprofile)
+    try:
+        if args.command == 'bench':
+            run_benchmarks(args)
+        elif args.command == 'synthesize':
+            source = SyntheticDataSource(args.rows or 0, SYNTHETIC_SEED if args.seed is None else args.seed)
+            write_synthetic_csv(source, args.output, args.extras_output)
+        elif args.command == 'normalize':
+            normalize_budget_csv(args.input, args.output, args.encoding)
+        elif args.command == 'diff':
+            run_diff(args)
+        elif args.command == 'ingest':
+            run_ingest(args)
+        else:
+            run_publish(args)
+    finally:
+        # Also when exiting due errors, report tells how far the run got
+        if _profiler is not None:
+            _profiler.report(args.profile)
+            _profiler.close()
+            _profiler = None
+
+def run_publish(args):
+    dataDict = None
     summary = None
+    fill_missing = FILL_MISSING_PARENTS if args.fill_missing_parents is None else args.fill_missing_parents
     try:
-        data, summary = get_data()        
-    except HttpError as err:
+        with profile_stage('data'):
+            dataDict, summary = get_tree(get_data_source_from_args(args), refresh=args.refresh, fill_missing=fill_missing)
+    except DataSourceError as err:
         print(err)
 
-    if data is None:
+    if dataDict is None:
         print('No data found')
         sys.exit(10)
     if summary is None:
         print('No summary found')
         sys.exit(10)
-    
-    print("Got data, %d rows" % (len(data)))    
-    dataDict = sort_data(data)
+
+    if CHECK_TOTALS or fill_missing:
+        with profile_stage('rollup'):
+            mismatches = rollup_totals(dataDict)
+        if CHECK_TOTALS:
+            print_total_mismatches(mismatches)
+
+    compare_to = args.compare_to or COMPARE_TO
+    if compare_to:
+        with profile_stage('diff'):
+            diff = diff_budgets(read_budget_nodes(compare_to), tree_budget_nodes(dataDict))
+            mark_budget_changes(dataDict, diff)
+        print("Compared to %s: %s" % (compare_to, diff.summary()))
+
+    if TOTEUTUMA_YEAR:
+        with profile_stage('history'):
+            with open_budget_history() as history:
+                found = add_toteutuma(dataDict, history.amounts(TOTEUTUMA_YEAR, 'toteutuma_cents'))
+        print("Toteutuma %d found for %d rows" % (TOTEUTUMA_YEAR, found))
 
     #print_sorted_data(dataDict)
 
-    html = generate_html(dataDict, summary)
-    if html is None:
-        print("Failed to generate html")
-        sys.exit(20)
-    print("Generated HTML")
-    html_file = 'output.html'
-    with open(html_file, 'w') as file:
-        file.write(html)
+    sharded = SHARDED if args.sharded is None else args.sharded
+    lazy_tables = (args.tables or TABLES) == 'json'
+    if sharded:
+        with profile_stage('render'):
+            shards = generate_shards(dataDict, lazy_tables=lazy_tables)
+        print("Generated HTML for %d paaluokka pages" % len(shards))
+        with profile_stage('write'):
+            for slug, (row, shard_html) in shards.items():
+                html_file = 'output-%s.html' % slug
+                with open(html_file, 'w') as file:
+                    file.write(shard_html)
+                profile_count('bytes', len(shard_html.encode('utf-8')))
+        print("Wrote paaluokka pages to output-*.html")
+
+        with profile_stage('publish'):
+            statuses = publish_to_targets(get_publish_targets(),
+                lambda client, page_id: publish_sharded(client, page_id, dataDict, summary, shards, force=args.force, lazy_tables=lazy_tables))
+    else:
+        html_file = 'output.html'
+        # Html is written to file as it is generated, and uploaded from there once complete, see RenderedPage
+        with profile_stage('render'):
+            try:
+                page = write_html(iter_html(dataDict, summary, lazy_tables=lazy_tables), html_file)
+            except OSError as e:
+                print("Failed to generate html due %r" % e)
+                sys.exit(20)
+        profile_count('bytes', page.size)
+        print("Generated HTML")
         print("Wrote to %s" % html_file)
 
-    #sys.exit(0)    
+        #sys.exit(0)    
 
-    response = update_wordpress_page(PAGE_ID, html)
-    if response is None:
+        with profile_stage('publish'):
+            statuses = publish_to_targets(get_publish_targets(),
+                lambda client, page_id: publish_page(page_id, page, force=args.force, client=client))
+
+    for (url, page_id), status in statuses.items():
+        print("%s page %d: %s" % (url, page_id, status or 'FAILED'))
+    if None in statuses.values():
         print("Failed to update wordpress page")
         sys.exit(30)
-    else:
-        print("Page updated")
 
     print("Job's done")
 
 
 
-def get_data():
+def get_tree(source=None, refresh=False, fill_missing=False):
+    """
+    Acquires data like get_data() and sorts it to BudgetTree, returns (tree, summary).
+
+    Sorted tree is stored to tree cache and mapped from there while source revision stays the same,
+    without parsing or sorting, see MappedBudgetTree. refresh skips the cache lookup, fresh tree is still stored.
+    """
+    if source is None:
+        source = get_data_source()
+
+    cache = None
+    revision = None
+    key = '%s\nfill_missing=%s' % (source.cache_key(), fill_missing)
+    if CACHE_ENABLED and CACHE_TREE:
+        cache = TreeCache(CACHE_DIRECTORY, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS)
+        with profile_stage('revision'):
+            revision = source.revision()
+        if revision is not None and not refresh:
+            with profile_stage('tree_load'):
+                cached = cache.load(key, revision)
+            if cached is not None:
+                print("Source unchanged (revision %s), using cached tree" % revision)
+                profile_count('tree_hits')
+                return cached
+
+    data, summary = get_data(source, refresh=refresh, revision=revision)
+    print("Got data, %d rows" % (len(data)))
+    with profile_stage('sort'):
+        tree = sort_data(data, fill_missing=fill_missing)
+
+    if cache is not None and revision is not None:
+        with profile_stage('tree_store'):
+            cache.store(key, revision, tree, summary)
+    return (tree, summary)
+
+def get_data(source=None, refresh=False, revision=None):
     """
-    Acquires Varjobudjetti data over Sheets API.
+    Acquires Varjobudjetti data from a data source, by default the one configured in [data] SOURCE.
+
+    Parsed data is stored to snapshot cache and returned from there while source revision stays the same.
+    refresh skips the cache lookup, fresh data is still stored. revision is source revision if already known.
+    """
+    if source is None:
+        source = get_data_source()
+
+    cache = None
+    if CACHE_ENABLED:
+        cache = SnapshotCache(CACHE_DIRECTORY, CACHE_MAX_ENTRIES, CACHE_MAX_AGE_DAYS)
+        if revision is None:
+            with profile_stage('revision'):
+                revision = source.revision()
+        if revision is None:
+            print("Source revision not available, not using snapshot cache")
+        elif not refresh:
+            with profile_stage('snapshot_load'):
+                snapshot = cache.load(source.cache_key(), revision)
+            if snapshot is not None:
+                print("Source unchanged (revision %s), using snapshot" % revision)
+                profile_count('snapshot_hits')
+                return snapshot
+
+    # Sheets are fetched here, file sources are read while parsing
+    with profile_stage('fetch'):
+        values = source.values()
+    with profile_stage('parse'):
+        data = list(iter_data_objects(values))
+    if not data:
+        print('No data found.')
+        sys.exit(1)
+
+    with profile_stage('parse_summary'):
+        summary = parse_summary(source.extras())
+
+    if cache is not None and revision is not None:
+        with profile_stage('snapshot_store'):
+            cache.store(source.cache_key(), revision, (data, summary))
+
+    return (data, summary)
+
+class SnapshotCache:
+    """
+    On-disk cache of parsed (data, summary) tuples.
+
+    Entries are keyed by source key and revision. Least recently used entries are evicted
+    when there are more than max_entries, and entries not used in max_age_days are removed.
+    """
+    # Names of entry files
+    prefix = 'snapshot-'
+    suffix = '.pickle'
+
+    def __init__(self, directory, max_entries=20, max_age_days=30):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+
+    def path(self, key, revision) -> str:
+        digest = hashlib.sha256(('%d\n%s\n%s' % (SNAPSHOT_FORMAT, key, revision)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, self.prefix + digest[:32] + self.suffix)
+
+    def load(self, key, revision):
+        path = self.path(key, revision)
+        try:
+            with open(path, 'rb') as file:
+                snapshot = pickle.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Ignoring unreadable snapshot %s due %r" % (path, e))
+            return None
+        if snapshot.get('format') != SNAPSHOT_FORMAT or snapshot.get('key') != key or snapshot.get('revision') != revision:
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return snapshot['value']
+
+    def store(self, key, revision, value) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key, revision)
+        snapshot = {
+            'format': SNAPSHOT_FORMAT,
+            'key': key,
+            'revision': revision,
+            'created': time.time(),
+            'value': value
+        }
+        # Write to temp file first, so that a failed run does not leave broken snapshot behind
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            pickle.dump(snapshot, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith(self.prefix) and name.endswith(self.suffix):
+                path = os.path.join(self.directory, name)
+                entries.append((os.path.getmtime(path), path))
+        # Newest first
+        entries.sort(reverse=True)
+        oldest_allowed = time.time() - self.max_age_days * 24 * 60 * 60
+        for index, (mtime, path) in enumerate(entries):
+            if index >= self.max_entries or mtime < oldest_allowed:
+                os.remove(path)
+
+class TreeCache(SnapshotCache):
+    """
+    On-disk cache of sorted BudgetTree and summary, in the binary format of write_tree_cache().
+    Entries are loaded as MappedBudgetTree and evicted like snapshots.
+    """
+    prefix = 'tree-'
+    suffix = '.bin'
+
+    def load(self, key, revision):
+        path = self.path(key, revision)
+        try:
+            tree = MappedBudgetTree(path)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Ignoring unreadable tree cache %s due %r" % (path, e))
+            return None
+        if tree.meta.get('key') != key or tree.meta.get('revision') != revision:
+            return None
+        # Mark as recently used
+        os.utime(path)
+        return (tree, tree.meta['summary'])
+
+    def store(self, key, revision, tree, summary) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key, revision)
+        meta = {
+            'key': key,
+            'revision': revision,
+            'created': time.time(),
+            'summary': summary,
+        }
+        # Write to temp file first, so that a failed run does not leave broken file behind.
+        # Replacing the file keeps the old one readable for processes which have it mapped.
+        temp_path = path + '.tmp'
+        write_tree_cache(tree, temp_path, meta)
+        os.replace(temp_path, path)
+        self.evict()
+
+def get_data_source_from_args(args):
+    """
+    Data source selected by --source, --csv, --csv-extras, --synthetic-rows and --seed options
+    """
+    source_name = args.source
+    if args.csv:
+        source_name = 'csv'
+    elif args.synthetic_rows is not None:
+        source_name = 'synthetic'
+    return get_data_source(source_name, args.csv, args.csv_extras, args.synthetic_rows, args.seed)
+
+def get_data_source(source_name=None, csv_file=None, csv_extras=None, synthetic_rows=None, seed=None):
+    """
+    Returns data source by name, 'sheets', 'csv' or 'synthetic'
+    """
+    if source_name is None:
+        source_name = DATA_SOURCE
+    if source_name == 'sheets':
+        return SheetsDataSource(SPREADSHEET_ID, SHEET_NAME, SHEET_EXTRAS)
+    elif source_name == 'csv':
+        csv_file = csv_file or CSV_FILE
+        csv_extras = csv_extras or CSV_EXTRAS
+        if not csv_file or not csv_extras:
+            print("CSV data source requires both CSV_FILE and CSV_EXTRAS, please review %s" % config_path)
+            sys.exit(1)
+        return CsvFileDataSource(csv_file, csv_extras, encoding=CSV_ENCODING)
+    elif source_name == 'synthetic':
+        if synthetic_rows is None:
+            synthetic_rows = SYNTHETIC_ROWS
+        if seed is None:
+            seed = SYNTHETIC_SEED
+        return SyntheticDataSource(synthetic_rows, seed)
+    else:
+        print("Unknown data source %r, expected 'sheets', 'csv' or 'synthetic'" % source_name)
+        sys.exit(1)
+
+def column_layout() -> str:
     """
+    COL_IDX_* configuration as string, parsed data depends on it
+    """
+    return ','.join('%s=%d' % (name, value) for name, value in sorted(globals().items()) if name.startswith('COL_IDX_'))
+
+def get_google_credentials():
+    """
+    Loads Google credentials from GOOGLE_TOKEN_FILE, runs the authorization flow if needed.
+    """
+    # Google sheets
+    # How to run, see: https://developers.google.com/sheets/api/quickstart/python
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import InstalledAppFlow
+
+    if not GOOGLE_AUTHENTICATION_FILE or not GOOGLE_TOKEN_FILE:
+        print("Mandatory config key missing, please review %s. [secrets] GOOGLE_AUTHENTICATION and GOOGLE_TOKEN" % config_path)
+        sys.exit(1)
     creds = None
     # The file GOOGLE_TOKEN_FILE stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
     if os.path.exists(GOOGLE_TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(GOOGLE_TOKEN_FILE, SCOPES)
+        creds = Credentials.from_authorized_user_file(GOOGLE_TOKEN_FILE)
+        if not creds.has_scopes(SCOPES):
+            print("Token in %s is missing some of the required scopes, authorizing again" % GOOGLE_TOKEN_FILE)
+            creds = None
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -194,188 +945,696 @@ def get_data():
         # Save the credentials for the next run
         with open(GOOGLE_TOKEN_FILE, 'w') as token:
             token.write(creds.to_json())
+    return creds
 
-    values = False
-    extras = False
-    try:
-        service = build('sheets', 'v4', credentials=creds)
-
-        # Call the Sheets API
-        sheet = service.spreadsheets()
-        # TODO?: use valueRenderOption='UNFORMATTED_VALUE', but it would require rewriting data parsing
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                    range=SHEET_NAME).execute()
-        values = result.get('values', [])
-        
-        result = sheet.values().get(spreadsheetId=SPREADSHEET_ID,
-                                    range=SHEET_EXTRAS, 
-                                    valueRenderOption='UNFORMATTED_VALUE').execute()
-        extras = result.get('values', [])
-    except HttpError as err:
-        raise err
-    
-    data = []
-    if not values:
-        print('No data found.')
-        sys.exit(1)
+class DataSourceError(Exception):
+    """
+    Data source failed to return data, e.g. Sheets API HttpError
+    """
+
+class SheetsDataSource:
+    """
+    Reads data rows and extras over Sheets API.
+
+    Rows are lists of cell values, as returned by the API.
+    """
+    def __init__(self, spreadsheet_id, sheet_name, sheet_extras):
+        self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
+        self.sheet_extras = sheet_extras
+        self._creds = None
+        self._values = None
+        self._extras = None
+
+    def credentials(self):
+        if self._creds is None:
+            with profile_stage('auth'):
+                self._creds = get_google_credentials()
+        return self._creds
+
+    def cache_key(self) -> str:
+        return 'sheets:%s:%s:%s:%s' % (self.spreadsheet_id, self.sheet_name, self.sheet_extras, column_layout())
+
+    def revision(self):
+        """
+        Spreadsheet version from Drive metadata, increases on every change to the spreadsheet.
+        Returns None if not available.
+        """
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import HttpError
+        try:
+            service = build('drive', 'v3', credentials=self.credentials())
+            metadata = service.files().get(fileId=self.spreadsheet_id, fields='version').execute()
+            return metadata.get('version')
+        except HttpError as err:
+            print("Failed to get spreadsheet version: %s" % err)
+            return None
+
+    def fetch(self):
+        from googleapiclient.discovery import build
+        from googleapiclient.errors import HttpError
+        creds = self.credentials()
+        try:
+            service = build('sheets', 'v4', credentials=creds)
+
+            # Call the Sheets API, both ranges in one request
+            sheet = service.spreadsheets()
+            result = sheet.values().batchGet(spreadsheetId=self.spreadsheet_id,
+                                             ranges=[self.sheet_name, self.sheet_extras],
+                                             valueRenderOption='UNFORMATTED_VALUE').execute()
+            valueRanges = result.get('valueRanges', [])
+            if len(valueRanges) != 2:
+                print("Expected 2 value ranges from batchGet, got %d" % len(valueRanges))
+                sys.exit(1)
+            self._values = valueRanges[0].get('values', [])
+            self._extras = valueRanges[1].get('values', [])
+        except HttpError as err:
+            raise DataSourceError(err) from err
+
+    def values(self):
+        if self._values is None:
+            self.fetch()
+        return self._values
+
+    def extras(self):
+        if self._extras is None:
+            self.fetch()
+        return self._extras
+
+class CsvFileDataSource:
+    """
+    Reads data rows and extras from local CSV files, e.g. exports of SHEET_NAME and SHEET_EXTRAS tabs.
+
+    Data file uses the same column layout as the sheet (COL_IDX_* values). Extras file has key and value columns.
+    Separator (; , or tab) and encoding (UTF-8 or ISO-8859-10) are detected from the file unless given.
+    Rows are streamed one at a time, file is never read into memory as whole.
+    """
+    def __init__(self, path, extras_path, encoding='auto', delimiter=None):
+        self.path = path
+        self.extras_path = extras_path
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+    def cache_key(self) -> str:
+        return 'csv:%s:%s:%s' % (os.path.abspath(self.path), os.path.abspath(self.extras_path), column_layout())
+
+    def revision(self) -> str:
+        """
+        Size and modification time of both files
+        """
+        data_stat = os.stat(self.path)
+        extras_stat = os.stat(self.extras_path)
+        return '%d-%d-%d-%d' % (data_stat.st_size, data_stat.st_mtime_ns, extras_stat.st_size, extras_stat.st_mtime_ns)
+
+    def values(self):
+        yield from read_csv_rows(self.path, self.encoding, self.delimiter)
+
+    def extras(self):
+        # Extras are read with UNFORMATTED_VALUE from sheet, so convert numbers to match
+        return [[parse_unformatted_cell(cell) for cell in row]
+                for row in read_csv_rows(self.extras_path, self.encoding, self.delimiter)]
+
+class FixtureDataSource:
+    """
+    Reads data rows and extras recorded with record_fixture(), for running offline
+    """
+    def __init__(self, path):
+        self.path = path
+        self._fixture = None
+
+    def cache_key(self) -> str:
+        return 'fixture:%s:%s' % (os.path.abspath(self.path), column_layout())
+
+    def revision(self) -> str:
+        stat = os.stat(self.path)
+        return '%d-%d' % (stat.st_size, stat.st_mtime_ns)
+
+    def load(self) -> dict:
+        if self._fixture is None:
+            with open(self.path, 'r', encoding='utf-8') as file:
+                self._fixture = json.load(file)
+        return self._fixture
+
+    def values(self):
+        return self.load()['values']
+
+    def extras(self):
+        return self.load()['extras']
+
+def record_fixture(source, path) -> None:
+    """
+    Stores data rows and extras of source to JSON file, as they are before parsing
+    """
+    fixture = {
+        'recorded': datetime.datetime.now().isoformat(timespec='seconds'),
+        'source': source.cache_key(),
+        'values': list(source.values()),
+        'extras': source.extras()
+    }
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(fixture, file, ensure_ascii=False)
+    print("Recorded %d rows and %d extras to %s" % (len(fixture['values']), len(fixture['extras']), path))
+
+class SyntheticDataSource:
+    """
+    Generates budget with sheet layout for load testing. Structure comes from budget tree file (one osoite per line,
+    e.g. data/Budjettipuu 2024.txt, lib additions included) and names and hallitus amounts from budjetti.vm.fi TAE CSV.
+
+    Tree is repeated with paaluokka numbers offset by 100 per copy until there are at least rows rows,
+    0 means one copy. Amounts, perustelu texts and links are random but reproducible with seed.
+    Totals of upper level rows are sums of their subrows, and extras are calculated from rows.
+    """
+    def __init__(self, rows, seed=0, tree_path=None, tae_path=None):
+        self.rows = rows
+        self.seed = seed
+        self.tree_path = tree_path or SYNTHETIC_TREE
+        self.tae_path = tae_path or SYNTHETIC_TAE
+        self._values = None
+        self._extras = None
+
+    def cache_key(self) -> str:
+        return 'synthetic:%d:%d:%s:%s:%s' % (self.rows, self.seed, os.path.abspath(self.tree_path),
+                                             os.path.abspath(self.tae_path), column_layout())
+
+    def revision(self) -> str:
+        tree_stat = os.stat(self.tree_path)
+        tae_stat = os.stat(self.tae_path)
+        return '%d-%d-%d-%d' % (tree_stat.st_size, tree_stat.st_mtime_ns, tae_stat.st_size, tae_stat.st_mtime_ns)
+
+    def values(self):
+        if self._values is None:
+            self._values, self._extras = generate_synthetic_budget(
+                read_budget_tree(self.tree_path), read_tae_csv(self.tae_path), self.rows, self.seed)
+        return self._values
+
+    def extras(self):
+        if self._extras is None:
+            self.values()
+        return self._extras
+
+def read_budget_tree(path) -> (str, list):
+    """
+    Reads budget tree file, first line is title ending with year, rest are osoite values.
+    Returns year and osoite values in file order, duplicates and 0. rows removed.
+    """
+    with open(path, 'r', encoding='utf-8') as file:
+        lines = [line.strip() for line in file]
+    year = lines[0].split()[-1] if lines else ''
+    osoitteet = []
+    seen = set()
+    for osoite in lines[1:]:
+        parts = extract_osoite(osoite)[:3]
+        if not parts[0] or parts[0] == '0' or parts in seen:
+            continue
+        seen.add(parts)
+        osoitteet.append(osoite)
+    return (year, osoitteet)
+
+def read_tae_csv(path) -> dict:
+    """
+    Reads names and amounts from budjetti.vm.fi TAE CSV, both menot and tulot sections.
+    Returns dict of (paaluokka, menoluokka, momentti) to (name, amount), upper levels with '' keys and amount None.
+    """
+    tae = {}
+    for row in read_csv_rows(path):
+        if len(row) < 6 or not row[0].isdigit():
+            # Section header rows
+            continue
+        tae[(row[0], '', '')] = (row[1], None)
+        tae[(row[0], row[2], '')] = (row[3], None)
+        amount = None
+        if len(row) > 7 and row[7]:
+            try:
+                amount = int(row[7])
+            except ValueError:
+                pass
+        tae[(row[0], row[2], row[4])] = (row[5], amount)
+    return tae
+
+# Perustelu sentences for rows with cuts and additions
+SYNTHETIC_PERUSTELUT = {
+    'leikkaus': [
+        'Tehtävä ei kuulu valtion ydintehtäviin.',
+        'Toimintaa tehostetaan ja päällekkäiset tehtävät karsitaan.',
+        'Tuki vääristää kilpailua ja se lakkautetaan asteittain.',
+        'Hallinnon digitalisaatiolla saavutetaan säästöjä henkilöstömenoissa.',
+        'Tuloarvio muuttuu verotuksen painopisteen siirtyessä työn verotuksesta kulutukseen.',
+    ],
+    'lisays': [
+        'Määräraha kohdennetaan uudelleen vaikuttavampiin toimiin.',
+        'Lisäys turvaa palvelun saatavuuden koko maassa.',
+        'Investointi vähentää tulevia menoja.',
+    ],
+}
+
+def generate_synthetic_budget(tree, tae, rows, seed) -> (list, list):
+    """
+    Returns values (header and data rows) and extras like Sheets API would return them with UNFORMATTED_VALUE
+    """
+    year, osoitteet = tree
+    random_ = random.Random(seed)
+    header = [''] * (max(globals()[name] for name in globals() if name.startswith('COL_IDX_')) + 1)
+    for name, value in globals().items():
+        if name.startswith('COL_IDX_'):
+            header[value] = name[len('COL_IDX_'):].capitalize()
+    values = [header]
+    totals = defaultdict(int)
+
+    copy = 0
+    while copy == 0 or len(values) - 1 < rows:
+        for paaluokka, nodes in group_budget_tree(osoitteet):
+            if copy > 0 and len(values) - 1 >= rows:
+                break
+            values.extend(generate_synthetic_paaluokka(nodes, copy * 100, tae, year, random_, totals))
+        copy += 1
+
+    cuts = totals['cuts']
+    additions = totals['additions']
+    extras = [
+        ['Valtion tehtäviä vähennetty', cuts],
+        ['Veronmaksajien rahaa säästetty', totals['meno_hallitus'] - totals['meno_lib']],
+        ['Valtion budjetista leikattu', (totals['meno_lib'] - totals['meno_hallitus']) / (totals['meno_hallitus'] or 1)],
+        ['Tehtäviä siirretty aluehallinnoille', 0],
+        ['Alijäämää varjobudjetissa', totals['meno_lib'] - totals['tulo_lib']],
+        ['Leikkausten osuus', cuts / ((cuts + additions) or 1)],
+    ]
+    return (values, extras)
+
+def group_budget_tree(osoitteet) -> list:
+    """
+    Groups osoite values by paaluokka, as list of (paaluokka, [(parts, osoite, libLisays), ...])
+    """
+    groups = {}
+    for osoite in osoitteet:
+        paaluokka, menoluokka, momentti, libLisays = extract_osoite(osoite)
+        groups.setdefault(paaluokka, []).append(((paaluokka, menoluokka, momentti), osoite, libLisays))
+    return list(groups.items())
+
+def generate_synthetic_paaluokka(nodes, offset, tae, year, random_, totals) -> list:
+    """
+    Rows of one paaluokka, amounts summed bottom up. Missing upper level rows are added.
+    """
+    paaluokka = nodes[0][0][0]
+    tulo = paaluokka.isdigit() and int(paaluokka) < 20
+    amounts = {}
+    lisays = {}
+    for parts, osoite, libLisays in nodes:
+        lisays[parts] = libLisays
+    # Parents may be missing from tree, e.g. when only lib additions are listed under a menoluokka
+    for parts in list(lisays):
+        for parent in ((parts[0], '', ''), (parts[0], parts[1], '')):
+            if parent != parts and parent not in lisays:
+                lisays[parent] = False
+    has_children = {(parts[0], '', '') for parts in lisays if parts[1]} | \
+                   {(parts[0], parts[1], '') for parts in lisays if parts[2]}
+
+    # Leaves get amounts, upper levels are sums
+    for parts in lisays:
+        if parts in has_children:
+            continue
+        if lisays[parts]:
+            hallitus = 0
+            lib = random_.randrange(1, 500) * 100000
+        else:
+            hallitus = (tae.get(parts, (None, None))[1]
+                        or int(random_.lognormvariate(16, 2)) // 1000 * 1000)
+            lib = hallitus if random_.random() < 0.5 else int(hallitus * random_.uniform(0.5, 1.0)) // 1000 * 1000
+        amounts[parts] = [hallitus, lib]
+        ero = lib - hallitus
+        if not tulo:
+            totals['cuts' if ero < 0 else 'additions'] += abs(ero)
+        for parent in ((parts[0], parts[1], ''), (parts[0], '', '')):
+            if parent != parts and parent in has_children:
+                amount = amounts.setdefault(parent, [0, 0])
+                amount[0] += hallitus
+                amount[1] += lib
+    side = 'tulo' if tulo else 'meno'
+    totals[side + '_hallitus'] += amounts[(paaluokka, '', '')][0]
+    totals[side + '_lib'] += amounts[(paaluokka, '', '')][1]
+
+    rows = []
+    number = str(int(paaluokka) + offset) if paaluokka.isdigit() else paaluokka
+    for parts in sorted(lisays, key=lambda parts: (parts[1] != '', parts[1], parts[2] != '', parts[2])):
+        syvyys = 3 if parts[2] else 2 if parts[1] else 1
+        osoite = '.'.join([number] + [part for part in parts[1:] if part]) + '.'
+        name, tae_amount = tae.get(parts, (None, None))
+        if lisays[parts]:
+            name = 'Liberaalipuolueen lisäys'
+        elif not name:
+            name = 'Budjettikohta %s' % osoite
+        hallitus, lib = amounts[parts]
+        ero = lib - hallitus
+        row = [''] * (COL_IDX_ERO_PERCENT + 1)
+        row[COL_IDX_TULO] = side
+        row[COL_IDX_SYVYYS] = syvyys
+        row[COL_IDX_OSOITE] = osoite
+        if not lisays[parts]:
+            row[COL_IDX_LINKKI] = ('https://budjetti.vm.fi/indox/sisalto.jsp?year={0}&lang=fi&maindoc=/{0}/tae/hallituksenEsitys/hallituksenEsitys.xml'
+                                   '&id=/{0}/tae/hallituksenEsitys/YksityiskohtaisetPerustelut/{1}/{2}.html').format(
+                                       year, '/'.join(part for part in parts if part), [part for part in parts if part][-1])
+        row[COL_IDX_PAALUOKKA] = number
+        row[COL_IDX_MENOLUOKKA] = parts[1]
+        row[COL_IDX_MOMENTTI] = parts[2]
+        if syvyys == 1:
+            row[COL_IDX_PAALUOKKA_SELITE] = name
+        elif syvyys == 2:
+            row[COL_IDX_MENOLUOKKA_SELITE] = name
+        else:
+            row[COL_IDX_MOMENTTI_SELITE] = name
+        row[COL_IDX_HALLITUS] = hallitus
+        row[COL_IDX_LIB] = lib
+        row[COL_IDX_ERO] = ero
+        if ero:
+            sentences = SYNTHETIC_PERUSTELUT['leikkaus' if ero < 0 else 'lisays']
+            row[COL_IDX_PERUSTELU] = ' '.join(random_.sample(sentences, random_.randint(1, 3)))
+        if hallitus:
+            row[COL_IDX_ERO_PERCENT] = ero / hallitus
+        while row and row[-1] == '':
+            row.pop()
+        rows.append(row)
+    return rows
+
+def write_synthetic_csv(source, path, extras_path) -> None:
+    """
+    Writes generated budget as CSV files readable by CsvFileDataSource
+    """
+    with open(path, 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file, delimiter=';')
+        for row in source.values():
+            row = list(row)
+            # Percent in sheet display format, CSV exports are formatted
+            if len(row) > COL_IDX_ERO_PERCENT and is_number(row[COL_IDX_ERO_PERCENT]):
+                row[COL_IDX_ERO_PERCENT] = ('%.1f %%' % (row[COL_IDX_ERO_PERCENT] * 100)).replace('.', ',')
+            writer.writerow(row)
+    with open(extras_path, 'w', encoding='utf-8', newline='') as file:
+        csv.writer(file, delimiter=';').writerows(source.extras())
+    print("Wrote %d rows to %s and extras to %s" % (len(source.values()) - 1, path, extras_path))
+
+def normalize_budget_csv(path, output_path, encoding='auto') -> None:
+    """
+    Writes budjetti.vm.fi CSV in our sheet layout, same as index.html and script.js show it
+    """
+    if encoding == 'auto':
+        encoding = detect_csv_encoding(path)
+    # Lines end only at \n like in script.js
+    with open(path, 'r', encoding=encoding, newline='\n') as file, \
+            open(output_path, 'w', encoding='utf-8', newline='') as output:
+        writer = csv.writer(output, delimiter=';', lineterminator='\n')
+        count = 0
+        for row in iter_normalized_rows(file):
+            writer.writerow(row)
+            count += 1
+    print("Wrote %d rows to %s" % (count - 1, output_path))
+
+# Amount columns of budjetti.vm.fi CSV, summed to level 1 and 2 rows
+NORMALIZE_SUM_COLUMNS = range(7, 20)
+
+def iter_normalized_rows(lines):
+    """
+    Port of processCSVLines() in script.js, in one pass.
+
+    Yields header and each momentti row with Momenttitaso and Budjettipuu columns added in front, then a
+    sum row for each paaluokka.menoluku and then for each paaluokka. Sum rows copy the first row of their
+    group with NORMALIZE_SUM_COLUMNS summed, in order of first appearance. Blank lines are skipped.
+    """
+    # Key to [first row cells, sums]
+    level2 = {}
+    level1 = {}
+    header = True
+    for line in lines:
+        # Unlike script.js, line end is not part of last cell, so an empty last cell on CRLF line is not NaN
+        cells = line.replace('"', '').rstrip('\r\n').split(';')
+        trimmed = [cell.strip() for cell in cells]
+        if header:
+            header = False
+            yield ['Momenttitaso', 'Budjettipuu'] + trimmed
+            continue
+        if not line.strip():
+            continue
+        padded = trimmed + ['', '', '', '', '']
+        yield ['3', f'{padded[0]}.{padded[2]}.{padded[4]}.'] + trimmed
+
+        # Empty cells do not count, whitespace does, as in script.js
+        if not cells[0]:
+            continue
+        group1 = level1.get(trimmed[0])
+        if group1 is None:
+            group1 = level1[trimmed[0]] = [trimmed, [0.0] * len(NORMALIZE_SUM_COLUMNS)]
+        if len(cells) < 3 or not cells[2]:
+            continue
+        key2 = (trimmed[0], trimmed[2])
+        group2 = level2.get(key2)
+        if group2 is None:
+            group2 = level2[key2] = [trimmed, [0.0] * len(NORMALIZE_SUM_COLUMNS)]
+        for i, column in enumerate(NORMALIZE_SUM_COLUMNS):
+            if column < len(cells) and cells[column]:
+                value = parse_js_float(cells[column])
+                group1[1][i] += value
+                group2[1][i] += value
+
+    for (paaluokka, menoluku), (first, sums) in level2.items():
+        yield ['2', f'{paaluokka}.{menoluku}.'] + normalized_sum_row(first, sums, (4, 5))
+    for paaluokka, (first, sums) in level1.items():
+        yield ['1', f'{paaluokka}.'] + normalized_sum_row(first, sums, (2, 3, 4, 5))
+
+def normalized_sum_row(first, sums, empty_columns) -> list:
+    row = []
+    for index, value in enumerate(first):
+        if index in NORMALIZE_SUM_COLUMNS:
+            value = format_js_number(sums[index - NORMALIZE_SUM_COLUMNS.start])
+        elif index in empty_columns:
+            value = ''
+        row.append(value)
+    return row
+
+_JS_FLOAT = re.compile(r'[+-]?(?:Infinity|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)')
+
+def parse_js_float(text: str) -> float:
+    """
+    JavaScript parseFloat(): longest number at start of text, ignoring the rest, NaN if none
+    """
+    match = _JS_FLOAT.match(text.lstrip())
+    return float(match.group(0)) if match else float('nan')
+
+def format_js_number(value: float) -> str:
+    """
+    Number as JavaScript String(number) shows it, e.g. 1000 instead of 1000.0
+    """
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return 'Infinity' if value > 0 else '-Infinity'
+    if value == 0:
+        return '0'
+    # Shortest digits which read back as value, positioned by JavaScript rules
+    sign, digits, exponent = Decimal(repr(value)).normalize().as_tuple()
+    digits = ''.join(map(str, digits))
+    k = len(digits)
+    n = exponent + k
+    if k <= n <= 21:
+        text = digits + '0' * (n - k)
+    elif 0 < n <= 21:
+        text = digits[:n] + '.' + digits[n:]
+    elif -6 < n <= 0:
+        text = '0.' + '0' * -n + digits
     else:
-        headerRow = True
-        for row in values:            
-            # Skip empty rows and first (header) row
-            if not row:                
+        mantissa = digits[0] + ('.' + digits[1:] if k > 1 else '')
+        text = '%se%+d' % (mantissa, n - 1)
+    return ('-' if sign else '') + text
+
+def read_csv_rows(path, encoding='auto', delimiter=None):
+    """
+    Yields CSV rows as lists of strings. Trailing empty cells are dropped, same as Sheets API does.
+    """
+    if encoding == 'auto':
+        encoding = detect_csv_encoding(path)
+    with open(path, 'r', encoding=encoding, newline='') as file:
+        if delimiter is None:
+            delimiter = detect_csv_delimiter(file.readline())
+            file.seek(0)
+        for row in csv.reader(file, delimiter=delimiter):
+            while row and row[-1] == '':
+                row.pop()
+            yield row
+
+def detect_csv_encoding(path, sample_size=64 * 1024) -> str:
+    """
+    Tells UTF-8 apart from ISO-8859-10, which is what budjetti.vm.fi opendata CSVs use
+    """
+    with open(path, 'rb') as file:
+        sample = file.read(sample_size)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        # Not final, sample may end in the middle of a multibyte character
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=False)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'iso-8859-10'
+
+def detect_csv_delimiter(header: str) -> str:
+    """
+    Picks the most common of ; , and tab on header line
+    """
+    return max([';', ',', '\t'], key=header.count)
+
+def parse_unformatted_cell(cell: str):
+    """
+    Converts numeric looking CSV cell to int or float, like Sheets API UNFORMATTED_VALUE would return it
+    """
+    value = cell.replace('\xa0', '').replace(' ', '').replace('−', '-').replace(',', '.')
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return cell
+
+def iter_data_objects(values, chunk_size=1024):
+    """
+    Parses data rows to DataObjects. First non-empty row is the header row.
+
+    Rows are parsed in chunks of chunk_size rows, amount and percent columns of a chunk at once,
+    so only one chunk of rows is kept in memory.
+    """
+    headerRow = True
+    chunk = []
+    for row in values:
+        # Skip empty rows and first (header) row
+        if not row:
+            continue
+        if headerRow:
+            headerRow = False
+            continue
+        profile_count('rows')
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield from parse_data_rows(chunk)
+            chunk = []
+    if chunk:
+        yield from parse_data_rows(chunk)
+
+def row_cell(row, index):
+    """
+    Cell value, or '' if row is shorter due Sheets API leaving out empty trailing cell values
+    """
+    return row[index] if index < len(row) else ''
+
+def parse_data_rows(rows):
+    """
+    Parses chunk of data rows to DataObjects
+    """
+    # NOTE: With valueRenderOption='UNFORMATTED_VALUE' numeric cells are ints and floats
+    #       and can be taken as is, otherwise values are formatted strings, see parse_amounts_cents()
+    hallitusColumn = parse_amounts_cents([row_cell(row, COL_IDX_HALLITUS) for row in rows])
+    libColumn = parse_amounts_cents([row_cell(row, COL_IDX_LIB) for row in rows])
+    # Euroja
+    # From sheet
+    eroColumn = parse_amounts_cents([row_cell(row, COL_IDX_ERO) for row in rows])
+    # %
+    eroPercentColumn = parse_percents_basis_points([row_cell(row, COL_IDX_ERO_PERCENT) for row in rows])
+
+    for row, hallitusCents, libCents, eroCents, eroPercentBp in zip(rows, hallitusColumn, libColumn, eroColumn, eroPercentColumn):
+        try:
+            # NOTE: Lenght of rows varies due Sheets API leaving out empty trailing cell values
+            # XXX Handle varying row lengths by assuming default values and reading values only if row length is long enough
+            paaluokka_selite = str(row_cell(row, COL_IDX_PAALUOKKA_SELITE))
+            menoluokka_selite = str(row_cell(row, COL_IDX_MENOLUOKKA_SELITE))
+            # Text, but with UNFORMATTED_VALUE a cell with number format would come as number
+            osoiteStr = str(row_cell(row, COL_IDX_OSOITE))
+            perustelu = str(row_cell(row, COL_IDX_PERUSTELU))
+            momentti_selite = str(row_cell(row, COL_IDX_MOMENTTI_SELITE))
+            tuloStr = row_cell(row, COL_IDX_TULO)
+            syvyysStr = row_cell(row, COL_IDX_SYVYYS)
+            linkkiStr = str(row_cell(row, COL_IDX_LINKKI))
+
+            # FIXME: API/Sheet is returning 1 for 11 in for some rows
+            #     due unknown issue.
+            # Skip accessing number cells and extract values from osoite cell            
+            #paaluokkaInt = 0
+            #paaluokkaStr = row[COL_IDX_MENOLUOKKA]
+            #try:
+            #    paaluokkaInt = int(paaluokkaStr)
+            #except ValueError:
+            #    pass
+            #menoLuokkaInt = 0
+            #menoLuokkaStr = row[COL_IDX_PAALUOKKA]
+            #try:
+            #    menoLuokkaInt = int(menoLuokkaStr)
+            #except ValueError:
+            #    pass
+            # Empty with lib additions
+            #momenttiInt = 0
+            #momenttiStr = row[COL_IDX_MOMENTTI]
+            #try:
+            #    momenttiInt = int(momenttiStr)
+            #except ValueError:
+            #    pass                
+            (paaluokka, menoLuokka, momentti, libLisays) = extract_osoite(osoiteStr)
+
+            #print("%s was parsed to %r.%r.%r" % (osoiteStr, paaluokka, menoLuokka, momentti))
+
+            tuloBool = tuloStr == 'tulo'
+
+            syvyysInt = 0
+            try:
+                syvyysInt = int(syvyysStr)
+            except ValueError:
+                pass
+
+            # Cells which could not be parsed are None
+            if hallitusCents is None:
+                hallitusValue = row_cell(row, COL_IDX_HALLITUS)
+                # XXX Another header row? Not sure, but filter it out
+                if str(hallitusValue).replace('\xa0', '') == 'Määräraha':
+                    print("Skipping another header row like row.")
+                else:
+                    print("Failed to convert hallitusValue %r to cents %r" % (hallitusValue, row))
                 continue
-            if headerRow:
-                headerRow = False
+            if libCents is None:
+                print("Failed to convert libValue %r to cents" % row_cell(row, COL_IDX_LIB))
+                continue
+            if eroCents is None:
+                print("Failed to convert eroValue %r to cents" % row_cell(row, COL_IDX_ERO))
+                continue
+            # Code
+            #eroCents = libCents - hallitusCents
+            if eroPercentBp is None:
+                print("Failed to convert eroPercentValue %r to basis points" % row_cell(row, COL_IDX_ERO_PERCENT))
                 continue
-            
-            try:
-                # NOTE: Lenght of rows varies due Sheets API leaving out empty trailing cell values
-                # XXX Handle varying row lengths by assuming default values and reading values only if row length is long enough
-                lastIndex = len(row) - 1
-                paaluokka_selite = ''
-                menoluokka_selite = ''
-                momentti_selite = ''
-                perustelu = ''
-                hallitusStr = ''
-                libStr = ''
-                tuloStr = ''
-                syvyysStr = ''
-                osoiteStr = ''
-                linkkiStr = ''
-                eroStr = ''
-                eroPercentStr = ''
-                if lastIndex >= COL_IDX_PAALUOKKA_SELITE:
-                    paaluokka_selite=row[COL_IDX_PAALUOKKA_SELITE]
-                if lastIndex >= COL_IDX_MENOLUOKKA_SELITE:
-                    menoluokka_selite=row[COL_IDX_MENOLUOKKA_SELITE]
-                if lastIndex >= COL_IDX_OSOITE:
-                    osoiteStr=row[COL_IDX_OSOITE]
-                if lastIndex >= COL_IDX_PERUSTELU:
-                    perustelu=row[COL_IDX_PERUSTELU]
-                if lastIndex >= COL_IDX_MOMENTTI_SELITE:
-                    momentti_selite=row[COL_IDX_MOMENTTI_SELITE]
-                if lastIndex >= COL_IDX_HALLITUS:
-                    hallitusStr = row[COL_IDX_HALLITUS]
-                if lastIndex >= COL_IDX_LIB:
-                    libStr = row[COL_IDX_LIB]
-                if lastIndex >= COL_IDX_TULO:
-                    tuloStr = row[COL_IDX_TULO]
-                if lastIndex >= COL_IDX_SYVYYS:
-                    syvyysStr = row[COL_IDX_SYVYYS]
-                if lastIndex >= COL_IDX_LINKKI:
-                    linkkiStr = row[COL_IDX_LINKKI]
-                if lastIndex >= COL_IDX_ERO_PERCENT:
-                    eroPercentStr = row[COL_IDX_ERO_PERCENT]
-                if lastIndex >= COL_IDX_ERO:
-                    eroStr = row[COL_IDX_ERO]
-
-                # FIXME: API/Sheet is returning 1 for 11 in for some rows
-                #     due unknown issue.
-                # Skip accessing number cells and extract values from osoite cell            
-                #paaluokkaInt = 0
-                #paaluokkaStr = row[COL_IDX_MENOLUOKKA]
-                #try:
-                #    paaluokkaInt = int(paaluokkaStr)
-                #except ValueError:
-                #    pass
-                #menoLuokkaInt = 0
-                #menoLuokkaStr = row[COL_IDX_PAALUOKKA]
-                #try:
-                #    menoLuokkaInt = int(menoLuokkaStr)
-                #except ValueError:
-                #    pass
-                # Empty with lib additions
-                #momenttiInt = 0
-                #momenttiStr = row[COL_IDX_MOMENTTI]
-                #try:
-                #    momenttiInt = int(momenttiStr)
-                #except ValueError:
-                #    pass                
-                (paaluokka, menoLuokka, momentti, libLisays) = extract_osoite(osoiteStr)
-
-                #print("%s was parsed to %r.%r.%r" % (osoiteStr, paaluokka, menoLuokka, momentti))
-
-                tuloBool = tuloStr == 'tulo'
-
-                syvyysInt = 0
-                try:
-                    syvyysInt = int(syvyysStr)
-                except ValueError:
-                    pass
-
-                hallitusDecimal = Decimal('0.0')
-                if (len(hallitusStr) > 0):
-                    # Remove non-breaking spaces
-                    hallitusStr = hallitusStr.replace('\xa0', '')
-                    # XXX Another header row? Not sure, but filter it out
-                    if hallitusStr == 'Määräraha':
-                        print("Skipping another header row like row.")
-                        continue
-                    try:
-                        hallitusDecimal = Decimal(hallitusStr)
-                    except InvalidOperation:
-                        print("Failed to convert hallitusStr %r to Decimal %r" % (hallitusStr, row))
-                        continue
-
-                libDecimal = Decimal('0.0')
-                if (len(libStr) > 0):
-                    # Remove non-breaking spaces
-                    libStr = libStr.replace('\xa0', '')
-                    try:
-                        libDecimal = Decimal(libStr)
-                    except InvalidOperation:
-                        print("Failed to convert libStr %r to Decimal" % libStr)
-                        continue                    
-
-                # Euroja
-                # From sheet
-                eroDecimal = Decimal('0.0')
-                if (len(eroStr) > 0):
-                    eroStr = eroStr.replace('\xa0', '')
-                    eroStr = eroStr.replace('−', '-')
-                    try:
-                        eroDecimal = Decimal(eroStr)
-                    except InvalidOperation:
-                        print("Failed to convert eroDecimal %r to Decimal" % eroStr)
-                        continue
-                # Code
-                #eroDecimal = hallitusDecimal - libDecimal                
-                #eroDecimal = -eroDecimal
-                
 
-                # %
-                eroPercentDecimal = Decimal('0.0')
-                if (len(eroPercentStr) > 0):
-                    try:
-                        eroPercentDecimal = parse_localized_percent(eroPercentStr)
-                    except ValueError:
-                        print("Failed to convert eroPercentStr %r to Decimal" % eroPercentStr)
-                        continue
-
-
-                dataObj = DataObject(
-                    tulo=tuloBool,
-                    syvyys=syvyysInt,
-                    paaluokka=paaluokka,
-                    paaluokka_selite=paaluokka_selite,
-                    menoluokka=menoLuokka,
-                    menoluokka_selite=menoluokka_selite,
-                    momentti=momentti,
-                    momentti_selite=momentti_selite,
-                    osoite=osoiteStr,
-                    libLisays=libLisays,
-                    hallitus=hallitusDecimal,
-                    lib=libDecimal,
-                    ero=eroDecimal,
-                    eroPercent=eroPercentDecimal,
-                    perustelu=perustelu,
-                    linkki=linkkiStr,
-                    subrows={}
-                )
-                data.append(dataObj)
-            except Exception as e:
-                print("Failed to process row %r due %r" % (row, e))
-    
+            dataObj = DataObject(
+                tulo=tuloBool,
+                syvyys=syvyysInt,
+                paaluokka=paaluokka,
+                paaluokka_selite=paaluokka_selite,
+                menoluokka=menoLuokka,
+                menoluokka_selite=menoluokka_selite,
+                momentti=momentti,
+                momentti_selite=momentti_selite,
+                osoite=osoiteStr,
+                libLisays=libLisays,
+                hallitus_cents=hallitusCents,
+                lib_cents=libCents,
+                ero_cents=eroCents,
+                ero_percent_bp=eroPercentBp,
+                perustelu=perustelu,
+                linkki=linkkiStr,
+            )
+            profile_count('parsed_rows')
+            yield dataObj
+        except Exception as e:
+            print("Failed to process row %r due %r" % (row, e))
+
+def parse_summary(extras) -> SummaryDataObject:
+    """
+    Parses SHEET_EXTRAS key-value rows to summary
+    """
     summary = None
 
     valtion_tehtavia_vahennetty = Decimal('0')
@@ -442,7 +1701,19 @@ def get_data():
         alijaamaa=alijaamaa,
         leikkausten_osuus=leikkausten_osuus)   
 
-    return (data, summary)
+    return summary
+
+def is_number(value) -> bool:
+    # bool is an int too, but a checkbox cell is not an amount
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def number_to_decimal(value) -> Decimal:
+    """
+    Converts UNFORMATTED_VALUE number to Decimal. Floats go through repr to avoid binary fraction noise.
+    """
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    return Decimal(value)
 
 def extract_osoite_int(osoite: str) -> (int, int, int, bool):
     """
@@ -476,82 +1747,967 @@ def extract_osoite(osoite: str) -> (str, str, str, bool):
     return parts[0], parts[1], parts[2], isLib
 
 def parse_localized_percent(percent_str):
-    # Already set
-    #locale.setlocale(locale.LC_ALL, 'fi_FI.utf8')
-    percent_str = percent_str.replace('\xa0', ' ')
-    percent_str = percent_str.strip('%')
-    # Replace weird character with normal negative sign
-    percent_str = percent_str.replace('−', '-')
-
-    # Parse the localized string to a float
+    """
+    Parses Finnish formatted percent, e.g. "−55,2 %" to fraction -0.552
+    """
     try:
-        percent_value = locale.atof(percent_str)
-        #percent_str = percent_str.replace(',','.')
-        #percent_value = float(percent_str)
+        percent_value = parse_percent_basis_points(percent_str)
     except ValueError as e:
         # Handle invalid input gracefully
         print("Invalid input:", percent_str)
         raise e
 
-    # Convert the parsed value to the standard percentage (e.g., 55.2% becomes 0.552)
-    percent_value /= 100.0
+    # Convert basis points to the standard percentage (e.g., 55.2% becomes 0.552)
+    return percent_value / 10000
+
+# Finnish number formatting to plain decimal: grouping spaces (also non-breaking and narrow no-break),
+# currency and percent signs removed, U+2212 minus to hyphen, decimal comma to dot
+_NUMBER_TRANSLATION = str.maketrans({' ': None, '\xa0': None, '\u202f': None, '€': None, '%': None,
+                                     '\u2212': '-', ',': '.'})
+
+def parse_amount_cents(value) -> int:
+    """
+    Parses amount to int cents without locale. value is a number in euros, as Sheets API UNFORMATTED_VALUE
+    returns them, or a Finnish formatted string such as "−1 234 567,89 €". Raises ValueError if not a number.
+    """
+    if is_number(value):
+        return to_cents(number_to_decimal(value))
+    return decimal_text_to_cents(value.translate(_NUMBER_TRANSLATION))
+
+def parse_percent_basis_points(value) -> int:
+    """
+    Parses percent to int basis points (0.01 %) without locale. value is a fraction, as Sheets API UNFORMATTED_VALUE
+    returns percents, or a Finnish formatted string such as "−55,2 %". Raises ValueError if not a number.
+    """
+    if is_number(value):
+        return to_cents(number_to_decimal(value) * 100)
+    # Hundredths of percent are basis points
+    return decimal_text_to_cents(value.translate(_NUMBER_TRANSLATION))
+
+def parse_amounts_cents(values) -> list:
+    """
+    Parses column of amounts like parse_amount_cents(). Empty cells are 0, cells which can not be parsed None.
+    """
+    return _parse_number_column(values, parse_amount_cents)
+
+def parse_percents_basis_points(values) -> list:
+    """
+    Parses column of percents like parse_percent_basis_points(). Empty cells are 0, cells which can not be parsed None.
+    """
+    return _parse_number_column(values, parse_percent_basis_points)
+
+def _parse_number_column(values, parse_number) -> list:
+    # Text cells are cleaned with one translate call for the whole column
+    texts = [value for value in values if isinstance(value, str)]
+    cleaned = '\n'.join(texts).translate(_NUMBER_TRANSLATION).split('\n')
+    if len(cleaned) != len(texts):
+        # Some cell contains a line break, clean one cell at a time
+        cleaned = [text.translate(_NUMBER_TRANSLATION) for text in texts]
+    cleaned = iter(cleaned)
+
+    parsed = []
+    for value in values:
+        try:
+            if isinstance(value, str):
+                text = next(cleaned)
+                parsed.append(decimal_text_to_cents(text) if text else 0)
+            elif is_number(value):
+                parsed.append(parse_number(value))
+            else:
+                parsed.append(None)
+        except ValueError:
+            parsed.append(None)
+    return parsed
+
+def decimal_text_to_cents(text: str) -> int:
+    """
+    Plain decimal such as "-1234.567" to hundredths, rounding half away from zero
+    """
+    sign = 1
+    if text[:1] == '-':
+        sign = -1
+        text = text[1:]
+    elif text[:1] == '+':
+        text = text[1:]
+    whole, dot, fraction = text.partition('.')
+    if not (whole or fraction) or not (whole.isdecimal() or not whole) or not (fraction.isdecimal() or not fraction):
+        raise ValueError("Not a decimal number: %r" % text)
+    cents = int(whole or '0') * 100 + int((fraction + '00')[:2])
+    if fraction[2:3] >= '5':
+        cents += 1
+    return sign * cents
+
+def sort_data(data: list[DataObject], fill_missing=False) -> 'BudgetTree':
+    """
+    Groups dataRows based on their common paaluokka and menoluokka numbers.
+    With fill_missing, missing parent rows are added, see BudgetTree.
+    
+    Returns
+        BudgetTree, mapping of top level rows, other rows inserted into subrows dicts inside each row object
+    """
+    tree = BudgetTree(data, fill_missing=fill_missing)
+    print("Sorted data contains %d rows" % len(tree.index))
+    profile_count('sorted_rows', len(tree.index))
+    profile_count('skipped_rows', len(data) - len(tree.index))
+    return tree
+
+def osoite_path(osoite: str) -> tuple:
+    """
+    Osoite as tuple of its parts, "11.01.01." to ('11', '01', '01'). Lib additions such as "30.lib.60" keep their lib part.
+    """
+    # Normalize ' lib' to 'lib' like extract_osoite()
+    return tuple(osoite.replace(' lib', 'lib').rstrip('.').split('.'))
+
+@functools.lru_cache(maxsize=4096)
+def natural_key(part: str) -> tuple:
+    """
+    Sort key of osoite part, numbers by value so that "2" comes before "11", and before text such as "lib"
+    """
+    return tuple((0, int(token), token) if token.isdecimal() else (1, 0, token)
+                 for token in re.split(r'(\d+)', part) if token) + ((2, 0, part),)
+
+class BudgetTree(Mapping):
+    """
+    Rows of budget as tree, built in one pass over rows in any order.
+
+    Mapping of paaluokka to top level row, ordered by number, like sort_data() has always returned.
+    Other rows are in subrows of their parent at any depth, each row at depth given by its syvyys.
+    All rows are indexed by osoite path, see find() and parent().
+
+    Rows coming before their parent wait for it. Rows whose parent never comes are left out, see orphans,
+    or with fill_missing get an empty parent row, see filled. rollup_totals() sets amounts of filled rows.
+    """
+    def __init__(self, rows=(), fill_missing=False):
+        self.roots = {}
+        # osoite path to row, for all rows in tree
+        self.index = {}
+        # Rows without parent, by path of the missing parent
+        self._waiting = defaultdict(list)
+        self.filled = []
+        for row in rows:
+            self.add(row)
+        if fill_missing:
+            self._fill_missing_parents()
+        self.orphans = self._take_orphans()
+        self._sort()
+
+    def __getitem__(self, paaluokka):
+        return self.roots[paaluokka]
+
+    def __iter__(self):
+        return iter(self.roots)
+
+    def __len__(self) -> int:
+        return len(self.roots)
+
+    @staticmethod
+    def path(row) -> tuple:
+        """
+        Path of row in tree, first syvyys parts of its osoite
+        """
+        return osoite_path(row.osoite)[:row.syvyys]
+
+    def add(self, row) -> bool:
+        """
+        Adds row under its parent, or to wait for its parent. Returns False if row can not be placed in tree.
+        """
+        path = self.path(row)
+        if row.syvyys < 1 or len(path) != row.syvyys or '' in path:
+            print("Unexpected syvyys value %r for osoite %r, don't know what to do!" % (row.syvyys, row.osoite))
+            return False
+
+        previous = self.index.get(path)
+        if previous is not None:
+            print("Duplicate osoite %r, using the last one" % row.osoite)
+            for key, subrow in previous.subrows.items():
+                if key not in row.subrows:
+                    row.add_subrow(key, subrow)
+        self.index[path] = row
+
+        if len(path) == 1:
+            self.roots[path[0]] = row
+        else:
+            parent = self.index.get(path[:-1])
+            if parent is None:
+                self._waiting[path[:-1]].append(row)
+            else:
+                parent.add_subrow(path[-1], row)
+
+        # Children which came first
+        for child in self._waiting.pop(path, ()):
+            row.add_subrow(self.path(child)[-1], child)
+        return True
+
+    def find(self, osoite: str):
+        """
+        Row by osoite, e.g. "11.01." or "30.lib.60.", None if not in tree
+        """
+        return self.index.get(osoite_path(osoite))
+
+    def parent(self, row):
+        """
+        Parent row, None for top level rows
+        """
+        path = self.path(row)
+        return self.index.get(path[:-1]) if len(path) > 1 else None
+
+    def walk(self):
+        """
+        Yields all rows depth first, parents before their subrows, in order
+        """
+        stack = list(reversed(self.roots.values()))
+        while stack:
+            row = stack.pop()
+            yield row
+            stack.extend(reversed(row.subrows.values()))
+
+    def _fill_missing_parents(self) -> None:
+        while self._waiting:
+            parent_path, rows = next(iter(self._waiting.items()))
+            parent = missing_parent_row(parent_path, rows[0])
+            print("Adding missing row %r for its subrows" % parent.osoite)
+            self.filled.append(parent)
+            # Takes waiting subrows, and waits for its own parent if that is missing too
+            self.add(parent)
+
+    def _take_orphans(self) -> list:
+        orphans = []
+        for parent_path, rows in self._waiting.items():
+            for row in rows:
+                print("Unknown parent %r for row %r, leaving it out" % ('.'.join(parent_path) + '.', row.osoite))
+                # Remove row and its subrows from index
+                stack = [row]
+                while stack:
+                    orphan = stack.pop()
+                    orphans.append(orphan)
+                    self.index.pop(self.path(orphan), None)
+                    stack.extend(orphan.subrows.values())
+        self._waiting.clear()
+        return orphans
+
+    def _sort(self) -> None:
+        self.roots = dict(sorted(self.roots.items(), key=lambda item: natural_key(item[0])))
+        for row in self.index.values():
+            row.sort_subrows(natural_key)
+
+# Bump when layout of tree cache files changes, files of other formats are not loaded
+TREE_CACHE_FORMAT = 1
+TREE_CACHE_MAGIC = b'VBTREE\0\0'
+# Written in native byte order, files from other byte order machines do not match
+TREE_CACHE_BYTE_ORDER = 0x01020304
+# Magic, format, byte order, row count, string count, meta size
+TREE_CACHE_HEADER = struct.Struct('=8sIIIIQ')
+# Fixed-width columns in file order as (attribute, array typecode). Rows are in BudgetTree.walk() order,
+# so subrows of a row are the rows from it up to its _end. String columns are indexes to string table.
+TREE_CACHE_COLUMNS = (
+    ('hallitus_cents', 'q'),
+    ('lib_cents', 'q'),
+    ('ero_cents', 'q'),
+    ('ero_percent_bp', 'q'),
+    ('_end', 'i'),
+    ('_key', 'i'),
+    ('paaluokka', 'i'),
+    ('paaluokka_selite', 'i'),
+    ('menoluokka', 'i'),
+    ('menoluokka_selite', 'i'),
+    ('momentti', 'i'),
+    ('momentti_selite', 'i'),
+    ('osoite', 'i'),
+    ('perustelu', 'i'),
+    ('linkki', 'i'),
+    ('tulo', 'B'),
+    ('syvyys', 'B'),
+    ('libLisays', 'B'),
+    ('_filled', 'B'),
+)
+TREE_CACHE_STRINGS = frozenset(('_key', 'paaluokka', 'paaluokka_selite', 'menoluokka', 'menoluokka_selite',
+                                'momentti', 'momentti_selite', 'osoite', 'perustelu', 'linkki'))
+TREE_CACHE_BOOLS = frozenset(('tulo', 'libLisays', '_filled'))
+
+def _align(offset, alignment=8) -> int:
+    return (offset + alignment - 1) // alignment * alignment
+
+def write_tree_cache(tree, path, meta) -> int:
+    """
+    Writes BudgetTree to path as fixed-width columns and a table of distinct strings, meta pickled in header.
+    muutos and toteutuma_cents are set per run, so they are not written. Returns file size.
+    """
+    rows = list(tree.walk())
+    position = {id(row): index for index, row in enumerate(rows)}
+    keys = [None] * len(rows)
+    for key, row in tree.roots.items():
+        keys[position[id(row)]] = key
+    for row in rows:
+        for key, subrow in row.subrows.items():
+            keys[position[id(subrow)]] = key
+    # Subtree of a row ends where subtree of its last subrow ends
+    ends = [0] * len(rows)
+    for index in range(len(rows) - 1, -1, -1):
+        subrows = rows[index].subrows
+        ends[index] = ends[position[id(next(reversed(subrows.values())))]] if subrows else index + 1
+    filled = set(map(id, tree.filled))
+
+    strings = {}
+    def string_index(value):
+        return strings.setdefault(value, len(strings))
+
+    columns = []
+    for name, typecode in TREE_CACHE_COLUMNS:
+        if name == '_end':
+            values = ends
+        elif name == '_key':
+            values = keys
+        elif name == '_filled':
+            values = [id(row) in filled for row in rows]
+        else:
+            values = [getattr(row, name) for row in rows]
+        if name in TREE_CACHE_STRINGS:
+            values = map(string_index, values)
+        columns.append(array.array(typecode, values))
+
+    encoded = [value.encode('utf-8') for value in strings]
+    offsets = array.array('I', [0])
+    for value in encoded:
+        offsets.append(offsets[-1] + len(value))
+    meta_bytes = pickle.dumps(meta, protocol=pickle.HIGHEST_PROTOCOL)
+
+    with open(path, 'wb') as file:
+        file.write(TREE_CACHE_HEADER.pack(TREE_CACHE_MAGIC, TREE_CACHE_FORMAT, TREE_CACHE_BYTE_ORDER,
+                                          len(rows), len(encoded), len(meta_bytes)))
+        file.write(meta_bytes)
+        # Columns start at aligned offsets, so that they can be read in place
+        for column in columns + [offsets]:
+            file.write(b'\0' * (_align(file.tell()) - file.tell()))
+            file.write(column.tobytes())
+        file.write(b''.join(encoded))
+        return file.tell()
+
+class MappedBudgetTree(BudgetTree):
+    """
+    BudgetTree loaded from a file written by write_tree_cache(). The file is memory-mapped and its rows are
+    MappedRow views reading the columns in place, so loading takes the same time for any budget size,
+    and processes mapping the same file share its pages.
+    """
+    def __init__(self, path):
+        self.file_path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, count, string_count, meta_size = TREE_CACHE_HEADER.unpack_from(self._mmap)
+        if magic != TREE_CACHE_MAGIC or version != TREE_CACHE_FORMAT or byte_order != TREE_CACHE_BYTE_ORDER:
+            raise ValueError("Not a tree cache file of format %d" % TREE_CACHE_FORMAT)
+        view = memoryview(self._mmap)
+        offset = TREE_CACHE_HEADER.size
+        self.meta = pickle.loads(view[offset:offset + meta_size])
+        offset += meta_size
+        self._columns = {}
+        for name, typecode in TREE_CACHE_COLUMNS + (('_string_offsets', 'I'),):
+            offset = _align(offset)
+            size = (string_count + 1 if name == '_string_offsets' else count) * struct.calcsize(typecode)
+            self._columns[name] = view[offset:offset + size].cast(typecode)
+            offset += size
+        self._string_offsets = self._columns.pop('_string_offsets')
+        self._string_data = view[offset:]
+        self._strings = [None] * string_count
+        self._end = self._columns['_end']
+        self._readers = {name: self._reader(name) for name, typecode in TREE_CACHE_COLUMNS}
+        self.row_count = count
+        self.orphans = []
+        self._index = None
+        self._filled = None
+
+        self.roots = {}
+        index = 0
+        while index < count:
+            self.roots[self.string(self._columns['_key'][index])] = MappedRow(self, index)
+            index = self._end[index]
+
+    def _reader(self, name):
+        column = self._columns[name]
+        if name in TREE_CACHE_STRINGS:
+            return lambda index: self.string(column[index])
+        if name in TREE_CACHE_BOOLS:
+            return lambda index: column[index] != 0
+        return column.__getitem__
+
+    def string(self, index) -> str:
+        """
+        String from string table, decoded once
+        """
+        value = self._strings[index]
+        if value is None:
+            value = self._strings[index] = str(
+                self._string_data[self._string_offsets[index]:self._string_offsets[index + 1]], 'utf-8')
+        return value
+
+    def read(self, name, index):
+        return self._readers[name](index)
+
+    def subrows(self, index):
+        """
+        Subrows of row at index as dict of key to MappedRow, in order
+        """
+        end = self._end[index]
+        if end == index + 1:
+            return _NO_SUBROWS
+        keys = self._columns['_key']
+        subrows = {}
+        child = index + 1
+        while child < end:
+            subrows[self.string(keys[child])] = MappedRow(self, child)
+            child = self._end[child]
+        return subrows
+
+    @property
+    def index(self) -> dict:
+        if self._index is None:
+            self._index = {self.path(row): row for row in self.walk()}
+        return self._index
+
+    @property
+    def filled(self) -> list:
+        if self._filled is None:
+            filled = self._columns['_filled']
+            self._filled = [row for row in self.walk() if filled[row._index]]
+        return self._filled
+
+    def overrides(self, row) -> dict:
+        """
+        Attributes assigned to row and its subrows, by row index
+        """
+        overrides = {}
+        stack = [row]
+        while stack:
+            row = stack.pop()
+            if row._overrides:
+                overrides[row._index] = dict(row._overrides)
+            # Subrows not created yet have nothing assigned
+            if row._subrows is not None:
+                stack.extend(row._subrows.values())
+        return overrides
+
+class MappedRow:
+    """
+    Row of MappedBudgetTree with the attributes of DataObject, read from the mapped file on access.
+    Assigned attributes, such as muutos and amounts of filled rows set by rollup_totals(), are kept in the row.
+    Rows are pickled as file path and row index, so render workers map the file instead of copying rows.
+    """
+    __slots__ = ('_tree', '_index', '_subrows', '_overrides')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+        self._subrows = None
+        self._overrides = None
+
+    @property
+    def subrows(self):
+        if self._subrows is None:
+            self._subrows = self._tree.subrows(self._index)
+        return self._subrows
+
+    hallitus = DataObject.hallitus
+    lib = DataObject.lib
+    ero = DataObject.ero
+    eroPercent = DataObject.eroPercent
+
+    def __reduce__(self):
+        return (load_mapped_row, (self._tree.file_path, self._index, self._tree.overrides(self)))
+
+    def __repr__(self) -> str:
+        return 'MappedRow(%r, %d)' % (self._tree.file_path, self._index)
+
+def _mapped_attribute(name):
+    def get(row):
+        if row._overrides is not None and name in row._overrides:
+            return row._overrides[name]
+        return row._tree.read(name, row._index)
+
+    def set(row, value):
+        if row._overrides is None:
+            row._overrides = {}
+        row._overrides[name] = value
+    return property(get, set)
+
+def _unmapped_attribute(name):
+    def get(row):
+        return row._overrides.get(name) if row._overrides is not None else None
+
+    def set(row, value):
+        if row._overrides is None:
+            row._overrides = {}
+        row._overrides[name] = value
+    return property(get, set)
+
+for _name in DataObject.__slots__:
+    if _name in dict(TREE_CACHE_COLUMNS):
+        setattr(MappedRow, _name, _mapped_attribute(_name))
+    elif _name != '_subrows':
+        # Set per run, not stored in file
+        setattr(MappedRow, _name, _unmapped_attribute(_name))
+
+# Trees mapped by this process, by path
+_mapped_trees = {}
+
+def load_mapped_row(path, index, overrides=None) -> MappedRow:
+    """
+    Row of tree cache file at path, with assigned attributes of row and its subrows from overrides
+    """
+    tree = _mapped_trees.get(path)
+    if tree is None:
+        tree = _mapped_trees[path] = MappedBudgetTree(path)
+    row = MappedRow(tree, index)
+    if overrides:
+        stack = [row]
+        while stack:
+            subrow = stack.pop()
+            if subrow._index in overrides:
+                subrow._overrides = overrides[subrow._index]
+            stack.extend(subrow.subrows.values())
+    return row
+
+def missing_parent_row(path, child) -> DataObject:
+    """
+    Empty row at path for parent missing from sheet, named after child. Amounts are set by rollup_totals().
+    """
+    (paaluokka, menoluokka, momentti) = (path + ('', '', ''))[:3]
+    return DataObject(
+        tulo=child.tulo,
+        syvyys=len(path),
+        paaluokka=paaluokka,
+        paaluokka_selite=child.paaluokka_selite,
+        menoluokka=menoluokka,
+        menoluokka_selite=child.menoluokka_selite if len(path) >= 2 else '',
+        momentti=momentti,
+        momentti_selite=child.momentti_selite if len(path) >= 3 else '',
+        osoite='.'.join(path) + '.',
+        libLisays='lib' in path,
+        hallitus_cents=0,
+        lib_cents=0,
+        ero_cents=0,
+        ero_percent_bp=0,
+        perustelu='',
+        linkki='',
+    )
+
+@dataclass
+class TotalMismatch:
+    row: DataObject
+    column: str
+    sheet_cents: int
+    computed_cents: int
+
+# Amount columns summed up from subrows
+TOTAL_COLUMNS = ('hallitus_cents', 'lib_cents', 'ero_cents')
+
+def rollup_totals(tree) -> list[TotalMismatch]:
+    """
+    Sums amount columns of subrows up the tree in one pass, subrows before their parents.
+
+    Rows added by BudgetTree fill_missing get the sums as their amounts, other rows
+    with subrows are compared to them. Returns rows whose amounts differ from sums of their subrows.
+    """
+    filled = set(map(id, tree.filled))
+    mismatches = []
+    # Parents come before their subrows in walk(), so reversed order has subrows first
+    for row in reversed(list(tree.walk())):
+        if not row.subrows:
+            continue
+        sums = [0] * len(TOTAL_COLUMNS)
+        for subrow in row.subrows.values():
+            for i, column in enumerate(TOTAL_COLUMNS):
+                sums[i] += getattr(subrow, column)
+        if id(row) in filled:
+            for column, total in zip(TOTAL_COLUMNS, sums):
+                setattr(row, column, total)
+            if row.hallitus_cents:
+                row.ero_percent_bp = round(row.ero_cents * 10000 / row.hallitus_cents)
+            continue
+        for column, total in zip(TOTAL_COLUMNS, sums):
+            if getattr(row, column) != total:
+                mismatches.append(TotalMismatch(row, column, getattr(row, column), total))
+    profile_count('total_mismatches', len(mismatches))
+    return mismatches
+
+def print_total_mismatches(mismatches) -> None:
+    for mismatch in mismatches:
+        print("Row %r %s is %s, but its subrows sum up to %s" % (
+            mismatch.row.osoite, mismatch.column.replace('_cents', ''),
+            euros_cents(mismatch.sheet_cents), euros_cents(mismatch.computed_cents)))
+    if mismatches:
+        print("%d totals differ from sums of subrows" % len(mismatches))
+
+def row_selite(row) -> str:
+    """
+    Name of row at its own level
+    """
+    return (row.paaluokka_selite, row.menoluokka_selite, row.momentti_selite)[min(row.syvyys, 3) - 1]
+
+def tree_budget_nodes(tree) -> dict:
+    """
+    Rows of BudgetTree as dict of osoite path to (name, hallitus cents)
+    """
+    return {path: (row_selite(row), row.hallitus_cents) for path, row in tree.index.items()}
+
+def read_budget_nodes(path) -> dict:
+    """
+    Reads budget to compare to as dict of osoite path to (name, cents), name and cents None if file does not have them.
+
+    path is a budget tree .txt file (osoite values only), budjetti.vm.fi TAE CSV (names and amounts of momentit),
+    or CSV in sheet layout (hallitus amounts), told apart by extension and header row. A year such as "2023"
+    reads names and hallitus amounts of that year from history database instead, see BudgetHistory.
+    """
+    if path.isdecimal():
+        with open_budget_history() as history:
+            return history.nodes(int(path))
+    if path.endswith('.txt'):
+        year, osoitteet = read_budget_tree(path)
+        return {osoite_path(osoite): (None, None) for osoite in osoitteet}
+    header = next(iter(read_csv_rows(path)), [])
+    if header and header[0].strip().endswith('numero'):
+        nodes = {}
+        for (paaluokka, menoluokka, momentti), (name, amount) in read_tae_csv(path).items():
+            key = tuple(part for part in (paaluokka, menoluokka, momentti) if part)
+            nodes[key] = (name, None if amount is None else amount * 100)
+        return nodes
+    return tree_budget_nodes(sort_data(list(iter_data_objects(read_csv_rows(path)))))
+
+def normalize_budget_path(path) -> tuple:
+    """
+    Path for joining budgets, "01" and "1" are the same
+    """
+    return tuple(part.lstrip('0') or '0' if part.isdecimal() else part.lower() for part in path)
+
+def normalize_budget_name(name) -> str:
+    """
+    Name for matching renumbered rows, without osoite prefix, case or extra whitespace
+    """
+    return ' '.join(re.sub(r'^[\d.\s]+', '', name or '').lower().split())
+
+@dataclass
+class BudgetDiff:
+    # Paths in new budget only
+    added: list
+    # Paths in old budget only
+    removed: list
+    # (old path, new path) of rows with the same name at the same level, but different osoite
+    renumbered: list
+    # (path, old cents, new cents) of rows in both with different amount
+    changed: list
+
+    def summary(self) -> str:
+        return '%d added, %d removed, %d renumbered, %d amounts changed' % (
+            len(self.added), len(self.removed), len(self.renumbered), len(self.changed))
+
+def diff_budgets(old: dict, new: dict) -> BudgetDiff:
+    """
+    Compares budgets given as dicts of osoite path to (name, cents), like read_budget_nodes() returns.
+    Rows are joined on normalized osoite, and rows left over on both sides on level and name, all by hashing.
+    """
+    old_by_key = {normalize_budget_path(path): path for path in old}
+    new_by_key = {normalize_budget_path(path): path for path in new}
+
+    changed = []
+    for key, new_path in new_by_key.items():
+        old_path = old_by_key.get(key)
+        if old_path is None:
+            continue
+        old_cents = old[old_path][1]
+        new_cents = new[new_path][1]
+        if old_cents is not None and new_cents is not None and old_cents != new_cents:
+            changed.append((new_path, old_cents, new_cents))
+
+    removed = [path for key, path in old_by_key.items() if key not in new_by_key]
+    added = [path for key, path in new_by_key.items() if key not in old_by_key]
+
+    # Removed rows by level and name, only names appearing once can be matched
+    removed_by_name = {}
+    for path in removed:
+        name = normalize_budget_name(old[path][0])
+        if name:
+            key = (len(path), name)
+            removed_by_name[key] = None if key in removed_by_name else path
+    added_names = defaultdict(int)
+    for path in added:
+        added_names[(len(path), normalize_budget_name(new[path][0]))] += 1
+    renumbered = []
+    for path in added:
+        key = (len(path), normalize_budget_name(new[path][0]))
+        old_path = removed_by_name.get(key)
+        if old_path is not None and added_names[key] == 1:
+            renumbered.append((old_path, path))
+    moved_from = {old_path for old_path, new_path in renumbered}
+    moved_to = {new_path for old_path, new_path in renumbered}
+
+    return BudgetDiff(
+        added=[path for path in added if path not in moved_to],
+        removed=[path for path in removed if path not in moved_from],
+        renumbered=renumbered,
+        changed=changed,
+    )
+
+def mark_budget_changes(tree, diff: BudgetDiff) -> None:
+    """
+    Sets muutos of rows in tree added, renumbered or with changed amount, for highlighting them on page
+    """
+    for path in diff.added:
+        tree.index[path].muutos = ('uusi', 'Uusi')
+    for old_path, new_path in diff.renumbered:
+        tree.index[new_path].muutos = ('uudelleennumeroitu', 'Ennen %s.' % '.'.join(old_path))
+    for path, old_cents, new_cents in diff.changed:
+        tree.index[path].muutos = ('muuttunut', 'Hallituksen esitys ennen %s' % euros_cents(old_cents))
+
+def run_diff(args) -> None:
+    old = read_budget_nodes(args.old)
+    if args.new:
+        new = read_budget_nodes(args.new)
+    else:
+        data, summary = get_data(get_data_source_from_args(args), refresh=args.refresh)
+        if data is None:
+            print('No data found')
+            sys.exit(10)
+        new = tree_budget_nodes(sort_data(data))
+    diff = diff_budgets(old, new)
+    show = lambda path: '.'.join(path) + '.'
+    for path in diff.added:
+        print("+ %s %s" % (show(path), new[path][0] or ''))
+    for path in diff.removed:
+        print("- %s %s" % (show(path), old[path][0] or ''))
+    for old_path, new_path in diff.renumbered:
+        print("> %s -> %s %s" % (show(old_path), show(new_path), new[new_path][0] or ''))
+    for path, old_cents, new_cents in diff.changed:
+        print("~ %s %s -> %s" % (show(path), euros_cents(old_cents), euros_cents(new_cents)))
+    print(diff.summary())
+
+# Bump when history database tables change, older databases must be ingested again
+HISTORY_SCHEMA_VERSION = 1
+
+# Amount columns of history database
+HISTORY_AMOUNTS = ('hallitus_cents', 'lib_cents', 'toteutuma_cents')
+
+def budget_side(path) -> str:
+    """
+    'tulo' or 'meno' of osoite path in budget files without tulo column, tulot are paaluokat 11-19
+    """
+    return 'tulo' if path[0].isdecimal() and int(path[0]) < 20 else 'meno'
+
+def row_side(row) -> str:
+    return 'tulo' if row.tulo else 'meno'
+
+def path_osoite(path) -> str:
+    """
+    Osoite of path as stored in history database, ('11', '01') to "11.01."
+    """
+    return '.'.join(path) + '.'
+
+class BudgetHistory:
+    """
+    SQLite database of budgets of different years, filled with ingest command.
 
-    return percent_value
+    Each row is a paaluokka, menoluokka or momentti of one year, keyed and indexed by year, side ('tulo' or 'meno')
+    and osoite. Files of the same year fill in each other's columns, e.g. names and hallitus amounts from TAE CSV
+    and lib amounts from the sheet.
+    """
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self._create_tables()
+
+    def _create_tables(self) -> None:
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version == HISTORY_SCHEMA_VERSION:
+            return
+        if version != 0:
+            raise ValueError("History database %s has schema version %d, expected %d, ingest budgets to a new database"
+                             % (self.path, version, HISTORY_SCHEMA_VERSION))
+        self.connection.executescript("""
+            CREATE TABLE momentit (
+                year INTEGER NOT NULL,
+                side TEXT NOT NULL,
+                osoite TEXT NOT NULL,
+                syvyys INTEGER NOT NULL,
+                nimi TEXT,
+                hallitus_cents INTEGER,
+                lib_cents INTEGER,
+                toteutuma_cents INTEGER,
+                PRIMARY KEY (year, side, osoite)
+            ) WITHOUT ROWID;
+            -- Same momentti over years
+            CREATE INDEX momentit_osoite ON momentit (osoite, year);
+            PRAGMA user_version = %d;
+        """ % HISTORY_SCHEMA_VERSION)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def ingest(self, records) -> int:
+        """
+        Adds (year, side, path, name, amounts) records, amounts is a dict of HISTORY_AMOUNTS columns to cents.
+        Existing rows are updated, None name or missing amounts keep their earlier values. Returns number of records.
+        """
+        rows = [(year, side, path_osoite(path), len(path), name,
+                 amounts.get('hallitus_cents'), amounts.get('lib_cents'), amounts.get('toteutuma_cents'))
+                for year, side, path, name, amounts in records]
+        with self.connection:
+            self.connection.executemany("""
+                INSERT INTO momentit (year, side, osoite, syvyys, nimi, hallitus_cents, lib_cents, toteutuma_cents)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (year, side, osoite) DO UPDATE SET
+                    nimi = COALESCE(excluded.nimi, nimi),
+                    hallitus_cents = COALESCE(excluded.hallitus_cents, hallitus_cents),
+                    lib_cents = COALESCE(excluded.lib_cents, lib_cents),
+                    toteutuma_cents = COALESCE(excluded.toteutuma_cents, toteutuma_cents)
+            """, rows)
+        return len(rows)
+
+    def years(self) -> list:
+        """
+        (year, rows) pairs of years in database
+        """
+        return [tuple(row) for row in self.connection.execute(
+            'SELECT year, COUNT(*) FROM momentit GROUP BY year ORDER BY year')]
+
+    def momentit(self, year, side=None) -> list:
+        """
+        Rows of year as sqlite3.Row objects, optionally only given side
+        """
+        if side is None:
+            return self.connection.execute('SELECT * FROM momentit WHERE year = ?', (year,)).fetchall()
+        return self.connection.execute('SELECT * FROM momentit WHERE year = ? AND side = ?', (year, side)).fetchall()
+
+    def nodes(self, year) -> dict:
+        """
+        Rows of year as dict of osoite path to (name, hallitus cents), like read_budget_nodes()
+        """
+        return {osoite_path(row['osoite']): (row['nimi'], row['hallitus_cents']) for row in self.momentit(year)}
+
+    def amounts(self, year, column) -> dict:
+        """
+        Amounts of year in one of HISTORY_AMOUNTS columns as dict of (side, osoite) to cents, rows without amount left out
+        """
+        if column not in HISTORY_AMOUNTS:
+            raise ValueError("Unknown amount column %s" % column)
+        return {(side, osoite): cents for side, osoite, cents in self.connection.execute(
+            'SELECT side, osoite, %s FROM momentit WHERE year = ? AND %s IS NOT NULL' % (column, column), (year,))}
+
+def open_budget_history(path=None):
+    """
+    Opens history database for reading, exits if it has not been created with ingest command
+    """
+    path = path or HISTORY_DATABASE
+    if not os.path.exists(path):
+        print("History database %s not found, load budgets to it with ingest command" % path)
+        sys.exit(1)
+    return contextlib.closing(BudgetHistory(path))
 
-def sort_data(data: list[DataObject]) -> dict:
+def budget_file_year(path):
     """
-    Groups dataRows based on their common paaluokka and menoluokka numbers
-    
-    Returns
-        dict of top level rows, other rows inserted into subrows dicts inside each row object
+    Year in budget file name such as "yhdistelmä budjetti TAE 2024.csv", None if there is none
     """
-    # XXX Initial sort required, as we want to first assign top level rows to dict, then second level and finally third level
-    initial_sort = sorted(data, key=lambda row:(row.syvyys, row.paaluokka, row.menoluokka, row.momentti))
+    years = re.findall(r'(?<!\d)(20\d\d)(?!\d)', os.path.basename(path))
+    return int(years[-1]) if years else None
 
-    tempDict = {}
-    sorted_count = 0
+def tree_history_records(tree, year) -> list:
+    """
+    Rows of BudgetTree as history records with names, hallitus and lib amounts
+    """
+    return [(year, row_side(row), path, row_selite(row), {'hallitus_cents': row.hallitus_cents, 'lib_cents': row.lib_cents})
+            for path, row in tree.index.items()]
 
-    for row in initial_sort:
-        # Skip suspicious rows -> 
-        if not validate_syvyys(row):
+def read_tae_history(path, year) -> list:
+    """
+    budjetti.vm.fi TAE CSV as history records: names and määräraha of year as hallitus amounts, and toteutuma of
+    earlier years from "Toteutuma YYYY" columns. Paaluokka and menoluokka amounts are sums of their momentit.
+    """
+    rows = iter(read_csv_rows(path))
+    header = next(rows, [])
+    # Column index to (year, amount column)
+    columns = {7: (year, 'hallitus_cents')}
+    for index, name in enumerate(header):
+        match = re.fullmatch(r'Toteutuma (\d{4})', name.strip())
+        if match:
+            columns[index] = (int(match.group(1)), 'toteutuma_cents')
+
+    names = {}
+    # (year, path) to amounts
+    amounts = defaultdict(dict)
+    for row in rows:
+        if len(row) < 6 or not row[0].isdigit():
+            # Section header rows
             continue
+        momentti = (row[0], row[2], row[4])
+        for depth, name in enumerate((row[1], row[3], row[5]), start=1):
+            names[momentti[:depth]] = name
+        for index, (column_year, column) in columns.items():
+            cell = row_cell(row, index).strip()
+            if not cell:
+                continue
+            try:
+                cents = parse_amount_cents(cell)
+            except ValueError:
+                print("Invalid amount %r in %s column %s of %s" % (cell, path, header[index], '.'.join(momentti)))
+                continue
+            for depth in (1, 2, 3):
+                values = amounts[(column_year, momentti[:depth])]
+                values[column] = values.get(column, 0) + cents
 
-        #print("Sorted a row %s" % row.osoite)
+    records = [(year, budget_side(node), node, name, amounts.get((year, node), {})) for node, name in names.items()]
+    records += [(column_year, budget_side(node), node, None, values)
+                for (column_year, node), values in amounts.items() if column_year != year]
+    return records
 
-        if row.syvyys == 3:
-            if row.paaluokka not in tempDict:
-                print("Unknown paaluokka in row with syvyys 3. Implementation error")
-                print("%r" % row)
-                sys.exit(2)
-            else:  
-                if row.menoluokka not in tempDict[row.paaluokka].subrows:
-                    print("Unknown menoluokka %r in paaluokka %r in row with syvyys 3. Implementation error" % (row.menoluokka, row.paaluokka))
-                    print("%r" % row)
-                    print("%r" % tempDict[row.paaluokka].subrows)
+def read_history_records(path, year=None) -> list:
+    """
+    Budget file as history records for BudgetHistory.ingest(), file types as in read_budget_nodes().
+    Year defaults to year in budget tree title or file name.
+    """
+    if path.endswith('.txt'):
+        title_year, osoitteet = read_budget_tree(path)
+        year = year or (int(title_year) if title_year.isdecimal() else budget_file_year(path))
+        paths = {osoite_path(osoite) for osoite in osoitteet}
+        return [(year, budget_side(path), path, None, {}) for path in paths]
+    year = year or budget_file_year(path)
+    if year is None:
+        raise ValueError("Year of %s not known, give it with --year" % path)
+    header = next(iter(read_csv_rows(path)), [])
+    if header and header[0].strip().endswith('numero'):
+        return read_tae_history(path, year)
+    return tree_history_records(sort_data(list(iter_data_objects(read_csv_rows(path)))), year)
+
+def run_ingest(args) -> None:
+    with contextlib.closing(BudgetHistory(args.database or HISTORY_DATABASE)) as history:
+        if args.files:
+            for path in args.files:
+                try:
+                    records = read_history_records(path, args.year)
+                except ValueError as e:
+                    print(e)
                     sys.exit(2)
-                else:
-                    tempDict[row.paaluokka].subrows[row.menoluokka].subrows[row.momentti] = row
-                    sorted_count += 1
-        elif row.syvyys == 2:
-            if row.paaluokka not in tempDict:
-                print("Unknown paaluokka in row with syvyys 2. Unable to find paaluokka %r. Implementation error?" % row.paaluokka)
-                print("Known paaluokka values:")
-                for paaluokkaRow in tempDict.values():
-                    print("%r" % paaluokkaRow.paaluokka)
-                print("%r" % row)
-                sys.exit(2)
-            else:
-                tempDict[row.paaluokka].subrows[row.menoluokka] = row
-                sorted_count += 1
-        elif row.syvyys == 1:
-            tempDict[row.paaluokka] = row            
-            sorted_count += 1
+                print("Ingested %d rows from %s" % (history.ingest(records), path))
         else:
-            print("Unexpected syvyys value %r, don't know what to do!" % row.syvyys)
-
-    print("Sorted data contains %d rows" % sorted_count)
-    
-    return tempDict
+            if args.year is None:
+                print("Give year of budget in data source with --year")
+                sys.exit(2)
+            data, summary = get_data(get_data_source_from_args(args), refresh=args.refresh)
+            if data is None:
+                print('No data found')
+                sys.exit(10)
+            count = history.ingest(tree_history_records(sort_data(data), args.year))
+            print("Ingested %d rows from data source" % count)
+        for year, count in history.years():
+            print("%d: %d rows" % (year, count))
+
+def add_toteutuma(tree, amounts) -> int:
+    """
+    Sets toteutuma_cents of rows in tree from dict of (side, osoite) to cents, see BudgetHistory.amounts().
+    Returns number of rows found.
+    """
+    found = 0
+    for path, row in tree.index.items():
+        row.toteutuma_cents = amounts.get((row_side(row), path_osoite(path)))
+        found += row.toteutuma_cents is not None
+    return found
 
 def validate_syvyys(row) -> bool:
     """
@@ -591,74 +2747,565 @@ def print_sorted_data(dataDict) -> None:
             for subsubrow in subrow.subrows.values():
                 print("%r %r %r subrows" % (subsubrow.osoite, subsubrow.momentti_selite, len(subsubrow.subrows)))
 
+class WordPressClient:
+    """
+    Wordpress REST API client
+
+    Uses one pooled requests.Session for all requests, so connections are reused.
+    Requests failing due connection errors, timeouts, 429 or 5xx are retried with jittered exponential backoff.
+    Request bodies are gzip compressed if compress is set. If server then responds 400 or 415,
+    compression is turned off and request is sent again uncompressed.
+    Streamed request bodies are sent chunked if stream is set. If server responds 411 or 501,
+    streaming is turned off and body is sent again in one piece.
+    """
+    RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+    MAX_BACKOFF = 30.0
+
+    def __init__(self, url, username, app_password, timeout=60, retries=4, backoff=1.0, compress=False, stream=True):
+        import requests
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.compress = compress
+        self.stream = stream
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Authorization': requests.auth._basic_auth_str(username, app_password)
+        })
+
+    def endpoint(self, path) -> str:
+        return f'{self.url}/wp-json/wp/v2/{path}'
+
+    def request(self, method, path, params=None, json_data=None, retry=True, json_stream=None):
+        """
+        Sends request, retrying as needed. Returns last response, or None if no response was received.
+        Requests which are not safe to repeat, such as creating a page, should be sent with retry=False.
+        json_stream is an alternative to json_data, a function returning json body as iterable of bytes.
+        It is called again for each attempt.
+        """
+        import requests
+        retries = self.retries if retry else 0
+        url = self.endpoint(path)
+        body = None
+        headers = {}
+        if json_data is not None:
+            body = json.dumps(json_data).encode('utf-8')
+            headers['Content-Type'] = 'application/json'
+        if json_stream is not None:
+            headers['Content-Type'] = 'application/json'
+
+        attempt = 0
+        while True:
+            if json_stream is not None and not self.stream:
+                body = b''.join(json_stream())
+                json_stream = None
+            compressed = self.compress and (body is not None or json_stream is not None)
+            request_headers = dict(headers)
+            request_body = body
+            if json_stream is not None:
+                chunks = json_stream()
+                if compressed:
+                    chunks = gzip_chunks(chunks)
+                    request_headers['Content-Encoding'] = 'gzip'
+                request_body = counted_chunks(chunks)
+            elif compressed:
+                request_body = gzip.compress(body)
+                request_headers['Content-Encoding'] = 'gzip'
+
+            profile_count('requests')
+            if json_stream is None:
+                profile_count('bytes_sent', len(request_body or b''))
+            try:
+                response = self.session.request(method, url, params=params, data=request_body,
+                                                headers=request_headers, timeout=self.timeout)
+                profile_count('bytes_received', len(response.content))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    print(f"{method} {url} failed due {e!r}, giving up after {attempt + 1} attempts")
+                    return None
+                self.sleep_before_retry(attempt, None)
+                attempt += 1
+                continue
+
+            if json_stream is not None and response.status_code in (411, 501):
+                print(f"{self.url} does not accept chunked requests, sending in one piece")
+                self.stream = False
+                continue
+
+            if compressed and response.status_code in (400, 415):
+                print(f"{self.url} does not accept compressed requests, sending uncompressed")
+                self.compress = False
+                continue
+
+            if response.status_code in self.RETRY_STATUS_CODES and attempt < retries:
+                print(f"{method} {url} returned {response.status_code}, retrying")
+                self.sleep_before_retry(attempt, response.headers.get('Retry-After'))
+                attempt += 1
+                continue
+
+            return response
+
+    def sleep_before_retry(self, attempt, retry_after) -> None:
+        delay = None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                # HTTP-date format is not worth parsing here, use backoff
+                pass
+        if delay is None:
+            # Full jitter, so parallel runs do not retry in sync
+            delay = random.uniform(0, self.backoff * (2 ** attempt))
+        time.sleep(min(delay, self.MAX_BACKOFF))
+
+    def update_page(self, page_id, content):
+        """
+        Update content to Wordpress page. content is html, or RenderedPage which is streamed from its file.
+
+        Note: Page must be saved in "Classic editor" mode for REST api pushed content to be visible
+              If page is saved using "Advanced Layout Editor" active, the will have completly different content
+        """
+        print(f'Writing to {self.endpoint(f"pages/{page_id}")}')
+
+        if isinstance(content, RenderedPage):
+            response = self.request('POST', f'pages/{page_id}', json_stream=content.iter_json)
+        else:
+            # Page data
+            page_data = {
+                'content': content
+            }
+            response = self.request('POST', f'pages/{page_id}', json_data=page_data)
+
+        if response is not None and response.status_code == 200:
+            print("Page updated successfully!")
+            return response.json()
+        elif response is not None:
+            print(f"Failed to update the page. Status code: {response.status_code}")
+            print(f"Error: {response}")
+        return None
+
+    def create_page(self, title, content, slug=None, parent=None, status='draft'):
+        """
+        Creates new page, returns it or None if creating failed
+        """
+        page_data = {
+            'title': title,
+            'content': content,
+            'status': status
+        }
+        if slug:
+            page_data['slug'] = slug
+        if parent:
+            page_data['parent'] = parent
+        print(f'Creating page {title!r} to {self.endpoint("pages")}')
+        response = self.request('POST', 'pages', json_data=page_data, retry=False)
+
+        if response is not None and response.status_code == 201:
+            return response.json()
+        elif response is not None:
+            print(f"Failed to create the page. Status code: {response.status_code}")
+        return None
+
+    def get_page(self, page_id, context=None):
+        """
+        Gets page content
+        Note that content and title are returned as "rendered" (i.e. different than wordpress editor shows with shortcodes etc)
+        With context='edit' content is returned also as "raw", i.e. as it was posted
+        Note that password protected pages can be returned as empty content
+        Note that hidden pages can return 401
+        """
+        params = {}
+        if context:
+            params['context'] = context
+        response = self.request('GET', f'pages/{page_id}', params=params)
+
+        if response is not None and response.status_code == 200:
+            return response.json()
+        elif response is not None:
+            print(f"Failed to get the page {page_id}. Status code: {response.status_code}")
+        return None
+
+    def get_pages(self, params=None, per_page=100):
+        """
+        Gets all pages matching params, following pagination
+        """
+        pages = []
+        page_number = 1
+        while True:
+            page_params = dict(params or {})
+            page_params.update({'per_page': per_page, 'page': page_number})
+            response = self.request('GET', 'pages', params=page_params)
+            if response is None or response.status_code != 200:
+                if response is not None:
+                    print(f"Failed to get the pages. Status code: {response.status_code}")
+                return None
+            pages.extend(response.json())
+            total_pages = int(response.headers.get('X-WP-TotalPages', 1))
+            if page_number >= total_pages:
+                return pages
+            page_number += 1
+
+def gzip_chunks(chunks):
+    """
+    gzip compresses iterable of bytes as it is consumed
+    """
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def counted_chunks(chunks):
+    """
+    Passes chunks of request body through, counting sent bytes
+    """
+    for chunk in chunks:
+        profile_count('bytes_sent', len(chunk))
+        yield chunk
+
+_wordpress_clients = {}
+_wordpress_clients_lock = threading.Lock()
+
+def get_wordpress_client(url=None) -> WordPressClient:
+    """
+    Client for url, by default WORDPRESS_URL. Created on first use, one client per site.
+    """
+    if url is None:
+        url = WORDPRESS_URL
+    url = url.rstrip('/')
+    with _wordpress_clients_lock:
+        if url not in _wordpress_clients:
+            username, app_password = get_wordpress_credentials(url)
+            _wordpress_clients[url] = WordPressClient(url, username, app_password,
+                                                      timeout=WORDPRESS_TIMEOUT, retries=WORDPRESS_RETRIES,
+                                                      compress=WORDPRESS_COMPRESS, stream=WORDPRESS_STREAM)
+        return _wordpress_clients[url]
+
+def get_wordpress_credentials(url) -> (str, str):
+    """
+    Credentials for site from WORDPRESS_AUTHENTICATION_FILE section named by site url,
+    defaults to [wordpress] section
+    """
+    wpconfig = load_wordpress_secrets()
+    section = url if wpconfig.has_section(url) else 'wordpress'
+    try:
+        return (wpconfig.get(section, 'USERNAME'), wpconfig.get(section, 'APP_PASSWORD'))
+    except (configparser.NoOptionError, configparser.NoSectionError) as e:
+        print("Mandatory config key missing, please review %s. %r" % (WORDPRESS_AUTHENTICATION_FILE, e))
+        sys.exit(1)
+
 def update_wordpress_page(page_id, content):
+    return get_wordpress_client().update_page(page_id, content)
+
+def get_wordpress_page(page_id, context=None):
+    return get_wordpress_client().get_page(page_id, context=context)
+
+def get_publish_targets() -> list:
+    """
+    Returns list of (url, page_id) tuples from TARGETS, or PAGE_ID at WORDPRESS_URL if TARGETS is not set
     """
-    Update content to Wordpress page
+    if not WORDPRESS_URL or (PAGE_ID is None and not WORDPRESS_TARGETS.strip()):
+        print("Mandatory config key missing, please review %s. [wordpress] WORDPRESS_URL and PAGE_ID" % config_path)
+        sys.exit(1)
+    targets = []
+    for line in WORDPRESS_TARGETS.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            if len(parts) == 1:
+                targets.append((WORDPRESS_URL, int(parts[0])))
+            elif len(parts) == 2:
+                targets.append((parts[0], int(parts[1])))
+            else:
+                raise ValueError(line)
+        except ValueError:
+            print("Invalid publish target %r, expected PAGE_ID or URL PAGE_ID, please review %s" % (line, config_path))
+            sys.exit(1)
+    if not targets:
+        targets.append((WORDPRESS_URL, PAGE_ID))
+    return targets
+
+def publish_to_targets(targets, publish) -> dict:
+    """
+    Calls publish(client, page_id) for all targets concurrently. A failing target does not stop others.
 
-    Note: Page must be saved in "Classic editor" mode for REST api pushed content to be visible
-          If page is saved using "Advanced Layout Editor" active, the will have completly different content
+    Returns dict of (url, page_id) to publish status, None for failed targets
     """
-    # Endpoint URL for updating a page
-    endpoint = f'{WORDPRESS_URL}/wp-json/wp/v2/pages/{page_id}'
-    
-    print(f'Writing to {endpoint}')
+    from concurrent.futures import ThreadPoolExecutor
+    def publish_target(target):
+        url, page_id = target
+        try:
+            return publish(get_wordpress_client(url), page_id)
+        except Exception as e:
+            print(f"Publishing to {url} page {page_id} failed due {e!r}")
+            return None
 
-    # Page data
-    page_data = {
-        'content': content
-    }
-    response = requests.post(endpoint, headers=HEADERS, json=page_data)
-    
-    if response.status_code == 200:
-        print("Page updated successfully!")
-        return response.json()
-    else:
-        print(f"Failed to update the page. Status code: {response.status_code}")
-        print(f"Error: {response}")
-        return None
+    with ThreadPoolExecutor(max_workers=max(1, min(PUBLISH_WORKERS, len(targets)))) as executor:
+        statuses = list(executor.map(publish_target, targets))
+    return dict(zip(targets, statuses))
 
-def get_wordpress_page(page_id):
+@profiled
+def publish_sharded(client, page_id, data, summary, shards, force=False, lazy_tables=False):
     """
-    Gets page content
-    Note that content and title are returned as "rendered" (i.e. different than wordpress editor shows with shortcodes etc)
-    Note that password protected pages can be returned as empty content
-    Note that hidden pages can return 401
+    Publishes each paaluokka in shards to a child page of page_id, and index page linking to them to page_id
+
+    Child pages are found by slug among page_id children, missing ones are created with the same status as page_id.
+    Returns 'updated' if any page was updated, 'unchanged' if none was, None if any page failed
     """
-    endpoint = f'{WORDPRESS_URL}/wp-json/wp/v2/pages/{page_id}'
-    response = requests.get(endpoint, headers=HEADERS)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Failed to get the page {page_id}. Status code: {response.status_code}")
+    from concurrent.futures import ThreadPoolExecutor
+    parent = client.get_page(page_id, context='edit')
+    if parent is None:
+        return None
+    # Without status only published pages are listed, children of unpublished parent would be created again
+    children = client.get_pages({'parent': page_id, 'context': 'edit', '_fields': 'id,slug,link',
+                                 'status': 'publish,future,draft,pending,private'})
+    if children is None:
+        return None
+    children_by_slug = {child['slug']: child for child in children}
+
+    def publish_shard(slug):
+        row, shard_html = shards[slug]
+        child = children_by_slug.get(slug)
+        if child is None:
+            title = row.osoite + " " + row.paaluokka_selite
+            child = client.create_page(title, shard_html, slug=slug, parent=page_id, status=parent.get('status', 'draft'))
+            if child is None:
+                return (slug, None, None)
+            record_published(f'{client.url}/pages/{child["id"]}', {
+                'hash': content_hash(shard_html),
+                'modified': child.get('modified')
+            })
+            return (slug, child['link'], 'updated')
+        status = publish_page(child['id'], shard_html, force=force, client=client)
+        return (slug, child['link'], status)
+
+    with ThreadPoolExecutor(max_workers=max(1, PUBLISH_WORKERS)) as executor:
+        results = list(executor.map(publish_shard, shards.keys()))
+
+    statuses = [status for slug, link, status in results]
+    links = {shards[slug][0].osoite: link for slug, link, status in results if link}
+    statuses.append(publish_page(page_id, generate_html(data, summary, links=links, lazy_tables=lazy_tables), force=force, client=client))
+
+    if None in statuses:
         return None
+    if 'updated' in statuses:
+        return 'updated'
+    return 'unchanged'
 
-def get_wordpress_pages():
-    endpoint = f'{WORDPRESS_URL}/wp-json/wp/v2/pages'
-    response = requests.get(endpoint, headers=HEADERS)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Failed to get the pages. Status code: {response.status_code}")
+@profiled
+def publish_page(page_id, content, force=False, client=None):
+    """
+    Updates Wordpress page, unless the page already has the same content. content is html or RenderedPage.
+
+    Last published content hash is kept in PUBLISH_MANIFEST. If page is not in manifest,
+    live page content is read once and compared instead.
+    Returns 'updated', 'unchanged' or None if update failed
+    """
+    if client is None:
+        client = get_wordpress_client()
+    digest = content.digest if isinstance(content, RenderedPage) else content_hash(content)
+    key = f'{client.url}/pages/{page_id}'
+    published = None
+
+    if not force:
+        published = load_publish_manifest().get(key)
+        if published is None:
+            page = client.get_page(page_id, context='edit')
+            if page is not None and 'raw' in page.get('content', {}):
+                published = {
+                    'hash': content_hash(page['content']['raw']),
+                    'modified': page.get('modified')
+                }
+                record_published(key, published)
+        if published is not None and published.get('hash') == digest:
+            print(f"Page {page_id} at {client.url} content unchanged, skipping update")
+            profile_count('skipped_updates')
+            return 'unchanged'
+
+    response = client.update_page(page_id, content)
+    if response is None:
         return None
+    raw = (response.get('content') or {}).get('raw')
+    if raw is not None and content_hash(raw) != digest:
+        # Some servers accept chunked requests but give Wordpress an empty body, which it answers with the old page
+        if not raw or (published is not None and content_hash(raw) == published.get('hash')):
+            print(f"Page {page_id} at {client.url} content was not updated, update did not go through")
+            return None
+        # Otherwise Wordpress changed content when saving, e.g. removed scripts for users without unfiltered_html
+        print(f"Warning: Page {page_id} at {client.url} content was changed by Wordpress when saving")
+
+    record_published(key, {
+        'hash': digest,
+        'modified': response.get('modified')
+    })
+    return 'updated'
+
+# Release version stamp added by generate_html(), changes on every run
+VERSION_STAMP_PATTERN = re.compile(r'<span style="font-size: 10pt;">Sivun versio: [^<]*</span>')
+# Start of version stamp, and rest of stamp which may still continue in the next chunk, see strip_version_stamps()
+VERSION_STAMP_START = '<span style="font-size: 10pt;">Sivun versio: '
+_VERSION_STAMP_REST = re.compile(r'[^<]*(?:<(?:/(?:s(?:p(?:a(?:n)?)?)?)?)?)?\Z')
+
+def content_hash(content: str) -> str:
+    """
+    sha256 of page content, ignoring "Sivun versio" stamp
+    """
+    content = VERSION_STAMP_PATTERN.sub('', content)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def strip_version_stamps(chunks):
+    """
+    Yields text of chunks with version stamps removed like content_hash() does, also stamps split between chunks
+    """
+    pending = ''
+    for chunk in chunks:
+        pending = VERSION_STAMP_PATTERN.sub('', pending + chunk)
+        keep = version_stamp_tail(pending)
+        yield pending[:len(pending) - keep]
+        pending = pending[len(pending) - keep:]
+    yield pending
+
+def version_stamp_tail(text) -> int:
+    """
+    Length of end of text which may be the beginning of a version stamp
+    """
+    start = text.rfind(VERSION_STAMP_START)
+    if start >= 0 and _VERSION_STAMP_REST.match(text, start + len(VERSION_STAMP_START)):
+        return len(text) - start
+    for length in range(min(len(VERSION_STAMP_START) - 1, len(text)), 0, -1):
+        if text.endswith(VERSION_STAMP_START[:length]):
+            return length
+    return 0
+
+# Characters read from html file at a time when uploading it
+STREAM_CHUNK_SIZE = 64 * 1024
+
+class RenderedPage:
+    """
+    Page html written to a file by write_html(), with its content_hash() and size in bytes.
+    Html is read back from the file in chunks, so the whole page does not need to be in memory.
+
+    Upload reads the file again instead of taking chunks from the renderer as they come: digest is needed
+    before uploading to skip unchanged pages, and the body is sent again on retries, to each target
+    and in one piece to servers not accepting chunked requests.
+    """
+    def __init__(self, path, digest, size):
+        self.path = path
+        self.digest = digest
+        self.size = size
+
+    def iter_chunks(self):
+        with open(self.path, 'r', encoding='utf-8', newline='') as file:
+            while True:
+                chunk = file.read(STREAM_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+
+    def iter_json(self):
+        """
+        Page update request body, same bytes as json.dumps({'content': html}).encode('utf-8')
+        """
+        yield b'{"content": "'
+        for chunk in self.iter_chunks():
+            # json string without its quotes
+            yield json.dumps(chunk)[1:-1].encode('utf-8')
+        yield b'"}'
+
+def write_html(chunks, path) -> RenderedPage:
+    """
+    Writes html chunks to file as they are generated, hashing them on the way like content_hash().
+    Page is uploaded from the file afterwards, see RenderedPage.
+    """
+    digest = hashlib.sha256()
+    size = 0
+
+    def written(file):
+        nonlocal size
+        for chunk in chunks:
+            encoded = chunk.encode('utf-8')
+            file.write(encoded)
+            size += len(encoded)
+            yield chunk
+
+    with open(path, 'wb') as file:
+        for text in strip_version_stamps(written(file)):
+            digest.update(text.encode('utf-8'))
+    return RenderedPage(path, digest.hexdigest(), size)
+
+def load_publish_manifest() -> dict:
+    if not os.path.exists(PUBLISH_MANIFEST):
+        return {}
+    try:
+        with open(PUBLISH_MANIFEST, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except ValueError as e:
+        print("Ignoring unreadable publish manifest %s due %r" % (PUBLISH_MANIFEST, e))
+        return {}
+
+# Targets are published from several threads, manifest updates must not overwrite each other
+_publish_manifest_lock = threading.Lock()
+
+def record_published(key, entry: dict) -> None:
+    with _publish_manifest_lock:
+        manifest = load_publish_manifest()
+        manifest[key] = entry
+        save_publish_manifest(manifest)
+
+def save_publish_manifest(manifest: dict) -> None:
+    temp_path = PUBLISH_MANIFEST + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    os.replace(temp_path, PUBLISH_MANIFEST)
+
+def get_wordpress_pages(params=None):
+    return get_wordpress_client().get_pages(params)
+
+# Thousands separator, non-breaking space as in Finnish locale
+EUROS_GROUPING = '\xa0'
+# Formatted amounts kept in memory, many amounts repeat across rows and pages
+EUROS_CACHE_SIZE = 8192
 
 def euros(number) -> str:
     """
-    Format currency
-    """
-    formatted = locale.currency(number, grouping=True, symbol=False)
-    # Remove empty cents
-    formatted = formatted.replace(",00", '')
-    # FIXME: locale.setlocale on mac
-    # XXX mac insists on using . as thousands separator. As we do not use decimal precision in euros, we can just replace . with correct thousands separator
-    formatted = formatted.replace(".", ' ')
-    # XXX and does something weird with -, by placing it at end of the number
-    formatted = formatted.replace("-", '')
-    if (number < 0):
-        formatted = "-" + formatted
-    formatted += ' €'
-    return formatted
+    Format currency in Finnish format without locale, e.g. "-1 234 567 €", cents only if there are any
+    """
+    return euros_cents(to_cents(number))
+
+@functools.lru_cache(maxsize=EUROS_CACHE_SIZE)
+def euros_cents(cents: int) -> str:
+    """
+    Format int cents like euros()
+    """
+    whole, fraction = divmod(abs(cents), 100)
+    formatted = f'{whole:,}'.replace(',', EUROS_GROUPING)
+    if fraction:
+        formatted += ',%02d' % fraction
+    if cents < 0:
+        formatted = '-' + formatted
+    return formatted + ' €'
+
+def euros_column(cents_values) -> list:
+    """
+    Format column of int cents like euros(), each distinct amount once
+    """
+    formatted = {cents: euros_cents(cents) for cents in set(cents_values)}
+    return [formatted[cents] for cents in cents_values]
+
+def euros_columns(rows) -> tuple:
+    """
+    Formatted hallitus, lib and ero columns of rows
+    """
+    rows = list(rows)
+    return (euros_column([row.hallitus_cents for row in rows]),
+            euros_column([row.lib_cents for row in rows]),
+            euros_column([row.ero_cents for row in rows]))
 
 def calc_saastoja_percent(hallitus, lib):
     percentage = 100 - (lib/hallitus) * 100
@@ -666,47 +3313,100 @@ def calc_saastoja_percent(hallitus, lib):
     rounded = abs(max(rounded, 1))
     return rounded
 
-def generate_html(data, summary) -> str:
+@profiled
+def generate_html(data, summary, links=None, lazy_tables=False) -> str:
+    """
+    Whole page. If links to paaluokka pages are given, tables link to them instead of being included.
+    With lazy_tables level 2 tables are included as json and rendered in browser.
+    """
+    return ''.join(iter_html(data, summary, links, lazy_tables))
 
-    doc, tag, text = Doc().tagtext()
-    doc.asis(generate_intro())
+def iter_html(data, summary, links=None, lazy_tables=False):
+    """
+    generate_html() as chunks, each section is yielded as soon as it is generated
+    """
+    yield generate_intro()
     
-    doc.asis(generate_mediassa_2024())
+    yield generate_mediassa_2024()
 
-    doc.asis(generate_budjetti_title())
-    doc.asis(generate_summary(data, summary))
-    doc.asis(generate_menot_summary(data))
-    doc.asis(generate_aiheipiireittain(data))
+    yield generate_budjetti_title()
+    yield generate_summary(data, summary)
+    yield generate_menot_summary(data)
+    yield generate_aiheipiireittain(data)
 
     
     # Too broad to be useful
-    #doc.asis(generate_tulot_summary(data))
+    #yield generate_tulot_summary(data)
 
-    with tag('div', klass='main_color av_default_container_wrap container_wrap fullsize'):
-        with tag('div', klass='template-page content  av-content-full alpha units'):
-            with tag('div', klass='entry-content-wrapper clearfix'):
-                with tag('div', klass='flex_column av_one_full  flex_column_div av-zero-column-padding first  avia-builder-el-56  el_after_av_layout_row  el_before_av_one_full  avia-builder-el-first  '):                        
-                    #doc.asis(generate_budjetti_title())
-                    doc.asis(generate_tulot(data))
-                    doc.asis(generate_menot(data))
-
-    doc.asis(generate_taulukkolinkki())
-    doc.asis(generate_naamat())
-    doc.asis(generate_outro())
-
-    doc.asis(generate_2023())
-    doc.asis(generate_mediassa_2023())
-        
-    doc.asis(generate_js())
-    doc.asis("""<div style="height:50px" class="hr hr-invisible   avia-builder-el-115  el_after_av_hr  avia-builder-el-last "><span class="hr-inner "><span class="hr-inner-style"></span></span></div></div>""")
-
-    # Generate release version
+    yield ('<div class="main_color av_default_container_wrap container_wrap fullsize">'
+           '<div class="template-page content  av-content-full alpha units">'
+           '<div class="entry-content-wrapper clearfix">'
+           '<div class="flex_column av_one_full  flex_column_div av-zero-column-padding first  avia-builder-el-56  el_after_av_layout_row  el_before_av_one_full  avia-builder-el-first  ">')
+    #yield generate_budjetti_title()
+    yield from iter_tulot(data, links, lazy_tables)
+    yield from iter_menot(data, links, lazy_tables)
+    yield '</div></div></div></div>'
+
+    yield generate_taulukkolinkki()
+    yield generate_naamat()
+    yield generate_outro()
+
+    yield generate_2023()
+    yield generate_mediassa_2023()
+
+    if lazy_tables:
+        yield generate_tables_json(row for row in data.values() if links is None or row.osoite not in links)
+    yield generate_js(lazy_tables)
+    yield """<div style="height:50px" class="hr hr-invisible   avia-builder-el-115  el_after_av_hr  avia-builder-el-last "><span class="hr-inner "><span class="hr-inner-style"></span></span></div></div>"""
+
+    yield generate_version()
+
+def generate_version() -> str:
+    """
+    Release version
+    """
+    doc, tag, text = Doc().tagtext()
     current_datetime = datetime.datetime.now()
-    timestamp = current_datetime.timestamp()
     formatted_time = current_datetime.strftime('%c')
     with tag('span', style="font-size: 10pt;"):
         text("Sivun versio: %s" % formatted_time)
+    return doc.getvalue()
+
+@profiled
+def generate_shards(data, lazy_tables=False) -> dict:
+    """
+    Page for each top level row, as dict of slug to (row, html)
+    """
+    rows = list(data.values())
+    pages = render_rows(functools.partial(generate_paaluokka_page, lazy_tables=lazy_tables), rows)
+    shards = {}
+    for row, page in zip(rows, pages):
+        shards[paaluokka_slug(row)] = (row, page)
+    return shards
+
+def paaluokka_slug(row) -> str:
+    """
+    Stable slug for paaluokka page, based on osoite only so that renaming does not create a new page
+    """
+    return 'paaluokka-' + re.sub(r'[^0-9a-z]+', '-', row.osoite.lower()).strip('-')
 
+@profiled
+def generate_paaluokka_page(row, lazy_tables=False) -> str:
+    """
+    Single paaluokka with its menoluokka tables, for sharded publishing
+    """
+    doc, tag, text = Doc().tagtext()
+    with tag('div', klass='main_color av_default_container_wrap container_wrap fullsize'):
+        with tag('div', klass='template-page content  av-content-full alpha units'):
+            with tag('div', klass='entry-content-wrapper clearfix'):
+                with tag('div', klass='flex_column av_one_full  flex_column_div av-zero-column-padding first  avia-builder-el-56  el_after_av_layout_row  el_before_av_one_full  avia-builder-el-first  '):
+                    with tag('h2', style='padding: 35px 10px 30px 35px;'):
+                        text(row.osoite + " " + row.paaluokka_selite)
+                    doc.asis(generate_section_content(row, lazy_tables))
+    if lazy_tables:
+        doc.asis(generate_tables_json([row]))
+    doc.asis(generate_js(lazy_tables))
+    doc.asis(generate_version())
     return doc.getvalue()
 
 def generate_taulukkolinkki() -> str:
@@ -895,6 +3595,7 @@ Tietotekniikan diplomi-insinööri<br>
 
     """
 
+@profiled
 def generate_summary(data, summary) -> str:
     doc, tag, text = Doc().tagtext()
 
@@ -971,6 +3672,7 @@ def generate_summary(data, summary) -> str:
     return doc.getvalue()
 
 # "Säästöjä löydetty ministeriöittän"
+@profiled
 def generate_menot_summary(data) -> str:
     doc, tag, text = Doc().tagtext()
 
@@ -1013,6 +3715,7 @@ def generate_menot_summary(data) -> str:
 
 # XXX https://github.com/liberaalipuolue/leikattavaaloytyy/blob/main/julkaisumateriaali/Liberaalipuolueen%20varjobudjetti%202024%20leikkauksia%20aihepiireitt%C3%A4in%2C%20mrd%20%E2%82%AC.png 
 #     as html
+@profiled
 def generate_aiheipiireittain(data) -> str:
     """
     """
@@ -1051,6 +3754,7 @@ def generate_aiheipiireittain(data) -> str:
 
 
 # Generated progress bars do not make much sense for tulot top level. Not current used due this.
+@profiled
 def generate_tulot_summary(data) -> str:
     doc, tag, text = Doc().tagtext()
 
@@ -1088,71 +3792,151 @@ def generate_tulot_summary(data) -> str:
     return doc.getvalue()
 
 
-def generate_tulot(data):
-    doc, tag, text = Doc().tagtext()
+@profiled
+def generate_tulot(data, links=None, lazy_tables=False):
+    return ''.join(iter_tulot(data, links, lazy_tables))
 
+def iter_tulot(data, links=None, lazy_tables=False):
     # Header
-    doc.asis("""
+    yield """
     <div id="tulot" style="height:50px" class="hr hr-invisible   avia-builder-el-58  el_after_av_textblock  el_before_av_textblock "><span class="hr-inner "><span class="hr-inner-style"></span></span></div>
     <section class="av_textblock_section " itemscope="itemscope" itemtype="https://schema.org/CreativeWork"><div class="avia_textblock  " itemprop="text"><p style="text-align: center;">
     <span style="font-size: 28pt;">Tulot</span></p>
 </div></section>"""
-    )
-
-    doc.asis(generate_tables(data, include_tulot=True, include_menot=False))
 
-    return doc.getvalue()
+    yield from iter_tables(data, include_tulot=True, include_menot=False, links=links, lazy_tables=lazy_tables)
 
-def generate_menot(data):
-    doc, tag, text = Doc().tagtext()
+@profiled
+def generate_menot(data, links=None, lazy_tables=False):
+    return ''.join(iter_menot(data, links, lazy_tables))
 
+def iter_menot(data, links=None, lazy_tables=False):
     # Header
-    doc.asis("""
+    yield """
     <div id="menot" style="height:50px" class="hr hr-invisible   avia-builder-el-58  el_after_av_textblock  el_before_av_textblock "><span class="hr-inner "><span class="hr-inner-style"></span></span></div>
     <section class="av_textblock_section " itemscope="itemscope" itemtype="https://schema.org/CreativeWork"><div class="avia_textblock  " itemprop="text"><p style="text-align: center;">
     <span style="font-size: 28pt;">Menot</span></p>
 </div></section>"""
-    )
 
-    doc.asis(generate_tables(data, include_tulot=False, include_menot=True))
+    yield from iter_tables(data, include_tulot=False, include_menot=True, links=links, lazy_tables=lazy_tables)
+
+def generate_tables(data, include_tulot=True, include_menot=True, links=None, lazy_tables=False) -> str:
+    """
+    Toggle section for each top level row. With links (osoite to url), toggles link to paaluokka pages instead.
+    """
+    return ''.join(iter_tables(data, include_tulot, include_menot, links, lazy_tables))
+
+def iter_tables(data, include_tulot=True, include_menot=True, links=None, lazy_tables=False):
+    """
+    generate_tables() as chunks, one toggle section at a time
+    """
+    rows = [row for row in data.values() if (include_tulot if row.tulo else include_menot)]
+    yield from render_rows(functools.partial(generate_toggle_section, links=links, lazy_tables=lazy_tables), rows)
 
+def generate_toggle_section(row, links=None, lazy_tables=False) -> str:
+    """
+    Toggle section of top level row, or link to its paaluokka page if links has it
+    """
+    doc, tag, text = Doc().tagtext()
+    if links is not None and row.osoite in links:
+        with tag('div', klass='toggle-section', style='border: none;'):
+            with tag('h2', klass='av-elegant-toggle toggler', style='padding: 35px 10px 30px 35px; border-left-width: 0; border-right-width: 0;'):
+                with tag('a', href=links[row.osoite]):
+                    text(row.osoite + " " + row.paaluokka_selite)
+        return doc.getvalue()
+    with tag('div', klass='toggle-section', style='border: none;'):
+        with tag('h2', klass='toggle-button av-elegant-toggle toggler', style='padding: 35px 10px 30px 35px; border-left-width: 0; border-right-width: 0;'):
+            text(row.osoite + " " + row.paaluokka_selite)
+            doc.asis('<span class="toggle_icon"><span class="vert_icon"></span><span class="hor_icon"></span></span>')
+        with tag('div', klass='section-content'):
+            doc.asis(generate_section_content(row, lazy_tables))
     return doc.getvalue()
 
-def generate_tables(data, include_tulot=True, include_menot=True) -> str:
-    """        
+def render_rows(render, rows):
+    """
+    Yields render(row) for each top level row in order. With RENDER_WORKERS other than 1,
+    rows are rendered in a pool of processes, each row with its subrows sent to a worker.
+    """
+    workers = RENDER_WORKERS or os.cpu_count() or 1
+    if workers == 1 or len(rows) < 2:
+        yield from map(render, rows)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, len(rows)),
+                             initializer=init_render_worker, initargs=(RENDERER, TOTEUTUMA_YEAR)) as executor:
+        # Results come in order of rows, whichever worker finishes first
+        yield from executor.map(render, rows)
+
+def init_render_worker(renderer, toteutuma_year=None) -> None:
+    """
+    Sets up render worker process. Workers do not read config, only settings used in rendering are passed on.
+    """
+    global RENDERER, TOTEUTUMA_YEAR, _profiler
+    RENDERER = renderer
+    TOTEUTUMA_YEAR = toteutuma_year
+    # Stages are profiled in the main process only
+    _profiler = None
+
+def generate_section_content(row, lazy_tables=False) -> str:
+    """
+    Top level row amounts, perustelu and tables of its subrows.
+    With lazy_tables, only a placeholder for tables rendered in browser from generate_tables_json() data.
     """
     doc, tag, text = Doc().tagtext()
 
-    for row in data.values():
-        if row.tulo and not include_tulot:
-            continue
-        if not row.tulo and not include_menot:
-            continue
-        with tag('div', klass='toggle-section', style='border: none;'):
-            with tag('h2', klass='toggle-button av-elegant-toggle toggler', style='padding: 35px 10px 30px 35px; border-left-width: 0; border-right-width: 0;'):
-                text(row.osoite + " " + row.paaluokka_selite)
-                doc.asis('<span class="toggle_icon"><span class="vert_icon"></span><span class="hor_icon"></span></span>')
-            with tag('div', klass='section-content'):
-
-                with tag('br'):
-                    pass
-                with tag('h4'):
-                    text(f'Hallituksen esitys: {euros(row.hallitus)}')
-                with tag('h4'):
-                    text(f'Liberaalipuolueen esitys: {euros(row.lib)}')
-                with tag('h4'):
-                    text(f'Reilumpi leikkaus: {euros(row.ero)}')
-                with tag('p', style="font-size: 14pt;"):
-                    text(row.perustelu)
-                if row.linkki:
-                    with tag('p'):
-                        with tag('a', href=row.linkki):
-                            text("Linkki")
-
-                for subrow in row.subrows.values():
-                    doc.asis(generate_level_2(subrow))
+    with tag('br'):
+        pass
+    with tag('h4'):
+        text(f'Hallituksen esitys: {euros_cents(row.hallitus_cents)}')
+    with tag('h4'):
+        text(f'Liberaalipuolueen esitys: {euros_cents(row.lib_cents)}')
+    with tag('h4'):
+        text(f'Reilumpi leikkaus: {euros_cents(row.ero_cents)}')
+    with tag('p', style="font-size: 14pt;"):
+        text(row.perustelu)
+    if row.linkki:
+        with tag('p'):
+            with tag('a', href=row.linkki):
+                text("Linkki")
+
+    if lazy_tables:
+        with tag('div', ('data-osoite', row.osoite), klass='level2-tables'):
+            pass
+        return doc.getvalue()
+
+    for subrow in row.subrows.values():
+        doc.asis(generate_level_2(subrow))
     return doc.getvalue()
 
+@profiled
+def generate_tables_json(rows) -> str:
+    """
+    Level 2 table data of given top level rows as json, for rendering tables in browser.
+
+    {"toteutuma": year, "tables": {osoite: [[title, linkki, hallitus, lib, ero, perustelu,
+                                             [[title, linkki, hallitus, lib, ero, perustelu, muutos, toteutuma], ...],
+                                             muutos, toteutuma], ...]}}
+    Amounts are formatted already, so that tables look the same as when rendered by generate_level_2_table().
+    muutos is [kind, description] of mark_budget_changes(), or null.
+    year is TOTEUTUMA_YEAR or null, toteutuma is included only with year.
+    """
+    toteutuma = bool(TOTEUTUMA_YEAR)
+    tables = {}
+    for row in rows:
+        tables[row.osoite] = [
+            [subrow.osoite + " " + subrow.menoluokka_selite, subrow.linkki,
+             euros_cents(subrow.hallitus_cents), euros_cents(subrow.lib_cents), euros_cents(subrow.ero_cents),
+             subrow.perustelu,
+             [[subsubrow.osoite + " " + subsubrow.momentti_selite, subsubrow.linkki, hallitus, lib, ero,
+               subsubrow.perustelu, subsubrow.muutos] + ([toteutuma_text(subsubrow)] if toteutuma else [])
+              for subsubrow, hallitus, lib, ero in zip(subrow.subrows.values(), *euros_columns(subrow.subrows.values()))],
+             subrow.muutos] + ([toteutuma_text(subrow)] if toteutuma else [])
+            for subrow in row.subrows.values()]
+    payload = json.dumps({'toteutuma': TOTEUTUMA_YEAR or None, 'tables': tables}, ensure_ascii=False, separators=(',', ':'))
+    # Must not end the script element early
+    payload = payload.replace('</', '<\\/')
+    return '<script type="application/json" id="budjetti-tables">' + payload + '</script>'
+
 def generate_level_2(subrow) -> str:
     """
     <section class="av_toggle_section"  itemscope="itemscope" itemtype="https://schema.org/CreativeWork"  >
@@ -1176,6 +3960,9 @@ def generate_level_2(subrow) -> str:
     Oikeusvaltion ylläpito tulee turvata riittävällä rahoituksella. IT-hankkeiden resurssitehokkuutta tulee parantaa.</span>
     </p>
     """
+    if RENDERER == 'template':
+        return render_level_2(subrow)
+
     doc, tag, text = Doc().tagtext()
 
     with tag('section', klass='inner-toggle-section'):
@@ -1197,6 +3984,22 @@ def generate_level_2(subrow) -> str:
 
     return doc.getvalue()
 
+# Background of rows changed since compared budget, see mark_budget_changes()
+MUUTOS_STYLES = {
+    'uusi': 'background-color: #dff0d8 !important;',
+    'uudelleennumeroitu': 'background-color: #d9edf7 !important;',
+    'muuttunut': 'background-color: #fcf8e3 !important;',
+}
+
+def level_2_row_attrs(row, klass, style=None) -> list:
+    """
+    Attributes of level 2 table row. Changed rows get muutos class, description as title and highlight unless style is given.
+    """
+    if row.muutos is None:
+        return [('class', klass)] + ([('style', style)] if style else [])
+    kind, description = row.muutos
+    return [('title', description), ('class', '%s muutos-%s' % (klass, kind)), ('style', style or MUUTOS_STYLES[kind])]
+
 def generate_level_2_table(subrow) -> str:
     """
     Returns table as yattag doc
@@ -1231,6 +4034,9 @@ def generate_level_2_table(subrow) -> str:
                     text('Momentti')
                 with tag('th'):
                     text('Hallituksen esitys')
+                if TOTEUTUMA_YEAR:
+                    with tag('th'):
+                        text('Toteutuma %d' % TOTEUTUMA_YEAR)
                 with tag('th'):
                     text('Liberaalipuolueen esitys')
                 with tag('th'):
@@ -1242,7 +4048,7 @@ def generate_level_2_table(subrow) -> str:
 
             # Draw menoluokka as special row
             # #ffd90 Bright yellow
-            with tag('tr', klass='menoluokka_row', style='background-color: rgb(255, 217, 0) !important;'):
+            with tag('tr', *level_2_row_attrs(subrow, 'menoluokka_row', 'background-color: rgb(255, 217, 0) !important;')):
                 with tag('td'):
                     with tag('h4', klass='table_header'):
                         text(subrow.osoite + " " + subrow.menoluokka_selite)
@@ -1252,23 +4058,27 @@ def generate_level_2_table(subrow) -> str:
                                 text("Linkki")
                 with tag('td'):
                     with tag('h4', klass='table_header'):
-                        text(euros(subrow.hallitus))
+                        text(euros_cents(subrow.hallitus_cents))
+                if TOTEUTUMA_YEAR:
+                    with tag('td'):
+                        with tag('h4', klass='table_header'):
+                            text(toteutuma_text(subrow))
                 with tag('td'):
                     with tag('h4', klass='table_header'):
-                        text(euros(subrow.lib))
+                        text(euros_cents(subrow.lib_cents))
                 with tag('td'):
                     with tag('h4', klass='table_header'):
-                        text(euros(subrow.ero))
+                        text(euros_cents(subrow.ero_cents))
                 with tag('td'):
                     with tag('h4', klass='table_header'):
                         text(subrow.perustelu)
 
-            for subsubrow in subrow.subrows.values():
+            for subsubrow, hallitus, lib, ero in zip(subrow.subrows.values(), *euros_columns(subrow.subrows.values())):
                 odd = not odd
                 class_text = 'even'
                 if odd:
                     class_text = 'odd'
-                with tag('tr', klass=class_text):
+                with tag('tr', *level_2_row_attrs(subsubrow, class_text)):
                     with tag('td'):
                         text(subsubrow.osoite + " " + subsubrow.momentti_selite)
                         text(" ")
@@ -1276,23 +4086,138 @@ def generate_level_2_table(subrow) -> str:
                             with tag('a', href=subsubrow.linkki, target='_blank'):
                                 text("Linkki")
                     with tag('td'):
-                        text(euros(subsubrow.hallitus))
+                        text(hallitus)
+                    if TOTEUTUMA_YEAR:
+                        with tag('td'):
+                            text(toteutuma_text(subsubrow))
                     with tag('td'):
-                        text(euros(subsubrow.lib))
+                        text(lib)
                     with tag('td'):
-                        text(euros(subsubrow.ero))
+                        text(ero)
                     with tag('td'):
                         text(subsubrow.perustelu)
             
     return doc.getvalue()
 
-def generate_js() -> str:
+def toteutuma_text(row) -> str:
+    """
+    Toteutuma of row for level 2 table, empty if history database does not have it
+    """
+    return '' if row.toteutuma_cents is None else euros_cents(row.toteutuma_cents)
+
+@contextlib.contextmanager
+def use_renderer(renderer):
+    """
+    Renders level 2 tables with given renderer inside the block
+    """
+    global RENDERER
+    previous = RENDERER
+    RENDERER = renderer
+    try:
+        yield
+    finally:
+        RENDERER = previous
+
+class HtmlTemplate:
+    """
+    Html fragment with {name} fields, parsed once. Values must be escaped already, see escape_text() and escape_attr().
+    """
+    __slots__ = ('source', 'fields')
+
+    def __init__(self, source):
+        self.source = source
+        self.fields = frozenset(field for _, field, _, _ in string.Formatter().parse(source) if field)
+
+    def fill(self, **values) -> str:
+        missing = self.fields.difference(values)
+        if missing:
+            raise KeyError("Template fields missing: %s" % ', '.join(sorted(missing)))
+        return self.source.format_map(values)
+
+def html_attrs(attrs) -> str:
+    """
+    (name, value) pairs as html attributes, like yattag writes them
+    """
+    return ''.join(' %s="%s"' % (name, escape_attr(value)) for name, value in attrs)
+
+def escape_text(value: str) -> str:
+    """
+    Escapes text content like yattag text()
+    """
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+def escape_attr(value: str) -> str:
+    """
+    Escapes attribute value like yattag
+    """
+    return value.replace("&", "&amp;").replace("<", "&lt;").replace('"', "&quot;")
+
+# Same markup as generate_level_2() and generate_level_2_table() produce with yattag
+LEVEL_2_START = HtmlTemplate(
+    '<section class="inner-toggle-section">'
+    '<table class="datatable tablepress tablepress-responsive tablepress-responsive-stack-tablet tablepress-id-11_verot">'
+    '<thead><tr><th>Momentti</th><th>Hallituksen esitys</th>{toteutuma}<th>Liberaalipuolueen esitys</th>'
+    '<th>Reilumpi leikkaus</th><th>Perustelu</th></tr></thead><tbody>')
+LEVEL_2_MENOLUOKKA_ROW = HtmlTemplate(
+    '<tr{attrs}>'
+    '<td><h4 class="table_header">{title}{link}</h4></td>'
+    '<td><h4 class="table_header">{hallitus}</h4></td>{toteutuma}'
+    '<td><h4 class="table_header">{lib}</h4></td>'
+    '<td><h4 class="table_header">{ero}</h4></td>'
+    '<td><h4 class="table_header">{perustelu}</h4></td></tr>')
+LEVEL_2_MENOLUOKKA_TOTEUTUMA = HtmlTemplate('<td><h4 class="table_header">{toteutuma}</h4></td>')
+LEVEL_2_MENOLUOKKA_LINK = HtmlTemplate('<a href="{href}">Linkki</a>')
+LEVEL_2_MOMENTTI_ROW = HtmlTemplate(
+    '<tr{attrs}><td>{title} {link}</td><td>{hallitus}</td>{toteutuma}<td>{lib}</td><td>{ero}</td><td>{perustelu}</td></tr>')
+LEVEL_2_MOMENTTI_TOTEUTUMA = HtmlTemplate('<td>{toteutuma}</td>')
+# Toteutuma column is added only with TOTEUTUMA_YEAR
+LEVEL_2_TOTEUTUMA_HEADER = HtmlTemplate('<th>Toteutuma {year}</th>')
+LEVEL_2_MOMENTTI_LINK = HtmlTemplate('<a href="{href}" target="_blank">Linkki</a>')
+LEVEL_2_END = HtmlTemplate('</tbody></table></section>')
+
+def render_level_2(subrow) -> str:
+    """
+    generate_level_2() with precompiled templates instead of yattag, output is identical
+    """
+    toteutuma = bool(TOTEUTUMA_YEAR)
+    parts = [LEVEL_2_START.fill(toteutuma=LEVEL_2_TOTEUTUMA_HEADER.fill(year=TOTEUTUMA_YEAR) if toteutuma else '')]
+    link = LEVEL_2_MENOLUOKKA_LINK.fill(href=escape_attr(subrow.linkki)) if subrow.linkki else ''
+    parts.append(LEVEL_2_MENOLUOKKA_ROW.fill(
+        attrs=html_attrs(level_2_row_attrs(subrow, 'menoluokka_row', 'background-color: rgb(255, 217, 0) !important;')),
+        title=escape_text(subrow.osoite + " " + subrow.menoluokka_selite),
+        link=link,
+        hallitus=escape_text(euros_cents(subrow.hallitus_cents)),
+        toteutuma=LEVEL_2_MENOLUOKKA_TOTEUTUMA.fill(toteutuma=escape_text(toteutuma_text(subrow))) if toteutuma else '',
+        lib=escape_text(euros_cents(subrow.lib_cents)),
+        ero=escape_text(euros_cents(subrow.ero_cents)),
+        perustelu=escape_text(subrow.perustelu)))
+
+    odd = True
+    fill_row = LEVEL_2_MOMENTTI_ROW.source.format
+    for subsubrow, hallitus, lib, ero in zip(subrow.subrows.values(), *euros_columns(subrow.subrows.values())):
+        odd = not odd
+        link = LEVEL_2_MOMENTTI_LINK.fill(href=escape_attr(subsubrow.linkki)) if subsubrow.linkki else ''
+        # Same fields on every row, format directly without checks of fill()
+        parts.append(fill_row(
+            attrs=html_attrs(level_2_row_attrs(subsubrow, 'odd' if odd else 'even')),
+            title=escape_text(subsubrow.osoite + " " + subsubrow.momentti_selite),
+            link=link,
+            hallitus=escape_text(hallitus),
+            toteutuma=LEVEL_2_MOMENTTI_TOTEUTUMA.fill(toteutuma=escape_text(toteutuma_text(subsubrow))) if toteutuma else '',
+            lib=escape_text(lib),
+            ero=escape_text(ero),
+            perustelu=escape_text(subsubrow.perustelu)))
+    parts.append(LEVEL_2_END.source)
+    return ''.join(parts)
+
+def generate_js(lazy_tables=False) -> str:
     """
     Add js for:
     * Collapsing tables
     * Datatables for search
+    * Rendering level 2 tables from json, if lazy_tables
     """
-    return """    
+    js = """    
      <script>
         jQuery(document).ready(function(){
             jQuery(".toggle-button").click(function(){
@@ -1320,6 +4245,148 @@ def generate_js() -> str:
        });
     </script>
  
+    """
+    if lazy_tables:
+        js += generate_tables_js()
+    return js
+
+def generate_tables_js() -> str:
+    """
+    Builds level 2 tables from generate_tables_json() data, same markup as generate_level_2().
+    Tables of a section are built when its toggle is opened first time, or right away outside toggles.
+    """
+    return """
+    <script>
+        var budjettiTables = null;
+        var budjettiMuutosStyles = """ + json.dumps(MUUTOS_STYLES) + """;
+
+        function budjettiElement(name, className, text) {
+            var element = document.createElement(name);
+            if (className) {
+                element.className = className;
+            }
+            if (text !== undefined) {
+                element.textContent = text;
+            }
+            return element;
+        }
+
+        function budjettiLink(href, target) {
+            var link = budjettiElement("a", null, "Linkki");
+            link.href = href;
+            if (target) {
+                link.target = target;
+            }
+            return link;
+        }
+
+        function budjettiCell(row, text, header) {
+            var cell = budjettiElement("td");
+            if (header) {
+                cell.appendChild(budjettiElement("h4", "table_header", text));
+            } else {
+                cell.textContent = text;
+            }
+            row.appendChild(cell);
+            return cell;
+        }
+
+        // Same as level_2_row_attrs()
+        function budjettiMuutos(row, muutos, style) {
+            if (muutos) {
+                row.title = muutos[1];
+                row.className += " muutos-" + muutos[0];
+                row.setAttribute("style", style || budjettiMuutosStyles[muutos[0]]);
+            }
+        }
+
+        function budjettiRenderTables(container) {
+            if (container.getAttribute("data-rendered")) {
+                return;
+            }
+            container.setAttribute("data-rendered", "1");
+            if (budjettiTables === null) {
+                budjettiTables = JSON.parse(document.getElementById("budjetti-tables").textContent);
+            }
+            var fragment = document.createDocumentFragment();
+            var toteutuma = budjettiTables.toteutuma;
+            var titles = ["Momentti", "Hallituksen esitys", "Liberaalipuolueen esitys", "Reilumpi leikkaus", "Perustelu"];
+            if (toteutuma) {
+                titles.splice(2, 0, "Toteutuma " + toteutuma);
+            }
+            (budjettiTables.tables[container.getAttribute("data-osoite")] || []).forEach(function(subrow) {
+                var section = budjettiElement("section", "inner-toggle-section");
+                var table = budjettiElement("table", "datatable tablepress tablepress-responsive tablepress-responsive-stack-tablet tablepress-id-11_verot");
+                var thead = budjettiElement("thead");
+                var headerRow = budjettiElement("tr");
+                titles.forEach(function(title) {
+                    headerRow.appendChild(budjettiElement("th", null, title));
+                });
+                thead.appendChild(headerRow);
+                table.appendChild(thead);
+
+                var tbody = budjettiElement("tbody");
+                var menoluokkaRow = budjettiElement("tr", "menoluokka_row");
+                menoluokkaRow.setAttribute("style", "background-color: rgb(255, 217, 0) !important;");
+                budjettiMuutos(menoluokkaRow, subrow[7], menoluokkaRow.getAttribute("style"));
+                var titleCell = budjettiCell(menoluokkaRow, subrow[0], true);
+                if (subrow[1]) {
+                    titleCell.firstChild.appendChild(budjettiLink(subrow[1]));
+                }
+                budjettiCell(menoluokkaRow, subrow[2], true);
+                if (toteutuma) {
+                    budjettiCell(menoluokkaRow, subrow[8], true);
+                }
+                budjettiCell(menoluokkaRow, subrow[3], true);
+                budjettiCell(menoluokkaRow, subrow[4], true);
+                budjettiCell(menoluokkaRow, subrow[5], true);
+                tbody.appendChild(menoluokkaRow);
+
+                subrow[6].forEach(function(subsubrow, index) {
+                    var row = budjettiElement("tr", index % 2 == 0 ? "even" : "odd");
+                    var cell = budjettiCell(row, subsubrow[0] + " ");
+                    if (subsubrow[1]) {
+                        cell.appendChild(budjettiLink(subsubrow[1], "_blank"));
+                    }
+                    budjettiCell(row, subsubrow[2]);
+                    if (toteutuma) {
+                        budjettiCell(row, subsubrow[7]);
+                    }
+                    budjettiCell(row, subsubrow[3]);
+                    budjettiCell(row, subsubrow[4]);
+                    budjettiCell(row, subsubrow[5]);
+                    budjettiMuutos(row, subsubrow[6]);
+                    tbody.appendChild(row);
+                });
+                table.appendChild(tbody);
+                section.appendChild(table);
+                fragment.appendChild(section);
+            });
+            container.appendChild(fragment);
+
+            jQuery(container).find("table.datatable").DataTable({
+                paging: false,
+                searching: true,
+                ordering: false,
+                language: {
+                  url: '//cdn.datatables.net/plug-ins/1.13.6/i18n/fi.json',
+                },
+            });
+        }
+
+        jQuery(document).ready(function(){
+            jQuery(".toggle-button").click(function(){
+                jQuery(this).closest(".toggle-section").find(".level2-tables").each(function(){
+                    budjettiRenderTables(this);
+                });
+            });
+            jQuery(".level2-tables").each(function(){
+                if (jQuery(this).closest(".section-content").length == 0) {
+                    budjettiRenderTables(this);
+                }
+            });
+        });
+    </script>
     """
 
     # Not needed
@@ -1328,6 +4395,281 @@ def generate_js() -> str:
     
     
 
+def run_benchmarks(args):
+    """
+    Times parse, sort, tree cache, render and publish stages with fixture data scaled to each of --scales.
+    Publishing goes to a local Wordpress stand-in, nothing is sent anywhere.
+    """
+    fixture = args.fixture or BENCH_FIXTURE
+    repeat = BENCH_REPEAT if args.repeat is None else args.repeat
+    scales_arg = args.scales or BENCH_SCALES
+    import platform
+    if args.record:
+        record_fixture(get_data_source_from_args(args), fixture)
+        return
+
+    if not args.synthetic and not os.path.exists(fixture):
+        print("Benchmark fixture %s not found, record one with: bench --record, or use bench --synthetic" % fixture)
+        sys.exit(1)
+    try:
+        scales = [int(scale) for scale in scales_arg.split(',')]
+    except ValueError:
+        print("Invalid --scales %r, expected comma separated integers" % scales_arg)
+        sys.exit(1)
+
+    seed = SYNTHETIC_SEED if args.seed is None else args.seed
+    if args.synthetic:
+        # Synthetic budget of scale 1 has the size of the real budget tree
+        base_rows = len(read_budget_tree(SYNTHETIC_TREE)[1])
+    else:
+        source = FixtureDataSource(fixture)
+        values = source.values()
+        extras = source.extras()
+
+    results = {
+        'format': 1,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'fixture': 'synthetic:%d' % seed if args.synthetic else fixture,
+        'repeat': repeat,
+        'results': []
+    }
+
+    server = BenchWordPressServer()
+    try:
+        client = WordPressClient(server.url, 'bench', 'bench', timeout=WORDPRESS_TIMEOUT,
+                                 retries=0, compress=WORDPRESS_COMPRESS, stream=WORDPRESS_STREAM)
+        for scale in scales:
+            if args.synthetic:
+                source = SyntheticDataSource(base_rows * scale, seed)
+                values = source.values()
+                extras = source.extras()
+            else:
+                values = scale_values(source.values(), scale)
+            result = {'scale': scale}
+            result.update(run_benchmark(values, extras, client, repeat))
+            results['results'].append(result)
+            print("Scale %dx, %d rows: %s" % (scale, result['rows'], ', '.join(
+                '%s %.3fs' % (stage, timing['median']) for stage, timing in result['stages'].items())))
+    finally:
+        server.close()
+
+    output = args.output or 'benchmark/results-%s.json' % (results['commit'] or 'unknown')[:12]
+    directory = os.path.dirname(output)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+    print("Wrote benchmark results to %s" % output)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if compare_benchmarks(baseline, results, args.threshold):
+            sys.exit(40)
+
+def run_benchmark(values, extras, client, repeat) -> dict:
+    """
+    Runs all stages repeat times, returns stage timings in seconds and sizes of the last run
+    """
+    import statistics
+    import tempfile
+    timings = defaultdict(list)
+    result = {}
+    tempDirectory = tempfile.TemporaryDirectory()
+    for run in range(max(1, repeat)):
+        # File of each run is new, earlier mapped trees must not see it change
+        treePath = os.path.join(tempDirectory.name, 'tree-%d.bin' % run)
+        # Stages print progress per row or page, not wanted between timings
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            data = list(iter_data_objects(values))
+            summary = parse_summary(extras)
+            timings['parse'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            dataDict = sort_data(data)
+            timings['sort'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            write_tree_cache(dataDict, treePath, {})
+            timings['tree_store'].append(time.perf_counter() - start)
+
+            # Mapping only, rows are read when rendering
+            start = time.perf_counter()
+            mappedTree = MappedBudgetTree(treePath)
+            timings['tree_load'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            html = generate_html(dataDict, summary)
+            timings['render'].append(time.perf_counter() - start)
+
+            # Same page with precompiled templates, output must not change
+            start = time.perf_counter()
+            with use_renderer('template'):
+                templateHtml = generate_html(dataDict, summary)
+            timings['render_template'].append(time.perf_counter() - start)
+
+            if run == 0:
+                # Same page from mapped tree, not timed
+                mappedHtml = generate_html(mappedTree, summary)
+
+            # Uploaded from file like run_publish() does, streamed unless [wordpress] STREAM_REQUESTS is off
+            page = write_html([html], os.path.join(tempDirectory.name, 'output.html'))
+            start = time.perf_counter()
+            response = client.update_page(1, page)
+            timings['publish'].append(time.perf_counter() - start)
+
+        if response is None:
+            print("Publishing to benchmark server failed")
+            sys.exit(30)
+        if content_hash(response['content']['raw']) != page.digest:
+            print("Benchmark server got different content than was published")
+            sys.exit(30)
+        # Timings of a renderer with different output are not comparable, and the output is a regression
+        if content_hash(templateHtml) != content_hash(html):
+            print("Template renderer output differs from yattag output")
+            sys.exit(50)
+        if run == 0 and content_hash(mappedHtml) != content_hash(html):
+            print("Output from mapped tree differs from sorted tree output")
+            sys.exit(50)
+        result = {
+            'rows': len(values) - 1,
+            'parsed_rows': len(data),
+            'html_bytes': len(html.encode('utf-8')),
+        }
+
+    tempDirectory.cleanup()
+    result['stages'] = {stage: {
+        'runs': runs,
+        'min': min(runs),
+        'median': statistics.median(runs),
+        } for stage, runs in timings.items()}
+    return result
+
+def compare_benchmarks(baseline, results, threshold) -> bool:
+    """
+    Prints stage medians against baseline results of the same scale. Returns True if any stage regressed over threshold.
+    """
+    baseline_by_scale = {result['scale']: result for result in baseline.get('results', [])}
+    regressed = False
+    for result in results['results']:
+        base = baseline_by_scale.get(result['scale'])
+        if base is None:
+            continue
+        for stage, timing in result['stages'].items():
+            if stage not in base['stages']:
+                continue
+            base_median = base['stages'][stage]['median']
+            change = timing['median'] / base_median - 1 if base_median else 0.0
+            # Stages taking milliseconds vary more than that between runs
+            slower = change > threshold and timing['median'] - base_median > 0.005
+            regressed = regressed or slower
+            print("Scale %dx %s: %.3fs -> %.3fs (%+.0f%%)%s" % (result['scale'], stage, base_median, timing['median'],
+                                                             change * 100, ' REGRESSION' if slower else ''))
+    return regressed
+
+def scale_values(values, factor) -> list:
+    """
+    Repeats data rows factor times. Copies get paaluokka numbers offset by 100 per copy,
+    so that they form separate paaluokka trees: 28.10.01 is copied as 128.10.01, 228.10.01, ...
+    """
+    rows = [row for row in values if row]
+    header, rows = rows[:1], rows[1:]
+    scaled = header + rows
+    for copy in range(1, factor):
+        for row in rows:
+            if len(row) > COL_IDX_OSOITE:
+                match = re.match(r'(\d+)(.*)', str(row[COL_IDX_OSOITE]), re.DOTALL)
+                if match:
+                    row = list(row)
+                    row[COL_IDX_OSOITE] = str(int(match.group(1)) + copy * 100) + match.group(2)
+            scaled.append(row)
+    return scaled
+
+def git_commit():
+    """
+    Current git commit, or None if not in a git checkout
+    """
+    import subprocess
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class BenchWordPressServer:
+    """
+    Local stand-in for Wordpress REST API pages endpoint, runs in a background thread.
+    Accepts page updates like Wordpress does and responds with the updated page.
+    """
+    def __init__(self):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        pages = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def page_id(self):
+                match = re.match(r'/wp-json/wp/v2/pages/(\d+)', self.path)
+                return int(match.group(1)) if match else None
+
+            def do_GET(self):
+                page_id = self.page_id()
+                if page_id not in pages:
+                    self.send_json(404, {'code': 'rest_post_invalid_id'})
+                    return
+                self.send_json(200, pages[page_id])
+
+            def read_body(self) -> bytes:
+                if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                # Chunk size line in hex, chunk and line end, until chunk of size 0 and optional trailer
+                parts = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if size == 0:
+                        while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                            pass
+                        return b''.join(parts)
+                    parts.append(self.rfile.read(size))
+                    self.rfile.readline()
+
+            def do_POST(self):
+                page_id = self.page_id()
+                if page_id is None:
+                    self.send_json(404, {'code': 'rest_no_route'})
+                    return
+                body = self.read_body()
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                content = json.loads(body)['content']
+                pages[page_id] = {
+                    'id': page_id,
+                    'modified': datetime.datetime.now().isoformat(timespec='seconds'),
+                    'content': {'raw': content, 'rendered': content}
+                }
+                self.send_json(200, pages[page_id])
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
 
 if __name__ == '__main__':
     main()